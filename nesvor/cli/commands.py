@@ -3,15 +3,22 @@ import argparse
 import logging
 import re
 import os
+import copy
+import traceback
 import torch
 from typing import List, Optional, Tuple, Dict, Any, cast
 from ..image import Stack, Slice, Volume
 from ..svort.inference import svort_predict
 from ..inr.train import train
 from ..inr.models import INR
-from ..inr.sample import sample_volume, sample_slices, override_sample_mask
-from .io import outputs, inputs
-from ..utils import makedirs, log_args, log_result
+from ..inr.sample import (
+    sample_volume,
+    sample_volume_streaming,
+    sample_slices,
+    override_sample_mask,
+)
+from .io import outputs, inputs, load_manifest
+from ..utils import makedirs, log_args, log_result, set_seed
 from ..preprocessing import n4_bias_field_correction, assess, brain_segmentation
 from ..segmentation import twai
 from ..svr import slice_to_volume_reconstruction
@@ -56,7 +63,7 @@ class Command(object):
         keys = ["output_slices", "simulated_slices"]
         makedirs([getattr(self.args, k, None) for k in keys])
 
-        keys = ["output_model", "output_volume"]
+        keys = ["output_model", "output_volume", "checkpoint"]
         for k in keys:
             if getattr(self.args, k, None):
                 makedirs(os.path.dirname(getattr(self.args, k)))
@@ -103,6 +110,9 @@ class Reconstruct(Command):
             self.args.inference_batch_size = 8 * self.args.batch_size
         if not self.args.n_inference_samples:
             self.args.n_inference_samples = 2 * self.args.n_samples
+        # checkpoint
+        if getattr(self.args, "resume", False) and not self.args.checkpoint:
+            raise ValueError("--checkpoint is not provided for --resume!")
         # deformable
         if self.args.deformable:
             if not self.args.single_precision:
@@ -183,6 +193,49 @@ class Reconstruct(Command):
         )
 
 
+class ReconstructBatch(Command):
+    def check_args(self) -> None:
+        self.subjects = load_manifest(self.args.manifest)
+        if not self.subjects:
+            raise ValueError("No subject is found in the manifest!")
+        # parse the arguments of all subjects before running any of them
+        self.subject_args = [
+            _subject_args(self.args, subject) for subject in self.subjects
+        ]
+
+    def exec(self) -> None:
+        failed = []
+        for i, (subject, args) in enumerate(zip(self.subjects, self.subject_args)):
+            name = str(subject.get("name", i))
+            logging.info(
+                "Subject %s (%d/%d) starts ...", name, i + 1, len(self.subjects)
+            )
+            handler = None
+            if args.output_log and args.output_log != self.args.output_log:
+                makedirs(os.path.dirname(args.output_log))
+                handler = logging.FileHandler(args.output_log, mode="w")
+                handler.setFormatter(logging.getLogger().handlers[-1].formatter)
+                logging.getLogger().addHandler(handler)
+            try:
+                set_seed(args.seed)
+                Reconstruct(args).main()
+            except Exception:
+                failed.append(name)
+                logging.error("Subject %s failed:\n%s", name, traceback.format_exc())
+            finally:
+                if handler is not None:
+                    logging.getLogger().removeHandler(handler)
+                    handler.close()
+                if "cuda" in str(args.device):
+                    torch.cuda.empty_cache()
+        log_result(
+            "%d/%d subjects finished successfully."
+            % (len(self.subjects) - len(failed), len(self.subjects))
+        )
+        if failed:
+            raise RuntimeError("Failed subjects: %s" % ", ".join(failed))
+
+
 class SampleVolume(Command):
     def exec(self) -> None:
         self.new_timer("Data loading")
@@ -390,8 +443,18 @@ def _register(args: argparse.Namespace, data: List[Stack]) -> List[Slice]:
     else:
         raise ValueError("Unkown registration method!")
     force_scanner = args.scanner_space
+    args_registration = None
+    if args.registration_optimizer != "gd":
+        args_registration = {"optimizer": {"name": args.registration_optimizer}}
     slices = svort_predict(
-        data, args.device, args.svort_version, svort, vvr, force_vvr, force_scanner
+        data,
+        args.device,
+        args.svort_version,
+        svort,
+        vvr,
+        force_vvr,
+        force_scanner,
+        args_registration,
     )
     return slices
 
@@ -471,17 +534,32 @@ def _sample_inr(
         getattr(args, "sample_orientation", None),
     )
 
-    output_volume = (
-        sample_volume(
+    output_volume = None
+    if return_volume and getattr(args, "inference_memory_budget", None):
+        # stream the output volume to disk
+        sample_volume_streaming(
+            model,
+            mask,
+            args.output_resolution * args.output_psf_factor,
+            args.output_volume,
+            args.inference_memory_budget * 1024**3,
+            args.n_inference_samples,
+            args.output_intensity_mean,
+            getattr(args, "psf_sampling", "random"),
+            getattr(args, "occupancy_block_size", 0),
+            getattr(args, "occupancy_threshold", 0.01),
+        )
+    elif return_volume:
+        output_volume = sample_volume(
             model,
             mask,
             args.output_resolution * args.output_psf_factor,
             args.inference_batch_size,
             args.n_inference_samples,
+            getattr(args, "psf_sampling", "random"),
+            getattr(args, "occupancy_block_size", 0),
+            getattr(args, "occupancy_threshold", 0.01),
         )
-        if return_volume
-        else None
-    )
 
     simulated_slices = (
         sample_slices(
@@ -490,6 +568,7 @@ def _sample_inr(
             mask,
             args.output_psf_factor,
             args.n_inference_samples,
+            getattr(args, "psf_sampling", "random"),
         )
         if return_slices
         else None
@@ -497,6 +576,45 @@ def _sample_inr(
     return output_volume, simulated_slices
 
 
+def _subject_args(
+    args: argparse.Namespace, subject: Dict[str, Any]
+) -> argparse.Namespace:
+    # parse the arguments of a subject in the manifest on top of the batch arguments
+    from .parsers import main_parser
+
+    parser = main_parser()[1].choices["reconstruct"]
+    actions = {a.dest: a for a in parser._actions if a.option_strings}
+    argv: List[str] = []
+    for k, v in subject.items():
+        if k == "name":
+            continue
+        k = k.lstrip("-").replace("-", "_")
+        if k not in actions:
+            raise ValueError("Unknown argument <%s> in the manifest!" % k)
+        action = actions[k]
+        if action.nargs == 0:  # flags
+            if str(v).lower() in ("1", "true", "yes"):
+                argv.append(action.option_strings[-1])
+            continue
+        argv.append(action.option_strings[-1])
+        if isinstance(v, list):
+            argv.extend(str(x) for x in v)
+        elif isinstance(v, str) and action.nargs is not None:
+            argv.extend(v.split())
+        else:
+            argv.append(str(v))
+    subject_args = copy.deepcopy(args)
+    subject_args.command = "reconstruct"
+    subject_args = parser.parse_args(argv, namespace=subject_args)
+    if "device" in subject:
+        subject_args.device = (
+            torch.device(subject_args.device)
+            if subject_args.device >= 0
+            else torch.device("cpu")
+        )
+    return subject_args
+
+
 """warnings and checks"""
 
 
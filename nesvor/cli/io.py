@@ -1,7 +1,8 @@
 import torch
-from typing import Dict, Tuple, Any, Optional
+from typing import Dict, Tuple, Any, Optional, List
 from argparse import Namespace
 import json
+import csv
 import logging
 from ..image import (
     Volume,
@@ -15,6 +16,24 @@ from ..utils import merge_args
 from ..preprocessing import stack_intersect, otsu_thresholding, thresholding
 
 
+def load_manifest(path: str) -> List[Dict[str, Any]]:
+    # a list of subjects, each is a dict of arguments
+    if path.endswith(".json"):
+        with open(path, "r") as f:
+            subjects = json.load(f)
+        if isinstance(subjects, dict):
+            subjects = subjects["subjects"]
+    elif path.endswith(".csv"):
+        with open(path, "r", newline="") as f:
+            subjects = [
+                {k.strip(): v.strip() for k, v in row.items() if k and v and v.strip()}
+                for row in csv.DictReader(f)
+            ]
+    else:
+        raise ValueError("The manifest should be a .csv or .json file!")
+    return subjects
+
+
 def inputs(args: Namespace) -> Tuple[Dict, Namespace]:
     input_dict: Dict[str, Any] = dict()
     if getattr(args, "input_stacks", None) is not None:
@@ -68,7 +87,10 @@ def inputs(args: Namespace) -> Tuple[Dict, Namespace]:
 
 
 def outputs(data: Dict, args: Namespace) -> None:
-    if getattr(args, "output_volume", None) and "output_volume" in data:
+    if (
+        getattr(args, "output_volume", None)
+        and data.get("output_volume") is not None
+    ):
         if args.output_intensity_mean:
             data["output_volume"].rescale(args.output_intensity_mean)
         data["output_volume"].save(
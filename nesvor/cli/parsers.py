@@ -228,6 +228,148 @@ def build_parser_training() -> argparse.ArgumentParser:
         type=int,
         help="Number of sample for PSF during training.",
     )
+    parser.add_argument(
+        "--early-stop-window",
+        type=int,
+        default=0,
+        help=rst(
+            "If > 0, monitor the convergence of the data loss, averaged over windows of N iterations. "
+            "Training stops early when the relative improvement of the mean loss of a window over the previous window "
+            "is less than `--early-stop-tol <#early-stop-tol>`__ after all the learning rate decays."
+        ),
+    )
+    parser.add_argument(
+        "--early-stop-tol",
+        type=float,
+        default=1e-3,
+        help="Tolerance of relative improvement of the windowed mean loss for convergence.",
+    )
+    parser.add_argument(
+        "--adaptive-milestones",
+        action="store_true",
+        help=rst(
+            "Decay the learning rate as soon as the loss converges (requires `--early-stop-window <#early-stop-window>`__), "
+            "the fixed `--milestones <#milestones>`__ are used as the latest iterations for the decays."
+        ),
+    )
+    parser.add_argument(
+        "--progressive-levels",
+        type=float,
+        default=0,
+        help=rst(
+            "Coarse-to-fine training of the hash grid encoding. "
+            "Training starts with the coarsest `--progressive-start-levels <#progressive-start-levels>`__ levels, "
+            "and the finer levels are unlocked one by one until all levels are active at this fraction of the iterations "
+            "(0 to disable). The disabled levels are not computed in the pytorch implementation."
+        ),
+    )
+    parser.add_argument(
+        "--progressive-start-levels",
+        type=int,
+        default=4,
+        help="Number of active hash grid levels at the beginning of coarse-to-fine training.",
+    )
+    parser.add_argument(
+        "--lazy-adam",
+        action="store_true",
+        help=(
+            "Use a lazy (row-wise sparse) Adam optimizer for the hash grid encoding, "
+            "which only updates the rows touched by each batch."
+        ),
+    )
+    parser.add_argument(
+        "--n-proc-train",
+        type=int,
+        default=1,
+        help=rst(
+            "Number of processes for data-parallel training. "
+            "The training points are sharded across the processes and the gradients are all-reduced in each iteration "
+            "(gloo on CPU, NCCL on GPUs, where process i uses the i-th GPU after `--device <#device>`__). "
+            "`--batch-size <#batch-size>`__ is the total batch size of all processes."
+        ),
+    )
+    parser.add_argument(
+        "--sample-with-replacement",
+        action="store_true",
+        help="Sample training batches with replacement instead of iterating over random permutations of the data.",
+    )
+    parser.add_argument(
+        "--importance-sampling",
+        action="store_true",
+        help=rst(
+            "Sample the training pixels in proportion to their running errors (mixed with uniform sampling, see `--importance-uniform <#importance-uniform>`__), "
+            "and reweight the data terms of the loss accordingly. "
+            "Overrides `--sample-with-replacement <#sample-with-replacement>`__."
+        ),
+    )
+    parser.add_argument(
+        "--importance-uniform",
+        type=float,
+        default=0.5,
+        help="Fraction of uniform sampling mixed into importance sampling, which bounds the importance weights. Should be in (0, 1].",
+    )
+    parser.add_argument(
+        "--no-prefetch",
+        action="store_true",
+        help="Disable preparing the next training batch in background.",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        help=rst(
+            "Path to save a JSON summary of the wall/CPU time of each phase of the training iterations "
+            "(data sampling, forward pass components, backward, optimizer step) and the peak memory, "
+            "aggregated over windows of `--profile-window <#profile-window>`__ iterations. "
+            "Profiling synchronizes the device after each phase and is disabled if not set."
+        ),
+    )
+    parser.add_argument(
+        "--profile-window",
+        type=int,
+        default=100,
+        help="Number of iterations in each window of the profile summary.",
+    )
+    parser.add_argument(
+        "--profile-trace",
+        type=str,
+        help=rst(
+            "Path to save a Chrome trace (torch.profiler) of `--profile-trace-iters <#profile-trace-iters>`__ training iterations "
+            "(requires `--profile <#profile>`__)."
+        ),
+    )
+    parser.add_argument(
+        "--profile-trace-iters",
+        type=int,
+        default=10,
+        help="Number of iterations recorded in the Chrome trace (after one warm-up iteration).",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        help="Path to save training checkpoints (written atomically), which can be used with `--resume <#resume>`__.",
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        type=int,
+        default=500,
+        help="Save a checkpoint every N iterations (0 to disable).",
+    )
+    parser.add_argument(
+        "--checkpoint-interval-seconds",
+        type=float,
+        default=0,
+        help="Save a checkpoint every N seconds of training (0 to disable).",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help=rst(
+            "Resume training from `--checkpoint <#checkpoint>`__ if it exists. "
+            "The model, optimizer, scheduler, grad scaler, loss averages, data sampler and RNG states are restored. "
+            "Note that the resumed training is not guaranteed to be bit-for-bit identical to an uninterrupted run, "
+            "since some GPU kernels (e.g., atomic adds in tiny-cuda-nn) are non-deterministic."
+        ),
+    )
     parser.add_argument(
         "--single-precision",
         action="store_true",
@@ -458,11 +600,50 @@ def build_parser_outputs_sampling(
             parser.add_argument(
                 "--inference-batch-size", type=int, help="batch size for inference"
             )
+            parser.add_argument(
+                "--inference-memory-budget",
+                type=float,
+                help=(
+                    "Peak memory (in GB) for sampling the output volume. "
+                    "If provided, the volume is sampled slab by slab and written directly to <output-volume> "
+                    "(voxels outside the mask are set to 0), and <inference-batch-size> is ignored."
+                ),
+            )
             parser.add_argument(
                 "--n-inference-samples",
                 type=int,
                 help="number of sample for PSF during inference",
             )
+            parser.add_argument(
+                "--psf-sampling",
+                type=str,
+                default="random",
+                choices=["random", "sobol", "gauss-hermite"],
+                help=rst(
+                    "Method for integrating the PSF during inference. \n\n"
+                    "#. ``random``: random Gaussian samples; \n"
+                    "#. ``sobol``: deterministic quasi-Monte-Carlo samples from a Sobol sequence; \n"
+                    "#. ``gauss-hermite``: deterministic Gauss-Hermite quadrature with k^3 nodes, where k^3 is close to <n-inference-samples>. "
+                    "It is only accurate for very few samples and requires <n-inference-samples> <= 8, otherwise ``sobol`` is used. \n\n"
+                    "The deterministic methods usually need several times fewer <n-inference-samples> than ``random``. \n"
+                ),
+            )
+            parser.add_argument(
+                "--occupancy-block-size",
+                type=int,
+                default=0,
+                help=(
+                    "If > 1, the INR is first evaluated on blocks of (occupancy-block-size)^3 voxels, "
+                    "and only the occupied blocks (and their neighbors) are sampled at the output resolution. "
+                    "Voxels in empty blocks are set to 0."
+                ),
+            )
+            parser.add_argument(
+                "--occupancy-threshold",
+                type=float,
+                default=0.01,
+                help="A block is empty if its density < occupancy-threshold * (mean density of all blocks).",
+            )
             parser.add_argument(
                 "--output-psf-factor",
                 type=float,
@@ -518,6 +699,17 @@ def build_parser_svort() -> argparse.ArgumentParser:
             "Default: register the data to the atlas space when svort or svort-stack are used."
         ),
     )
+    parser.add_argument(
+        "--registration-optimizer",
+        default="gd",
+        type=str,
+        choices=["gd", "lbfgs"],
+        help=(
+            "Optimizer of stack-to-stack and slice-to-volume registration, "
+            "``gd``: normalized gradient descent with momentum; "
+            "``lbfgs``: L-BFGS with backtracking line search."
+        ),
+    )
     return _parser
 
 
@@ -771,6 +963,29 @@ def build_parser_svr() -> argparse.ArgumentParser:
             "If a single number N is provided, will use [N, N, ..., N*3]. "
         ),
     )
+    parser.add_argument(
+        "--srr-solver",
+        type=str,
+        default="gd",
+        choices=["gd", "cg"],
+        help=rst(
+            "Solver of super-resolution reconstruction in each inner iteration. \n\n"
+            "#. ``gd``: one step of gradient descent; \n"
+            "#. ``cg``: Jacobi-preconditioned conjugate gradient warm-started from the current volume. \n"
+        ),
+    )
+    parser.add_argument(
+        "--srr-cg-iter",
+        type=int,
+        default=3,
+        help="Maximum number of CG iterations in each inner iteration (srr-solver = cg).",
+    )
+    parser.add_argument(
+        "--srr-cg-tol",
+        type=float,
+        default=0.1,
+        help="CG stops once the residual is reduced by this factor (srr-solver = cg).",
+    )
     parser.add_argument(
         "--psf",
         type=str,
@@ -778,6 +993,23 @@ def build_parser_svr() -> argparse.ArgumentParser:
         choices=["gaussian", "sinc"],
         help="Type of point spread function (PSF) used in data acquisition.",
     )
+    parser.add_argument(
+        "--n-proc-svr",
+        type=int,
+        default=1,
+        help=(
+            "Number of processes for slice-to-volume registration in CPU mode. "
+            "Slices are split into shards that are registered in parallel."
+        ),
+    )
+    parser.add_argument(
+        "--svr-auto-grad",
+        action="store_true",
+        help=(
+            "Compute the gradient of slice-to-volume registration with autograd "
+            "instead of central finite differences."
+        ),
+    )
     # regularization
     parser = _parser.add_argument_group("regularization")
     parser.add_argument(
@@ -790,6 +1022,26 @@ def build_parser_svr() -> argparse.ArgumentParser:
     return _parser
 
 
+def build_parser_batch() -> argparse.ArgumentParser:
+    """arguments related to batch processing"""
+    _parser = argparse.ArgumentParser(add_help=False)
+    parser = _parser.add_argument_group("batch")
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        required=True,
+        help=(
+            "Path to the manifest of subjects (.csv or .json). "
+            "Each subject (a row of the CSV file or an object in the JSON list) "
+            "provides arguments of the reconstruct command (e.g., input-stacks, output-volume, output-log), "
+            "which override the arguments of this command. "
+            "An optional 'name' field identifies the subject in the logs. "
+            "In CSV files, multiple values (e.g., input-stacks) are separated by spaces."
+        ),
+    )
+    return _parser
+
+
 def build_parser_common() -> argparse.ArgumentParser:
     """miscellaneous arguments"""
     _parser = argparse.ArgumentParser(add_help=False)
@@ -882,6 +1134,42 @@ def build_command_reconstruct(
     return parser_reconstruct
 
 
+def build_command_reconstruct_batch(
+    subparsers: argparse._SubParsersAction,
+) -> argparse.ArgumentParser:
+    # reconstruct-batch
+    parser_reconstruct_batch = add_subcommand(
+        subparsers,
+        name="reconstruct-batch",
+        help="run the reconstruct command on multiple subjects",
+        description=(
+            "Run the reconstruct command on a list of subjects in a single process. "
+            "The networks used in preprocessing (segmentation, assessment, and SVoRT) "
+            "are loaded once and shared by all subjects. "
+            "A subject that fails is logged and skipped without stopping the batch. "
+        ),
+        parents=[
+            build_parser_batch(),
+            build_parser_inputs(input_stacks=True, input_slices=True),
+            build_parser_stack_masking(),
+            build_parser_outputs(
+                output_volume=True,
+                output_slices=True,
+                simulate_slices=True,
+                output_model=True,
+            ),
+            build_parser_outputs_sampling(output_volume=True, simulate_slices=True),
+            build_parser_segmentation(optional=True),
+            build_parser_bias_field_correction(optional=True),
+            build_parser_assessment(),
+            build_parser_svort(),
+            build_parser_training(),
+            build_parser_common(),
+        ],
+    )
+    return parser_reconstruct_batch
+
+
 def build_command_sample_volume(
     subparsers: argparse._SubParsersAction,
 ) -> argparse.ArgumentParser:
@@ -1097,6 +1385,7 @@ def main_parser(
     # commands
     subparsers = parser.add_subparsers(title=title, metavar=metavar, dest=dest)
     build_command_reconstruct(subparsers)
+    build_command_reconstruct_batch(subparsers)
     build_command_sample_volume(subparsers)
     build_command_sample_slices(subparsers)
     build_command_register(subparsers)
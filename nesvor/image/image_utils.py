@@ -1,5 +1,7 @@
 from typing import Tuple, Union, Optional
 import os
+import gzip
+import shutil
 import nibabel as nib
 import torch
 import numpy as np
@@ -114,6 +116,44 @@ def save_nii_volume(
     nib.save(img, os.fspath(path))
 
 
+def create_nii_volume_memmap(
+    path: PathType,
+    shape: Tuple[int, int, int],
+    affine: np.ndarray,
+) -> np.memmap:
+    """
+    create a float32 nii file (uncompressed) filled with zeros and return a
+    writable memmap of its data with the same layout as Volume.image (D x H x W)
+    """
+    d, h, w = shape
+    header = nib.nifti1.Nifti1Header()
+    header.set_data_shape((w, h, d))
+    header.set_data_dtype(np.float32)
+    header.set_xyzt_units(2)
+    header.set_qform(affine, code="aligned")
+    header.set_sform(affine, code="scanner")
+    offset = 352
+    header.set_data_offset(offset)
+    with open(os.fspath(path), "wb") as f:
+        header.write_to(f)
+        f.write(b"\x00" * (offset - f.tell()))
+        f.truncate(offset + d * h * w * 4)
+    # the nii data is stored in Fortran order (x fastest), i.e., C order of (z, y, x)
+    return np.memmap(
+        os.fspath(path),
+        dtype=header.get_data_dtype(),
+        mode="r+",
+        offset=offset,
+        shape=(d, h, w),
+    )
+
+
+def compress_nii(path_src: PathType, path_dst: PathType) -> None:
+    with open(os.fspath(path_src), "rb") as f_src:
+        with gzip.open(os.fspath(path_dst), "wb") as f_dst:
+            shutil.copyfileobj(f_src, f_dst, 64 * 1024 * 1024)
+
+
 def load_nii_volume(path: PathType) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
     img = nib.load(os.fspath(path))
 
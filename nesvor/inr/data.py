@@ -1,4 +1,5 @@
-from typing import Dict, List
+from typing import Dict, List, Optional, Union, Any, Tuple
+from concurrent.futures import ThreadPoolExecutor, Future
 import torch
 from ..utils import gaussian_blur
 from ..transform import RigidTransform, transform_points
@@ -6,7 +7,20 @@ from ..image import Volume, Slice
 
 
 class PointDataset(object):
-    def __init__(self, slices: List[Slice]) -> None:
+    def __init__(
+        self,
+        slices: List[Slice],
+        replacement: bool = False,
+        prefetch: bool = False,
+        rank: int = 0,
+        world_size: int = 1,
+        importance: bool = False,
+        importance_uniform: float = 0.5,
+    ) -> None:
+        if not 0 < importance_uniform <= 1:
+            raise ValueError(
+                "importance_uniform should be in (0, 1], got %g" % importance_uniform
+            )
         self.mask_threshold = 1  # args.mask_threshold
 
         xyz_all = []
@@ -30,8 +44,29 @@ class PointDataset(object):
         self.slice_idx = torch.cat(slice_idx_all)
         self.transformation = RigidTransform.cat(transformation_all)
         self.resolution = torch.stack(resolution_all, 0)
-        self.count = self.v.shape[0]
+        self.count = 0
         self.epoch = 0
+        # sampling through a permutation index instead of reordering the data
+        self.perm: Optional[torch.Tensor] = None
+        self.generator: Optional[torch.Generator] = None
+        self.replacement = replacement
+        # in distributed training, batches are sampled from the points
+        # rank, rank + world_size, rank + 2 * world_size, ...
+        self.rank = rank
+        self.world_size = world_size
+        # importance sampling with the running error of each point
+        self.importance = importance
+        self.importance_uniform = importance_uniform
+        self.error: Optional[torch.Tensor] = None
+        self.visited: Optional[torch.Tensor] = None
+        # error updates are applied before sampling the next batch so that
+        # they do not race with the prefetch thread/stream
+        self._pending_error: List[Tuple[torch.Tensor, torch.Tensor]] = []
+        # prefetch the next batch in background
+        self.prefetch = prefetch
+        self._next: Union[None, Future, Dict[str, torch.Tensor]] = None
+        self._stream: Optional[torch.cuda.Stream] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
 
     @property
     def bounding_box(self) -> torch.Tensor:
@@ -51,22 +86,199 @@ class PointDataset(object):
         return self.v[torch.logical_and(self.v > q1, self.v < q2)].mean().item()
 
     def get_batch(self, batch_size: int, device) -> Dict[str, torch.Tensor]:
-        if self.count + batch_size > self.xyz.shape[0]:  # new epoch, shuffle data
-            self.count = 0
-            self.epoch += 1
-            idx = torch.randperm(self.xyz.shape[0], device=device)
-            self.xyz = self.xyz[idx]
-            self.v = self.v[idx]
-            self.slice_idx = self.slice_idx[idx]
-        # fetch a batch of data
+        if not self.prefetch:
+            return self._get_batch(batch_size, device, self._take_pending_error())
+        if self._next is None:
+            self._prefetch(batch_size, device)
+        batch = self._wait_prefetch()
+        self._prefetch(batch_size, device)  # prepare the next batch
+        return batch
+
+    def _get_batch(
+        self,
+        batch_size: int,
+        device,
+        pending_error: Optional[List[Tuple[torch.Tensor, torch.Tensor]]] = None,
+    ) -> Dict[str, torch.Tensor]:
+        if pending_error:
+            self._apply_error(pending_error)
+        n = (self.xyz.shape[0] - self.rank + self.world_size - 1) // self.world_size
+        if self.generator is None or self.generator.device != self.xyz.device:
+            self.generator = torch.Generator(device=self.xyz.device)
+            self.generator.manual_seed(int(torch.randint(2**62, (1,))))
+        weight = None
+        if self.importance:
+            idx, weight = self._importance_idx(n, batch_size)
+            self.count += batch_size
+            if self.count >= n:
+                self.count -= n
+                self.epoch += 1
+        elif self.replacement:
+            idx = torch.randint(
+                n,
+                (batch_size,),
+                generator=self.generator,
+                device=self.xyz.device,
+            )
+            self.count += batch_size
+            if self.count >= n:
+                self.count -= n
+                self.epoch += 1
+        else:
+            if self.perm is None or self.count + batch_size > n:  # new epoch
+                self.count = 0
+                self.epoch += 1
+                self.perm = torch.randperm(
+                    n, generator=self.generator, device=self.xyz.device
+                )
+            idx = self.perm[self.count : self.count + batch_size]
+            self.count += batch_size
+        local_idx = idx
+        if self.world_size > 1:
+            idx = idx * self.world_size + self.rank
+        # fetch a batch of data through the permutation
         batch = {
-            "xyz": self.xyz[self.count : self.count + batch_size],
-            "v": self.v[self.count : self.count + batch_size],
-            "slice_idx": self.slice_idx[self.count : self.count + batch_size],
+            "xyz": self.xyz[idx],
+            "v": self.v[idx],
+            "slice_idx": self.slice_idx[idx],
         }
-        self.count += batch_size
+        if weight is not None:
+            batch["weight"] = weight
+            batch["idx"] = local_idx
+        if self.xyz.device != torch.device(device):
+            pin = self.xyz.device.type == "cpu" and torch.device(device).type == "cuda"
+            for k in batch:
+                if pin:
+                    batch[k] = batch[k].pin_memory()
+                batch[k] = batch[k].to(device, non_blocking=pin)
         return batch
 
+    def _importance_idx(
+        self, n: int, batch_size: int
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        if self.error is None:
+            self.error = torch.ones(n, dtype=torch.float32, device=self.xyz.device)
+            self.visited = torch.zeros(n, dtype=torch.bool, device=self.xyz.device)
+        assert self.visited is not None
+        # points that are not visited yet use the mean error of the visited ones
+        # (computed without reading the number of visited points on the host)
+        n_visited = self.visited.sum()
+        mean_error = (self.error * self.visited).sum() / n_visited.clamp_min(1)
+        error = torch.where(self.visited, self.error, mean_error)
+        # mix with the uniform distribution to bound the weights
+        p = error / error.sum().clamp_min(1e-12)
+        p = self.importance_uniform / n + (1 - self.importance_uniform) * p
+        # inverse transform sampling (torch.multinomial supports < 2^24 categories),
+        # in float64 since p of a point is far below the float32 resolution
+        # of the CDF with millions of points
+        cdf = p.double().cumsum(0)
+        u = torch.rand(
+            batch_size,
+            generator=self.generator,
+            device=self.xyz.device,
+            dtype=torch.float64,
+        )
+        u *= cdf[-1]
+        idx = torch.searchsorted(cdf, u).clamp_max_(n - 1)
+        # importance weights so that the weighted loss is unbiased, with the
+        # probabilities actually used for sampling (the steps of the CDF)
+        p_idx = cdf[idx] - torch.where(idx > 0, cdf[idx - 1], cdf.new_zeros(()))
+        weight = (cdf[-1] / (n * p_idx)).float()
+        return idx, weight
+
+    def update_error(self, idx: torch.Tensor, error: torch.Tensor) -> None:
+        """update the running error of the sampled points (importance sampling)"""
+        if not self.importance:
+            return
+        # applied when the next batch is sampled, see _get_batch
+        self._pending_error.append((idx.detach(), error.detach()))
+
+    def _take_pending_error(self) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+        pending_error, self._pending_error = self._pending_error, []
+        return pending_error
+
+    def _apply_error(
+        self, pending_error: List[Tuple[torch.Tensor, torch.Tensor]]
+    ) -> None:
+        if self.error is None or self.visited is None:
+            return
+        for idx, error in pending_error:
+            idx = idx.to(self.error.device)
+            self.error[idx] = error.to(self.error)
+            self.visited[idx] = True
+
+    def _prefetch(self, batch_size: int, device) -> None:
+        if self.xyz.device.type == "cuda":
+            # prepare the next batch on a side stream
+            if self._stream is None:
+                self._stream = torch.cuda.Stream(self.xyz.device)
+            self._stream.wait_stream(torch.cuda.current_stream(self.xyz.device))
+            pending_error = self._take_pending_error()
+            for tensors in pending_error:
+                for t in tensors:
+                    if t.device.type == "cuda":
+                        t.record_stream(self._stream)
+            with torch.cuda.stream(self._stream):
+                self._next = self._get_batch(batch_size, device, pending_error)
+        else:
+            # prepare the next batch in a worker thread
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1)
+            self._next = self._executor.submit(
+                self._get_batch, batch_size, device, self._take_pending_error()
+            )
+
+    def _wait_prefetch(self) -> Dict[str, torch.Tensor]:
+        if isinstance(self._next, Future):
+            batch = self._next.result()
+        else:
+            batch = self._next
+            if self._stream is not None:
+                current_stream = torch.cuda.current_stream(self.xyz.device)
+                current_stream.wait_stream(self._stream)
+                for v in batch.values():
+                    v.record_stream(current_stream)
+        self._next = None
+        return batch
+
+    def clear_prefetch(self) -> None:
+        """wait for and discard the prefetched batch, e.g., before modifying the data"""
+        if self._next is not None:
+            self._wait_prefetch()
+
+    def state_dict(self) -> Dict[str, Any]:
+        # the prefetched batch (if any) is saved so that the batch sequence is kept
+        next_batch = self._wait_prefetch() if self._next is not None else None
+        self._next = next_batch
+        self._apply_error(self._take_pending_error())
+        return {
+            "count": self.count,
+            "epoch": self.epoch,
+            "perm": self.perm,
+            "generator": None if self.generator is None else self.generator.get_state(),
+            "next_batch": next_batch,
+            "error": self.error,
+            "visited": self.visited,
+        }
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        self.clear_prefetch()
+        self._pending_error = []
+        self.count = state_dict["count"]
+        self.epoch = state_dict["epoch"]
+        self.perm = state_dict["perm"]
+        if self.perm is not None:
+            self.perm = self.perm.to(self.xyz.device)
+        if state_dict["generator"] is not None:
+            self.generator = torch.Generator(device=self.xyz.device)
+            self.generator.set_state(state_dict["generator"])
+        self._next = state_dict["next_batch"]
+        self.error = state_dict.get("error")
+        self.visited = state_dict.get("visited")
+        if self.error is not None and self.visited is not None:
+            self.error = self.error.to(self.xyz.device)
+            self.visited = self.visited.to(self.xyz.device)
+
     @property
     def xyz_transformed(self) -> torch.Tensor:
         return transform_points(self.transformation[self.slice_idx], self.xyz)
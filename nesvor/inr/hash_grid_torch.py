@@ -1,6 +1,6 @@
-from typing import Tuple
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 
 """adapted from https://github.com/yashbhalgat/HashNeRF-pytorch/blob/main/hash_encoding.py"""
@@ -17,6 +17,7 @@ class HashEmbedder(nn.Module):
         base_resolution: int = 16,
         per_level_scale: float = 1.39,
         dtype: torch.dtype = torch.float32,
+        sparse_grad: bool = False,
     ) -> None:
         super(HashEmbedder, self).__init__()
         assert n_input_dims == 3 and otype == "HashGrid"
@@ -26,89 +27,148 @@ class HashEmbedder(nn.Module):
         self.log2_hashmap_size = log2_hashmap_size
         self.base_resolution = base_resolution
         self.b = per_level_scale
-
-        self.embeddings = nn.ModuleList(
-            [
-                nn.Embedding(2**self.log2_hashmap_size, self.n_features_per_level)
-                for _ in range(n_levels)
-            ]
+        # return the gradient of the embeddings as a sparse tensor (see LazyAdam)
+        self.sparse_grad = sparse_grad
+        # only the first n_active_levels levels are computed, the features of
+        # the remaining (fine) levels are zeros (coarse-to-fine training)
+        self.n_active_levels = n_levels
+
+        # coarse levels whose grid fits in the table use dense storage with
+        # direct indexing, the remaining (fine) levels use hash tables
+        table_size = 2**self.log2_hashmap_size
+        resolutions = [int(self.base_resolution * self.b**i) for i in range(n_levels)]
+        sides = [r + 2 for r in resolutions]
+        self.n_dense_levels = 0
+        while (
+            self.n_dense_levels < n_levels
+            and sides[self.n_dense_levels] ** 3 <= table_size
+        ):
+            self.n_dense_levels += 1
+        sizes = [
+            sides[i] ** 3 if i < self.n_dense_levels else table_size
+            for i in range(n_levels)
+        ]
+
+        # all levels are packed in a single table
+        self.embeddings = nn.Parameter(
+            torch.empty(sum(sizes), self.n_features_per_level)
         )
         # custom uniform initialization
-        for i in range(n_levels):
-            nn.init.uniform_(self.embeddings[i].weight, a=-0.0001, b=0.0001)
+        nn.init.uniform_(self.embeddings, a=-0.0001, b=0.0001)
 
         self.register_buffer(
             "box_offsets",
             torch.tensor([[[i, j, k] for i in [0, 1] for j in [0, 1] for k in [0, 1]]]),
         )
-
-    def trilinear_interp(
-        self,
-        x: torch.Tensor,
-        voxel_min_vertex: torch.Tensor,
-        voxel_embedds: torch.Tensor,
-    ) -> torch.Tensor:
-        """
-        x: B x 3
-        voxel_min_vertex: B x 3
-        voxel_max_vertex: B x 3
-        voxel_embedds: B x 8 x 2
-        """
-        # source: https://en.wikipedia.org/wiki/Trilinear_interpolation
-        weights = x - voxel_min_vertex
-
-        # step 1
-        # 0->000, 1->001, 2->010, 3->011, 4->100, 5->101, 6->110, 7->111
-        c00 = (
-            voxel_embedds[:, 0] * (1 - weights[:, 0][:, None])
-            + voxel_embedds[:, 4] * weights[:, 0][:, None]
-        )
-        c01 = (
-            voxel_embedds[:, 1] * (1 - weights[:, 0][:, None])
-            + voxel_embedds[:, 5] * weights[:, 0][:, None]
+        self.register_buffer(
+            "resolutions",
+            torch.tensor(resolutions, dtype=torch.float32),
+            persistent=False,
         )
-        c10 = (
-            voxel_embedds[:, 2] * (1 - weights[:, 0][:, None])
-            + voxel_embedds[:, 6] * weights[:, 0][:, None]
+        self.register_buffer(
+            "dense_sides",
+            torch.tensor(sides[: self.n_dense_levels], dtype=torch.int32),
+            persistent=False,
         )
-        c11 = (
-            voxel_embedds[:, 3] * (1 - weights[:, 0][:, None])
-            + voxel_embedds[:, 7] * weights[:, 0][:, None]
+        self.register_buffer(
+            "level_offsets",
+            torch.tensor([0] + sizes[:-1]).cumsum(0),
+            persistent=False,
         )
-
-        # step 2
-        c0 = c00 * (1 - weights[:, 1][:, None]) + c10 * weights[:, 1][:, None]
-        c1 = c01 * (1 - weights[:, 1][:, None]) + c11 * weights[:, 1][:, None]
-
-        # step 3
-        c = c0 * (1 - weights[:, 2][:, None]) + c1 * weights[:, 2][:, None]
-
-        return c
+        self._register_load_state_dict_pre_hook(self._load_hashed_embeddings)
+
+    def _load_hashed_embeddings(self, state_dict, prefix, *args, **kwargs) -> None:
+        # convert the state dict of the fully hashed implementation, either with
+        # per-level embeddings.{i}.weight or a packed (n_levels, T, F) table
+        keys = [prefix + "embeddings.%d.weight" % i for i in range(self.n_levels)]
+        if all(k in state_dict for k in keys):
+            tables = [state_dict.pop(k) for k in keys]
+        elif state_dict.get(prefix + "embeddings", torch.empty(0)).ndim == 3:
+            tables = list(state_dict[prefix + "embeddings"].unbind(0))
+        else:
+            return
+        for i in range(self.n_dense_levels):
+            side = int(self.dense_sides[i])
+            grid = torch.arange(side, dtype=torch.int32, device=tables[i].device)
+            z, y, x = torch.meshgrid(grid, grid, grid, indexing="ij")
+            vertices = torch.stack((x, y, z), -1).view(-1, 3)
+            tables[i] = tables[i][_hash(vertices, self.log2_hashmap_size)]
+        state_dict[prefix + "embeddings"] = torch.cat(tables, 0)
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         # x is 3D point position: B x 3
-        x_embedded_all = []
-        for i in range(self.n_levels):
-            resolution = int(self.base_resolution * self.b**i)
+        # B x L x 3
+        na = self.n_active_levels
+        xyz = x[:, None, :] * self.resolutions[None, :na, None]
+        voxel_min_vertex = torch.floor(xyz)
+        weights = xyz - voxel_min_vertex
+        voxel_min_vertex = voxel_min_vertex.int()
+        # indices of the 8 vertices: B x L x 8
+        nd = min(self.n_dense_levels, na)
+        voxel_indices = torch.cat(
             (
-                voxel_min_vertex,
-                hashed_voxel_indices,
-                xi,
-            ) = self.get_voxel_vertices(x, resolution)
-            voxel_embedds = self.embeddings[i](hashed_voxel_indices)
-            x_embedded = self.trilinear_interp(xi, voxel_min_vertex, voxel_embedds)
-            x_embedded_all.append(x_embedded)
-        return torch.cat(x_embedded_all, dim=-1)
-
-    def get_voxel_vertices(
-        self, xyz: torch.Tensor, resolution: float
-    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
-        xyz = xyz * resolution
-        voxel_min_vertex = torch.floor(xyz).int()
-        voxel_indices = voxel_min_vertex.unsqueeze(1) + self.box_offsets
-        hashed_voxel_indices = _hash(voxel_indices, self.log2_hashmap_size)
-
-        return voxel_min_vertex, hashed_voxel_indices, xyz
+                _dense_box(voxel_min_vertex[:, :nd], self.dense_sides[:nd]),
+                _hash_box(voxel_min_vertex[:, nd:], self.log2_hashmap_size),
+            ),
+            1,
+        )
+        voxel_indices = voxel_indices + self.level_offsets[:na, None]
+        # B x L x 8 x F
+        if self.sparse_grad:
+            voxel_embedds = F.embedding(
+                voxel_indices.view(-1), self.embeddings, sparse=True
+            )
+        else:
+            voxel_embedds = self.embeddings.index_select(0, voxel_indices.view(-1))
+        voxel_embedds = voxel_embedds.view(voxel_indices.shape + (-1,))
+        # trilinear weights of the 8 vertices: B x L x 8
+        weights = torch.stack((1 - weights, weights), -1)
+        weights = (
+            weights[..., 0, :, None, None]
+            * weights[..., 1, None, :, None]
+            * weights[..., 2, None, None, :]
+        ).flatten(-3)
+        x_embedded = torch.einsum("blvf,blv->blf", voxel_embedds, weights)
+        x_embedded = x_embedded.flatten(1)
+        if na < self.n_levels:
+            n_pad = (self.n_levels - na) * self.n_features_per_level
+            x_embedded = F.pad(x_embedded, (0, n_pad))
+        return x_embedded
+
+
+def _dense_box(voxel_min_vertex: torch.Tensor, sides: torch.Tensor) -> torch.Tensor:
+    """
+    indices of the 8 vertices (ordered as box_offsets) in dense grids: B x L x 3 -> B x L x 8
+    vertices outside the grids are clamped to the border
+    """
+    sides = sides[:, None]
+    c = [
+        torch.minimum(torch.stack((v, v + 1), -1).clamp_(min=0), sides - 1)
+        for v in voxel_min_vertex.unbind(-1)
+    ]
+    sides = sides[..., None, None]
+    index = c[0][..., :, None, None] + sides * (
+        c[1][..., None, :, None] + sides * c[2][..., None, None, :]
+    )
+    return index.flatten(-3).long()
+
+
+def _hash_box(voxel_min_vertex: torch.Tensor, log2_hashmap_size: int) -> torch.Tensor:
+    """
+    hash of the 8 vertices (ordered as box_offsets) of the voxels: ... x 3 -> ... x 8
+    equivalent to _hash(voxel_min_vertex[..., None, :] + box_offsets, log2_hashmap_size)
+    """
+    primes = [1, 2654435761, 805459861]
+    h = [
+        torch.stack((c, c + 1), -1) * p
+        for c, p in zip(voxel_min_vertex.unbind(-1), primes)
+    ]
+    xor_result = h[0][..., :, None, None] ^ h[1][..., None, :, None]
+    xor_result = (xor_result ^ h[2][..., None, None, :]).flatten(-3)
+    return (
+        torch.tensor((1 << log2_hashmap_size) - 1, device=xor_result.device)
+        & xor_result
+    )
 
 
 def _hash(coords: torch.Tensor, log2_hashmap_size: int) -> torch.Tensor:
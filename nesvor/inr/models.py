@@ -1,13 +1,14 @@
 from argparse import Namespace
 from math import log2
 from typing import Optional, Dict, Any, Union, TYPE_CHECKING, Tuple
+import contextlib
 import logging
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
 from .hash_grid_torch import HashEmbedder
 from ..transform import RigidTransform, ax_transform_points, mat_transform_points
-from ..utils import resolution2sigma
+from ..utils import resolution2sigma, TrainProfiler
 
 USE_TORCH = False
 
@@ -27,11 +28,20 @@ B_REG = "biasReg"
 T_REG = "transReg"
 I_REG = "imageReg"
 D_REG = "deformReg"
+PIXEL_ERR = "pixelError"  # per-pixel error for importance sampling
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+def _phase(profiler: Optional[TrainProfiler], name: str):
+    # time a phase of the forward pass if the model is profiled
+    return _NULL_CONTEXT if profiler is None else profiler.phase(name)
 
 
 def build_encoding(**config):
+    sparse_grad = config.pop("sparse_grad", False)
     if USE_TORCH:
-        encoding = HashEmbedder(**config)
+        encoding = HashEmbedder(sparse_grad=sparse_grad, **config)
     else:
         n_input_dims = config.pop("n_input_dims")
         dtype = config.pop("dtype")
@@ -153,7 +163,12 @@ class INR(nn.Module):
             base_resolution=base_resolution,
             per_level_scale=args.level_scale,
             dtype=args.dtype,
+            sparse_grad=getattr(args, "lazy_adam", False),
         )
+        self.n_levels = n_levels
+        self.n_features_per_level = args.n_features_per_level
+        self._n_active_levels = n_levels
+        self.profiler: Optional[TrainProfiler] = None
         # density net
         self.density_net = build_network(
             n_input_dims=n_levels * args.n_features_per_level,
@@ -184,14 +199,34 @@ class INR(nn.Module):
             self.bounding_box[1, 2],
         )
 
+    @property
+    def n_active_levels(self) -> int:
+        return self._n_active_levels
+
+    @n_active_levels.setter
+    def n_active_levels(self, value: int) -> None:
+        # the fine levels of the encoding are disabled in coarse-to-fine training
+        self._n_active_levels = max(1, min(int(value), self.n_levels))
+        if isinstance(self.encoding, HashEmbedder):
+            # the disabled levels are skipped
+            self.encoding.n_active_levels = self._n_active_levels
+
     def forward(self, x: torch.Tensor):
         x = (x - self.bounding_box[0]) / (self.bounding_box[1] - self.bounding_box[0])
         prefix_shape = x.shape[:-1]
         x = x.view(-1, x.shape[-1])
-        pe = self.encoding(x)
+        with _phase(self.profiler, "encoding"):
+            pe = self.encoding(x)
+        if self._n_active_levels < self.n_levels and not isinstance(
+            self.encoding, HashEmbedder
+        ):
+            # tinycudann computes all levels, mask the disabled ones
+            n_active = self._n_active_levels * self.n_features_per_level
+            pe = torch.cat((pe[:, :n_active], torch.zeros_like(pe[:, n_active:])), 1)
         if not self.training:
             pe = pe.to(dtype=x.dtype)
-        z = self.density_net(pe)
+        with _phase(self.profiler, "density_net"):
+            z = self.density_net(pe)
         density = F.softplus(z[..., 0].view(prefix_shape))
         if self.training:
             return density, pe, z
@@ -204,8 +239,14 @@ class INR(nn.Module):
         transformation: Optional[RigidTransform],
         psf_sigma: Union[float, torch.Tensor],
         n_samples: int,
+        psf_offsets: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
-        if n_samples > 1:
+        if psf_offsets is not None:
+            # deterministic offsets (N x 3) shared by all points
+            if isinstance(psf_sigma, torch.Tensor):
+                psf_sigma = psf_sigma.view(-1, 1, 3)
+            xyz = xyz[:, None] + psf_offsets.to(xyz.dtype) * psf_sigma
+        elif n_samples > 1:
             if isinstance(psf_sigma, torch.Tensor):
                 psf_sigma = psf_sigma.view(-1, 1, 3)
             xyz_psf = torch.randn(
@@ -304,6 +345,7 @@ class NeSVoR(nn.Module):
             torch.cuda.set_device(args.device)
         self.spatial_scaling = spatial_scaling
         self.args = args
+        self._profiler: Optional[TrainProfiler] = None
         self.n_slices = 0
         self.trans_first = True
         self.transformation = transformation
@@ -312,6 +354,16 @@ class NeSVoR(nn.Module):
         self.build_network(bounding_box)
         self.to(args.device)
 
+    @property
+    def profiler(self) -> Optional[TrainProfiler]:
+        return self._profiler
+
+    @profiler.setter
+    def profiler(self, value: Optional[TrainProfiler]) -> None:
+        # time the phases of the forward pass
+        self._profiler = value
+        self.inr.profiler = value
+
     @property
     def transformation(self) -> RigidTransform:
         return RigidTransform(self.axisangle.detach(), self.trans_first)
@@ -380,26 +432,32 @@ class NeSVoR(nn.Module):
         xyz: torch.Tensor,
         v: torch.Tensor,
         slice_idx: torch.Tensor,
+        weight: Optional[torch.Tensor] = None,
     ) -> Dict[str, Any]:
         # sample psf point
         batch_size = xyz.shape[0]
         n_samples = self.args.n_samples
-        xyz_psf = torch.randn(
-            batch_size, n_samples, 3, dtype=xyz.dtype, device=xyz.device
-        )
-        # psf = 1
-        psf_sigma = self.psf_sigma[slice_idx][:, None]
+        with _phase(self._profiler, "psf"):
+            xyz_psf = torch.randn(
+                batch_size, n_samples, 3, dtype=xyz.dtype, device=xyz.device
+            )
+            # psf = 1
+            psf_sigma = self.psf_sigma[slice_idx][:, None]
         # transform points
-        t = self.axisangle[slice_idx][:, None]
-        xyz = ax_transform_points(
-            t, xyz[:, None] + xyz_psf * psf_sigma, self.trans_first
-        )
+        with _phase(self._profiler, "transform"):
+            t = self.axisangle[slice_idx][:, None]
+            xyz = ax_transform_points(
+                t, xyz[:, None] + xyz_psf * psf_sigma, self.trans_first
+            )
 
         # deform
         xyz_ori = xyz
         if self.args.deformable:
-            de = self.deform_embedding(slice_idx)[:, None].expand(-1, n_samples, -1)
-            xyz = self.deform_net(xyz, de)
+            with _phase(self._profiler, "deform"):
+                de = self.deform_embedding(slice_idx)[:, None].expand(
+                    -1, n_samples, -1
+                )
+                xyz = self.deform_net(xyz, de)
 
         # inputs
         if self.args.n_features_slice:
@@ -439,20 +497,36 @@ class NeSVoR(nn.Module):
         if not self.args.no_slice_variance:
             var = var + self.log_var_slice.exp()[slice_idx]
         # losses
-        losses = {D_LOSS: ((v_out - v) ** 2 / (2 * var)).mean()}
+        d_loss = (v_out - v) ** 2 / (2 * var)
+        s_loss = None
         if not (self.args.no_pixel_variance and self.args.no_slice_variance):
-            losses[S_LOSS] = 0.5 * var.log().mean()
+            s_loss = 0.5 * var.log()
+        if weight is not None:
+            # importance sampling: reweight the data terms to keep them unbiased
+            # and return the per-pixel error (~ |residual| / sigma)
+            d_error = d_loss.detach().sqrt()
+            d_loss = d_loss * weight
+            if s_loss is not None:
+                s_loss = s_loss * weight
+        losses = {D_LOSS: d_loss.mean()}
+        if s_loss is not None:
+            losses[S_LOSS] = s_loss.mean()
             losses[DS_LOSS] = losses[D_LOSS] + losses[S_LOSS]
         if not self.args.no_transformation_optimization:
-            losses[T_REG] = self.trans_loss(trans_first=self.trans_first)
+            with _phase(self._profiler, "trans_reg"):
+                losses[T_REG] = self.trans_loss(trans_first=self.trans_first)
         if self.args.n_levels_bias:
             losses[B_REG] = log_bias.mean() ** 2
         if self.args.deformable:
-            losses[D_REG] = self.deform_reg(
-                xyz, xyz_ori, de
-            )  # deform_reg_autodiff(self.deform_net, xyz_ori, de)
+            with _phase(self._profiler, "deform_reg"):
+                losses[D_REG] = self.deform_reg(
+                    xyz, xyz_ori, de
+                )  # deform_reg_autodiff(self.deform_net, xyz_ori, de)
         # image regularization
-        losses[I_REG] = self.img_reg(density, xyz)
+        with _phase(self._profiler, "image_reg"):
+            losses[I_REG] = self.img_reg(density, xyz)
+        if weight is not None:
+            losses[PIXEL_ERR] = d_error
 
         return losses
 
@@ -461,7 +535,8 @@ class NeSVoR(nn.Module):
         x: torch.Tensor,
         se: Optional[torch.Tensor] = None,
     ) -> Dict[str, Any]:
-        density, pe, z = self.inr(x)
+        with _phase(self._profiler, "inr"):
+            density, pe, z = self.inr(x)
         prefix_shape = density.shape
         results = {"density": density}
 
@@ -473,13 +548,17 @@ class NeSVoR(nn.Module):
             pe_bias = pe[
                 ..., : self.args.n_levels_bias * self.args.n_features_per_level
             ]
-            results["log_bias"] = self.b_net(torch.cat(zs + [pe_bias], -1)).view(
-                prefix_shape
-            )
+            with _phase(self._profiler, "b_net"):
+                results["log_bias"] = self.b_net(
+                    torch.cat(zs + [pe_bias], -1)
+                ).view(prefix_shape)
 
         if not self.args.no_pixel_variance:
             zs.append(z[..., 1:])
-            results["log_var"] = self.sigma_net(torch.cat(zs, -1)).view(prefix_shape)
+            with _phase(self._profiler, "sigma_net"):
+                results["log_var"] = self.sigma_net(torch.cat(zs, -1)).view(
+                    prefix_shape
+                )
 
         return results
 
@@ -0,0 +1,113 @@
+from typing import Iterable, Tuple, Union, Dict, Any, Optional, Callable
+import torch
+
+
+class LazyAdam(torch.optim.Optimizer):
+    """
+    AdamW with lazy (row-wise sparse) updates for the parameter groups with
+    lazy=True, e.g., hash grid tables where a batch only touches a few rows.
+    The moments and parameters of a lazy group are updated only for the rows
+    with non-zero (or sparse) gradient. The decay of the moments and the weight
+    decay missed by a row since its last update are applied when the row is
+    touched again, so a row updated at every step follows AdamW exactly.
+    """
+
+    def __init__(
+        self,
+        params: Union[Iterable[torch.Tensor], Iterable[Dict[str, Any]]],
+        lr: float = 1e-3,
+        betas: Tuple[float, float] = (0.9, 0.999),
+        eps: float = 1e-8,
+        weight_decay: float = 1e-2,
+        lazy: bool = False,
+    ) -> None:
+        defaults = dict(
+            lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, lazy=lazy
+        )
+        super().__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, closure: Optional[Callable] = None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            for p in group["params"]:
+                if p.grad is None:
+                    continue
+                state = self.state[p]
+                if len(state) == 0:
+                    state["step"] = 0
+                    state["exp_avg"] = torch.zeros_like(p)
+                    state["exp_avg_sq"] = torch.zeros_like(p)
+                    if group["lazy"]:
+                        # the last step at which each row was updated
+                        state["last_step"] = torch.zeros(
+                            _n_rows(p), dtype=torch.int64, device=p.device
+                        )
+                state["step"] += 1
+                if group["lazy"]:
+                    _lazy_update(p, p.grad, state, group)
+                elif p.grad.is_sparse:
+                    raise RuntimeError("sparse gradients require lazy=True")
+                else:
+                    _dense_update(p, p.grad, state, group)
+        return loss
+
+
+def _n_rows(p: torch.Tensor) -> int:
+    return p.shape[0] if p.ndim > 1 else p.numel()
+
+
+def _dense_update(
+    p: torch.Tensor, grad: torch.Tensor, state: Dict[str, Any], group: Dict[str, Any]
+) -> None:
+    beta1, beta2 = group["betas"]
+    t = state["step"]
+    exp_avg, exp_avg_sq = state["exp_avg"], state["exp_avg_sq"]
+    if group["weight_decay"]:
+        p.mul_(1 - group["lr"] * group["weight_decay"])
+    exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+    exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+    denom = (exp_avg_sq.sqrt() / (1 - beta2**t) ** 0.5).add_(group["eps"])
+    p.addcdiv_(exp_avg, denom, value=-group["lr"] / (1 - beta1**t))
+
+
+def _lazy_update(
+    p: torch.Tensor, grad: torch.Tensor, state: Dict[str, Any], group: Dict[str, Any]
+) -> None:
+    beta1, beta2 = group["betas"]
+    t = state["step"]
+    n = _n_rows(p)
+    # rows with gradient: k, grad of the rows: k x F
+    if grad.is_sparse:
+        # sum the duplicate entries, faster than coalesce
+        rows, inverse = torch.unique(grad._indices()[0], return_inverse=True)
+        g = grad._values().view(inverse.numel(), -1)
+        g = g.new_zeros(rows.numel(), g.shape[1]).index_add_(0, inverse, g)
+    else:
+        g = grad.view(n, -1)
+        rows = g.ne(0).any(1).nonzero().squeeze(1)
+        g = g.index_select(0, rows)
+    if rows.numel() == 0:
+        return
+    # number of steps since the last update of each row
+    last_step = state["last_step"]
+    k = (t - last_step.index_select(0, rows)).to(p.dtype)[:, None]
+    last_step.index_fill_(0, rows, t)
+    p_rows = p.view(n, -1)
+    exp_avg = state["exp_avg"].view(n, -1)
+    exp_avg_sq = state["exp_avg_sq"].view(n, -1)
+    m = exp_avg.index_select(0, rows).mul_(torch.pow(beta1, k))
+    m.add_(g, alpha=1 - beta1)
+    v = exp_avg_sq.index_select(0, rows).mul_(torch.pow(beta2, k))
+    v.addcmul_(g, g, value=1 - beta2)
+    exp_avg.index_copy_(0, rows, m)
+    exp_avg_sq.index_copy_(0, rows, v)
+    x = p_rows.index_select(0, rows)
+    if group["weight_decay"]:
+        x.mul_(torch.pow(1 - group["lr"] * group["weight_decay"], k))
+    denom = (v.sqrt_() / (1 - beta2**t) ** 0.5).add_(group["eps"])
+    x.addcdiv_(m, denom, value=-group["lr"] / (1 - beta1**t))
+    p_rows.index_copy_(0, rows, x)
@@ -1,10 +1,24 @@
-from typing import List, Union, Optional
+from typing import List, Union, Optional, Tuple
 import os
+import logging
 import torch
+import torch.nn.functional as F
 from ..transform import transform_points, RigidTransform
 from ..image import Slice, Volume, load_volume, load_mask
+from ..image.image_utils import (
+    transformation2affine,
+    create_nii_volume_memmap,
+    compress_nii,
+)
 from .models import INR
-from ..utils import resolution2sigma, meshgrid, PathType
+from ..utils import (
+    resolution2sigma,
+    psf_quadrature,
+    GAUSS_HERMITE_MAX_SAMPLES,
+    meshgrid,
+    PathType,
+    DeviceType,
+)
 
 
 def override_sample_mask(
@@ -42,28 +56,224 @@ def sample_volume(
     psf_resolution: float,
     batch_size: int = 1024,
     n_samples: int = 128,
+    psf_sampling: str = "random",
+    occupancy_block_size: int = 0,
+    occupancy_threshold: float = 0.01,
 ) -> Volume:
     model.eval()
     img = mask.clone()
-    img.image[img.mask] = sample_points(
+    m = img.mask
+    if occupancy_block_size > 1:
+        m = m & occupancy_mask(
+            model,
+            mask,
+            psf_resolution,
+            occupancy_block_size,
+            occupancy_threshold,
+            batch_size,
+            n_samples,
+            psf_sampling,
+        )
+        img.image[img.mask] = 0
+    img.image[m] = sample_points(
         model,
-        img.xyz_masked,
+        _xyz_masked(img, m),
         psf_resolution,
         batch_size,
         n_samples,
+        psf_sampling,
     )
     return img
 
 
+def occupancy_mask(
+    model: INR,
+    mask: Volume,
+    psf_resolution: float,
+    block_size: int,
+    threshold: float,
+    batch_size: int = 1024,
+    n_samples: int = 128,
+    psf_sampling: str = "random",
+) -> torch.Tensor:
+    """
+    evaluate the INR at the centers of (block_size)^3 blocks of the mask with a
+    PSF covering a block, and mark the blocks (and their neighbors, to account
+    for the PSF footprint) whose density >= threshold * (mean density of blocks)
+    """
+    d, h, w = mask.image.shape
+    block_mask = (
+        F.max_pool3d(
+            mask.mask[None, None].float(), block_size, block_size, ceil_mode=True
+        )[0, 0]
+        > 0
+    )
+    # block centers in the voxel index space
+    kji = torch.flip(torch.nonzero(block_mask), (-1,)) * block_size + (
+        block_size - 1
+    ) / 2
+    xyz = transform_points(
+        mask.transformation,
+        (kji - (mask.shape_xyz - 1) / 2) * mask.resolution_xyz,
+    )
+    v = sample_points(
+        model,
+        xyz,
+        max(psf_resolution, block_size * float(mask.resolution_xyz.min())),
+        batch_size,
+        n_samples,
+        psf_sampling,
+    )
+    density = torch.zeros_like(block_mask, dtype=torch.float32)
+    density[block_mask] = v
+    occupied = density >= threshold * v.mean()
+    occupied = F.max_pool3d(occupied[None, None].float(), 3, 1, 1)[0, 0] > 0
+    logging.debug(
+        "occupancy: %d / %d blocks occupied",
+        int((occupied & block_mask).sum()),
+        int(block_mask.sum()),
+    )
+    for dim in range(3):
+        occupied = occupied.repeat_interleave(block_size, dim)
+    return occupied[:d, :h, :w]
+
+
+def _xyz_masked(volume: Volume, mask: torch.Tensor) -> torch.Tensor:
+    kji = torch.flip(torch.nonzero(mask), (-1,))
+    return transform_points(
+        volume.transformation,
+        (kji - (volume.shape_xyz - 1) / 2) * volume.resolution_xyz,
+    )
+
+
+def sample_volume_streaming(
+    model: INR,
+    mask: Volume,
+    psf_resolution: float,
+    path: PathType,
+    memory_budget: float,
+    n_samples: int = 128,
+    intensity_mean: Optional[float] = None,
+    psf_sampling: str = "random",
+    occupancy_block_size: int = 0,
+    occupancy_threshold: float = 0.01,
+) -> None:
+    """
+    sample the INR on the mask slab by slab (along z) and write the results
+    directly to a nii file, so that the peak memory (in bytes) stays around
+    memory_budget regardless of the size of the output volume.
+    Voxels outside the mask are set to 0.
+    """
+    model.eval()
+    n_samples = 0 if psf_resolution <= 0 else n_samples
+    # memory for the coordinates and the outputs of a slab
+    # (nonzero indices, xyz, values) ~ 40 bytes per masked voxel
+    d, h, w = mask.image.shape
+    slab_size = max(1, int(memory_budget / 2 // (40 * h * w)))
+    # memory for a batch of PSF samples during inference
+    batch_size = max(
+        1, int(memory_budget / 2 // (max(1, n_samples) * _bytes_per_point(model)))
+    )
+    logging.debug(
+        "streaming sampling: slab size = %d, batch size = %d", slab_size, batch_size
+    )
+
+    path = os.fspath(path)
+    compressed = path.endswith(".gz")
+    path_nii = path[:-3] + ".tmp" if compressed else path
+    affine = transformation2affine(
+        mask.image,
+        mask.transformation,
+        float(mask.resolution_x),
+        float(mask.resolution_y),
+        float(mask.resolution_z),
+    )
+    output = create_nii_volume_memmap(path_nii, (d, h, w), affine)
+
+    occupied = None
+    if occupancy_block_size > 1:
+        occupied = occupancy_mask(
+            model,
+            mask,
+            psf_resolution,
+            occupancy_block_size,
+            occupancy_threshold,
+            batch_size,
+            n_samples,
+            psf_sampling,
+        )
+
+    shape_xyz = mask.shape_xyz
+    resolution_xyz = mask.resolution_xyz
+    v_sum = 0.0
+    v_count = 0
+    for i in range(0, d, slab_size):
+        m = mask.mask[i : i + slab_size]
+        v_count += int(m.sum())
+        if occupied is not None:
+            m = m & occupied[i : i + slab_size]
+        kji = torch.flip(torch.nonzero(m), (-1,))
+        if kji.shape[0] == 0:
+            continue
+        kji[:, -1] += i
+        xyz = transform_points(
+            mask.transformation, (kji - (shape_xyz - 1) / 2) * resolution_xyz
+        )
+        del kji
+        v = sample_points(
+            model, xyz, psf_resolution, batch_size, n_samples, psf_sampling
+        )
+        del xyz
+        v_sum += v.sum().item()
+        slab = torch.zeros(m.shape, dtype=torch.float32, device=v.device)
+        slab[m] = v
+        output[i : i + slab_size] = slab.cpu().numpy()
+        del v, slab
+
+    # second pass: rescale the output intensity
+    if intensity_mean and v_count > 0:
+        scale_factor = intensity_mean / (v_sum / v_count)
+        for i in range(0, d, slab_size):
+            output[i : i + slab_size] *= scale_factor
+    output.flush()
+    del output
+
+    if compressed:
+        compress_nii(path_nii, path)
+        os.remove(path_nii)
+
+
+def _bytes_per_point(model: INR) -> int:
+    # rough estimate of the memory footprint of a point in the forward pass:
+    # coordinates, hash grid lookup (8 vertices per level with indices, weights
+    # and features), encoding and activations of the density net
+    encoding = model.encoding
+    n_encoding = getattr(encoding, "n_output_dims", None) or (
+        encoding.n_levels * encoding.n_features_per_level
+    )
+    n_hidden = max(
+        (
+            m.out_features
+            for m in model.density_net.modules()
+            if isinstance(m, torch.nn.Linear)
+        ),
+        default=64,
+    )
+    return 4 * (3 + 8 * 4 * n_encoding + n_encoding + 2 * n_hidden)
+
+
 def sample_points(
     model: INR,
     xyz: torch.Tensor,
     resolution: float = 0,
     batch_size: int = 1024,
     n_samples: int = 128,
+    psf_sampling: str = "random",
 ) -> torch.Tensor:
     shape = xyz.shape[:-1]
     xyz = xyz.view(-1, 3)
+    n_samples = 0 if resolution <= 0 else n_samples
+    psf_offsets, psf_weights = _psf_offsets(n_samples, psf_sampling, xyz.device)
     v = torch.empty(xyz.shape[0], dtype=torch.float32, device=xyz.device)
     with torch.no_grad():
         for i in range(0, xyz.shape[0], batch_size):
@@ -72,9 +282,10 @@ def sample_points(
                 xyz_batch,
                 None,
                 resolution2sigma(resolution, isotropic=True),
-                0 if resolution <= 0 else n_samples,
+                n_samples,
+                psf_offsets,
             )
-            v_b = model(xyz_batch).mean(-1)
+            v_b = _psf_mean(model(xyz_batch), psf_weights)
             v[i : i + batch_size] = v_b
     return v.view(shape)
 
@@ -85,20 +296,24 @@ def sample_slice(
     mask: Volume,
     output_psf_factor: float = 1.0,
     n_samples: int = 128,
+    psf_sampling: str = "random",
 ) -> Slice:
     slice_sampled = slice.clone(zero=True)
     xyz = meshgrid(slice_sampled.shape_xyz, slice_sampled.resolution_xyz).view(-1, 3)
     m = mask.sample_points(transform_points(slice_sampled.transformation, xyz)) > 0
     if m.any():
+        n_samples = 0 if output_psf_factor <= 0 else n_samples
+        psf_offsets, psf_weights = _psf_offsets(n_samples, psf_sampling, xyz.device)
         xyz_masked = model.sample_batch(
             xyz[m],
             slice_sampled.transformation,
             resolution2sigma(
                 slice_sampled.resolution_xyz * output_psf_factor, isotropic=False
             ),
-            0 if output_psf_factor <= 0 else n_samples,
+            n_samples,
+            psf_offsets,
         )
-        v = model(xyz_masked).mean(-1)
+        v = _psf_mean(model(xyz_masked), psf_weights)
         slice_sampled.mask = m.view(slice_sampled.mask.shape)
         slice_sampled.image[slice_sampled.mask] = v.to(slice_sampled.image.dtype)
     return slice_sampled
@@ -110,12 +325,38 @@ def sample_slices(
     mask: Volume,
     output_psf_factor: float = 1.0,
     n_samples: int = 128,
+    psf_sampling: str = "random",
 ) -> List[Slice]:
     model.eval()
     with torch.no_grad():
         slices_sampled = []
         for i, slice in enumerate(slices):
             slices_sampled.append(
-                sample_slice(model, slice, mask, output_psf_factor, n_samples)
+                sample_slice(
+                    model, slice, mask, output_psf_factor, n_samples, psf_sampling
+                )
             )
     return slices_sampled
+
+
+def _psf_offsets(
+    n_samples: int, psf_sampling: str, device: DeviceType
+) -> Tuple[Optional[torch.Tensor], Optional[torch.Tensor]]:
+    # None for random sampling
+    if psf_sampling == "random" or n_samples <= 1:
+        return None, None
+    if psf_sampling == "gauss-hermite" and n_samples > GAUSS_HERMITE_MAX_SAMPLES:
+        logging.warning(
+            "Gauss-Hermite PSF quadrature is less accurate than Sobol sampling "
+            "for more than %d samples, use Sobol sampling with %d samples instead.",
+            GAUSS_HERMITE_MAX_SAMPLES,
+            n_samples,
+        )
+        psf_sampling = "sobol"
+    return psf_quadrature(n_samples, psf_sampling, device)
+
+
+def _psf_mean(v: torch.Tensor, psf_weights: Optional[torch.Tensor]) -> torch.Tensor:
+    if psf_weights is None:
+        return v.mean(-1)
+    return (v * psf_weights).sum(-1)
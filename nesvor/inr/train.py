@@ -1,22 +1,74 @@
 from argparse import Namespace
-from typing import List, Tuple
+from typing import List, Tuple, Dict, Any
+import os
 import time
 import datetime
+import random
+import copy
+import tempfile
+import numpy as np
 import torch
 import torch.optim as optim
+import torch.distributed as dist
 import logging
-from ..utils import MovingAverage, log_params, TrainLogger
-from .models import INR, NeSVoR, D_LOSS, S_LOSS, DS_LOSS, I_REG, B_REG, T_REG, D_REG
+from ..utils import (
+    MovingAverage,
+    ConvergenceMonitor,
+    log_params,
+    TrainLogger,
+    PathType,
+    setup_logger,
+    set_seed,
+    TrainProfiler,
+)
+from .models import (
+    INR,
+    NeSVoR,
+    D_LOSS,
+    S_LOSS,
+    DS_LOSS,
+    I_REG,
+    B_REG,
+    T_REG,
+    D_REG,
+    PIXEL_ERR,
+)
 from ..transform import RigidTransform
 from ..image import Volume, Slice
 from .data import PointDataset
+from .optim import LazyAdam
 
 
 def train(slices: List[Slice], args: Namespace) -> Tuple[INR, List[Slice], Volume]:
+    if getattr(args, "n_proc_train", 1) > 1 and not dist.is_initialized():
+        return train_distributed(slices, args)
+    # data-parallel training if a process group is initialized
+    rank, world_size = 0, 1
+    if dist.is_initialized():
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+    # resume from checkpoint
+    checkpoint = None
+    if getattr(args, "resume", False) and os.path.isfile(args.checkpoint):
+        logging.info("resuming training from checkpoint %s", args.checkpoint)
+        checkpoint = torch.load(
+            args.checkpoint, map_location=args.device, weights_only=False
+        )
+        # use the slices of the checkpoint in case the preprocessing is not deterministic
+        slices = checkpoint["slices"]
     # create training dataset
-    dataset = PointDataset(slices)
+    dataset = PointDataset(
+        slices,
+        replacement=getattr(args, "sample_with_replacement", False),
+        prefetch=not getattr(args, "no_prefetch", False),
+        rank=rank,
+        world_size=world_size,
+        importance=getattr(args, "importance_sampling", False),
+        importance_uniform=getattr(args, "importance_uniform", 0.5),
+    )
     if args.n_epochs is not None:
         args.n_iter = args.n_epochs * (dataset.v.numel() // args.batch_size)
+    # args.batch_size is the global batch size of all processes
+    batch_size = args.batch_size // world_size
 
     use_scaling = True
     use_centering = True
@@ -41,6 +93,10 @@ def train(slices: List[Slice], args: Namespace) -> Tuple[INR, List[Slice], Volum
         spatial_scaling,
         args,
     )
+    if world_size > 1:
+        # start from the same model in all processes
+        for v in model.state_dict().values():
+            dist.broadcast(v, 0)
     # setup optimizer
     params_net = []
     params_encoding = []
@@ -52,11 +108,18 @@ def train(slices: List[Slice], args: Namespace) -> Tuple[INR, List[Slice], Volum
                 params_encoding.append(param)
     # logging
     logging.debug(log_params(model))
-    optimizer = torch.optim.AdamW(
-        params=[
-            {"name": "encoding", "params": params_encoding},
-            {"name": "net", "params": params_net, "weight_decay": 1e-2},
-        ],
+    param_groups = [
+        {"name": "encoding", "params": params_encoding},
+        {"name": "net", "params": params_net, "weight_decay": 1e-2},
+    ]
+    if getattr(args, "lazy_adam", False):
+        # only update the rows of the encoding touched by the batch
+        param_groups[0]["lazy"] = True
+        optimizer_cls = LazyAdam
+    else:
+        optimizer_cls = torch.optim.AdamW
+    optimizer = optimizer_cls(
+        params=param_groups,
         lr=args.learning_rate,
         betas=(0.9, 0.99),
         eps=1e-15,
@@ -88,33 +151,107 @@ def train(slices: List[Slice], args: Namespace) -> Tuple[INR, List[Slice], Volum
         D_REG: args.weight_deform,
     }
     average = MovingAverage(1 - 0.001)
+    # convergence monitor for adaptive lr decay and early stopping
+    monitor = None
+    early_stop_window = getattr(args, "early_stop_window", 0)
+    adaptive_milestones = getattr(args, "adaptive_milestones", False)
+    if early_stop_window > 0:
+        monitor = ConvergenceMonitor(early_stop_window, args.early_stop_tol)
     # logging
     logging_header = False
     logging.info("NeSVoR training starts.")
     train_time = 0.0
-    for i in range(1, args.n_iter + 1):
+    start_iter = 1
+    if checkpoint is not None:
+        model.load_state_dict(checkpoint["model"])
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        scheduler.load_state_dict(checkpoint["scheduler"])
+        scaler.load_state_dict(checkpoint["scaler"])
+        average.from_dict(checkpoint["average"])
+        dataset.load_state_dict(_rank_state(checkpoint["dataset"], rank, world_size))
+        set_rng_state(_rank_state(checkpoint["rng"], rank, world_size))
+        decay_milestones = checkpoint["decay_milestones"]
+        if monitor is not None and checkpoint.get("monitor") is not None:
+            monitor.from_dict(checkpoint["monitor"])
+        train_time = checkpoint["train_time"]
+        start_iter = checkpoint["iter"] + 1
+        logging.info("resume training at iteration %d", start_iter)
+        del checkpoint
+    # coarse-to-fine schedule of the hash grid levels
+    progressive_iter = int(getattr(args, "progressive_levels", 0) * args.n_iter)
+    checkpoint_interval = getattr(args, "checkpoint_interval", 0)
+    checkpoint_interval_seconds = getattr(args, "checkpoint_interval_seconds", 0)
+    checkpoint_time = time.time()
+    # opt-in per-phase profiling (in the first process)
+    profile_path = getattr(args, "profile", None)
+    profiler = TrainProfiler(
+        enabled=bool(profile_path) and rank == 0,
+        window=getattr(args, "profile_window", 100),
+        trace_path=getattr(args, "profile_trace", None),
+        trace_iters=getattr(args, "profile_trace_iters", 0),
+        device=args.device,
+        start_iter=start_iter,
+    )
+    if profiler.enabled:
+        model.profiler = profiler
+    for i in range(start_iter, args.n_iter + 1):
         train_step_start = time.time()
+        if progressive_iter > 0:
+            n_active_levels = progressive_n_levels(
+                i, progressive_iter, args.progressive_start_levels, model.inr.n_levels
+            )
+            if n_active_levels != model.inr.n_active_levels:
+                logging.debug("iter %d: %d active levels", i, n_active_levels)
+                model.inr.n_active_levels = n_active_levels
         # forward
-        batch = dataset.get_batch(args.batch_size, args.device)
-        with torch.cuda.amp.autocast(fp16):
+        with profiler.phase("get_batch"):
+            batch = dataset.get_batch(batch_size, args.device)
+        batch_idx = batch.pop("idx", None)
+        with profiler.phase("forward"), torch.cuda.amp.autocast(fp16):
             losses = model(**batch)
+            if batch_idx is not None:
+                dataset.update_error(batch_idx, losses.pop(PIXEL_ERR))
             loss = 0
             for k in losses:
                 if k in loss_weights and loss_weights[k]:
                     loss = loss + loss_weights[k] * losses[k]
         # backward
-        scaler.scale(loss).backward()
+        with profiler.phase("backward"):
+            scaler.scale(loss).backward()
+        if world_size > 1:
+            with profiler.phase("all_reduce"):
+                loss_values = all_reduce_grads(model, losses, world_size)
+        else:
+            with profiler.phase("item"):
+                loss_values = {k: losses[k].item() for k in losses}
         if args.debug:  # check nan grad
             for _name, _p in model.named_parameters():
-                if _p.grad is not None and not _p.grad.isfinite().all():
+                _g = _p.grad
+                if _g is not None and _g.is_sparse:
+                    _g = _g._values()
+                if _g is not None and not _g.isfinite().all():
                     logging.warning("iter %d: Found NaNs in the grad of %s", i, _name)
-        scaler.step(optimizer)
-        scaler.update()
-        optimizer.zero_grad()
+        with profiler.phase("step"):
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad()
+        profiler.step()
         train_time += time.time() - train_step_start
-        for k in losses:
-            average(k, losses[k].item())
-        if (decay_milestones and i >= decay_milestones[0]) or i == args.n_iter:
+        for k in loss_values:
+            average(k, loss_values[k])
+        # lr decay at fixed milestones
+        decay = bool(decay_milestones) and i >= decay_milestones[0]
+        stop = False
+        if monitor is not None and monitor(
+            loss_values[D_LOSS] + loss_values.get(S_LOSS, 0.0)
+        ):
+            if decay_milestones and adaptive_milestones:
+                decay = True  # decay early when the loss plateaus
+            elif not decay_milestones:
+                stop = True  # early stop when the loss plateaus after all decays
+                logging.info("Training converged at iteration %d.", i)
+        last_iter = stop or i == args.n_iter
+        if decay or last_iter:
             # logging
             if not logging_header:
                 train_logger = TrainLogger(
@@ -132,9 +269,11 @@ def train(slices: List[Slice], args: Namespace) -> Tuple[INR, List[Slice], Volum
                 *[average[k] for k in losses],
                 optimizer.param_groups[0]["lr"],
             )
-            if i < args.n_iter:
+            if not last_iter:
                 decay_milestones.pop(0)
                 scheduler.step()
+                if monitor is not None:
+                    monitor.reset()
             # check scaler
             if scaler.is_enabled():
                 current_scaler = scaler.get_scale()
@@ -145,8 +284,56 @@ def train(slices: List[Slice], args: Namespace) -> Tuple[INR, List[Slice], Volum
                         "The results might be suboptimal. "
                         "Try to set --single-precision or run the command again with a different random seed."
                     )
-                if i == args.n_iter:
+                if last_iter:
                     logging.debug("Final scale of GradScaler = %f" % current_scaler)
+        if stop:
+            break
+        # checkpoint
+        if getattr(args, "checkpoint", None) and i < args.n_iter:
+            save = (checkpoint_interval and i % checkpoint_interval == 0) or (
+                checkpoint_interval_seconds
+                and time.time() - checkpoint_time >= checkpoint_interval_seconds
+            )
+            if world_size > 1 and checkpoint_interval_seconds:
+                # follow the clock of rank 0
+                flag = torch.tensor([float(save)], device=args.device)
+                dist.broadcast(flag, 0)
+                save = bool(flag.item())
+            if save:
+                dataset_state, rng_state = dataset.state_dict(), get_rng_state()
+                if world_size > 1:
+                    # the data sampler and rng states of all processes
+                    states: List[Any] = [None] * world_size
+                    dist.all_gather_object(states, (dataset_state, rng_state))
+                    dataset_state = [state[0] for state in states]
+                    rng_state = [state[1] for state in states]
+                if rank == 0:
+                    save_checkpoint(
+                        args.checkpoint,
+                        {
+                            "iter": i,
+                            "train_time": train_time,
+                            "model": model.state_dict(),
+                            "optimizer": optimizer.state_dict(),
+                            "scheduler": scheduler.state_dict(),
+                            "scaler": scaler.state_dict(),
+                            "average": average.to_dict(),
+                            "dataset": dataset_state,
+                            "rng": rng_state,
+                            "decay_milestones": decay_milestones,
+                            "monitor": None if monitor is None else monitor.to_dict(),
+                            "slices": slices,
+                            "args": args,
+                        },
+                    )
+                checkpoint_time = time.time()
+
+    dataset.clear_prefetch()
+    if profiler.enabled:
+        model.profiler = None
+        profiler.save(profile_path)
+    # all levels are used for inference, e.g., after early stopping
+    model.inr.n_active_levels = model.inr.n_levels
 
     # outputs
     transformation = model.transformation
@@ -169,3 +356,186 @@ def train(slices: List[Slice], args: Namespace) -> Tuple[INR, List[Slice], Volum
         output_slice.transformation = transformation[i]
         output_slices.append(output_slice)
     return model.inr, output_slices, mask
+
+
+def progressive_n_levels(
+    i: int, progressive_iter: int, start_levels: int, n_levels: int
+) -> int:
+    """number of active hash grid levels at iteration i (coarse-to-fine training)"""
+    start_levels = max(1, min(start_levels, n_levels))
+    if i >= progressive_iter:
+        return n_levels
+    return start_levels + (n_levels - start_levels) * i // progressive_iter
+
+
+def train_distributed(
+    slices: List[Slice], args: Namespace
+) -> Tuple[INR, List[Slice], Volume]:
+    """
+    data-parallel training with args.n_proc_train processes, the points are
+    sharded across the processes and the gradients are all-reduced in each
+    iteration (NCCL if each process has a GPU, gloo otherwise)
+    """
+    n_proc = args.n_proc_train
+    n_threads = max(1, torch.get_num_threads() // n_proc)
+    logging.info("data-parallel training with %d processes", n_proc)
+    with tempfile.TemporaryDirectory() as tmp:
+        output = os.path.join(tmp, "output.pt")
+        torch.multiprocessing.spawn(
+            _train_worker,
+            args=(n_proc, n_threads, tmp, slices, args),
+            nprocs=n_proc,
+        )
+        results = torch.load(output, map_location=args.device, weights_only=False)
+    inr = INR(results["model"]["bounding_box"], args)
+    inr.load_state_dict(results["model"])
+    return inr, results["slices"], results["mask"]
+
+
+def _train_worker(
+    rank: int,
+    world_size: int,
+    n_threads: int,
+    tmp: str,
+    slices: List[Slice],
+    args: Namespace,
+) -> None:
+    args = copy.copy(args)
+    if rank == 0:  # append to the log file of the main process
+        output_log = getattr(args, "output_log", None)
+        setup_logger(output_log, getattr(args, "verbose", 1), "a")
+    else:
+        setup_logger(None, 0)
+    set_seed(getattr(args, "seed", None))
+    torch.set_num_threads(n_threads)
+    backend = "gloo"
+    device = torch.device(args.device)
+    if device.type == "cuda":
+        n_gpu = torch.cuda.device_count()
+        args.device = torch.device("cuda", ((device.index or 0) + rank) % n_gpu)
+        if world_size <= n_gpu and dist.is_nccl_available():
+            backend = "nccl"
+    dist.init_process_group(
+        backend,
+        init_method="file://" + os.path.join(tmp, "init"),
+        rank=rank,
+        world_size=world_size,
+    )
+    try:
+        inr, output_slices, mask = train(slices, args)
+        if rank == 0:
+            torch.save(
+                {"model": inr.state_dict(), "slices": output_slices, "mask": mask},
+                os.path.join(tmp, "output.pt"),
+            )
+    finally:
+        dist.destroy_process_group()
+
+
+def all_reduce_grads(
+    model: torch.nn.Module, losses: Dict[str, torch.Tensor], world_size: int
+) -> Dict[str, float]:
+    """
+    average the gradients and the losses over all processes. The dense
+    gradients and the losses are reduced in one all-reduce, the sparse
+    gradients (hash grid with LazyAdam) are all-gathered and kept sparse.
+    Parameters without gradient on every process keep grad = None.
+    """
+    params = [p for p in model.parameters() if p.requires_grad]
+    device = params[0].device
+    # 0: no gradient, 1: dense gradient, 2: sparse gradient
+    kinds = torch.tensor(
+        [0 if p.grad is None else 2 if p.grad.is_sparse else 1 for p in params],
+        device=device,
+    )
+    dist.all_reduce(kinds, op=dist.ReduceOp.MAX)
+    dense = [p for p, k in zip(params, kinds.tolist()) if k == 1]
+    sparse = [p for p, k in zip(params, kinds.tolist()) if k == 2]
+    # dense gradients and losses
+    grads = [
+        torch.zeros(p.numel(), device=device)
+        if p.grad is None
+        else p.grad.flatten().float()
+        for p in dense
+    ]
+    values = torch.stack([losses[k].detach().float() for k in losses])
+    buffer = torch.cat(grads + [values.to(device)])
+    dist.all_reduce(buffer)
+    buffer /= world_size
+    offset = 0
+    for p in dense:
+        p.grad = buffer[offset : offset + p.numel()].view_as(p).to(p.dtype)
+        offset += p.numel()
+    if sparse:
+        _all_gather_sparse_grads(sparse, world_size)
+    return dict(zip(losses, buffer[offset:].tolist()))
+
+
+def _all_gather_sparse_grads(params: List[torch.Tensor], world_size: int) -> None:
+    # the rows of the sparse gradients of all processes are concatenated,
+    # duplicated rows are summed in the optimizer (LazyAdam)
+    device = params[0].device
+    local = []
+    for p in params:
+        if p.grad is None:
+            g = torch.zeros_like(p).to_sparse(1)
+        else:
+            g = p.grad.coalesce() if p.grad.is_sparse else p.grad.to_sparse(1)
+        local.append((g._indices(), g._values()))
+    nnz = torch.tensor([v.shape[0] for _, v in local], device=device)
+    nnz_all = [torch.empty_like(nnz) for _ in range(world_size)]
+    dist.all_gather(nnz_all, nnz)
+    nnz_all_list = torch.stack(nnz_all).tolist()  # world_size x n_params
+    for j, (p, (indices, values)) in enumerate(zip(params, local)):
+        sizes = [n[j] for n in nnz_all_list]
+        max_nnz = max(sizes)
+        # all_gather requires tensors of the same size
+        pad = max_nnz - values.shape[0]
+        indices = torch.nn.functional.pad(indices, (0, pad))
+        values = torch.cat((values, values.new_zeros((pad,) + values.shape[1:])))
+        indices_all = [torch.empty_like(indices) for _ in range(world_size)]
+        values_all = [torch.empty_like(values) for _ in range(world_size)]
+        dist.all_gather(indices_all, indices)
+        dist.all_gather(values_all, values)
+        p.grad = torch.sparse_coo_tensor(
+            torch.cat([x[:, :n] for x, n in zip(indices_all, sizes)], 1),
+            torch.cat([x[:n] for x, n in zip(values_all, sizes)]) / world_size,
+            p.shape,
+        )
+
+
+def _rank_state(state: Any, rank: int, world_size: int) -> Any:
+    # checkpoints of distributed training store a list of per-process states
+    n_proc = len(state) if isinstance(state, list) else 1
+    if n_proc != world_size:
+        raise ValueError(
+            "The checkpoint is saved with %d processes, but %d processes are used."
+            % (n_proc, world_size)
+        )
+    return state[rank] if isinstance(state, list) else state
+
+
+def save_checkpoint(path: PathType, checkpoint: Dict[str, Any]) -> None:
+    # write to a temporary file first so that an interrupted write
+    # never corrupts the previous checkpoint
+    path = os.fspath(path)
+    torch.save(checkpoint, path + ".tmp")
+    os.replace(path + ".tmp", path)
+    logging.debug("checkpoint saved at iteration %d", checkpoint["iter"])
+
+
+def get_rng_state() -> Dict[str, Any]:
+    return {
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+        "numpy": np.random.get_state(),
+        "random": random.getstate(),
+    }
+
+
+def set_rng_state(state: Dict[str, Any]) -> None:
+    torch.set_rng_state(state["torch"].cpu())
+    if state["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state["cuda"]])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["random"])
@@ -1,4 +1,5 @@
 import os
+import functools
 from typing import List, Optional
 import numpy as np
 import torch
@@ -26,6 +27,15 @@ def get_iqa2d_checkpoint() -> str:
     return os.path.join(model_dir, model_name)
 
 
+@functools.lru_cache(maxsize=None)
+def load_iqa2d(device) -> torch.nn.Module:
+    model = resnet34(num_classes=3).to(device)
+    checkpoint = torch.load(get_iqa2d_checkpoint(), map_location=device)
+    model.load_state_dict(checkpoint)
+    model.eval()
+    return model
+
+
 def iqa2d(
     stacks: List[Stack],
     device,
@@ -35,10 +45,7 @@ def iqa2d(
     augmentation: bool = True,
 ) -> List[float]:
     # load model
-    model = resnet34(num_classes=3).to(device)
-    checkpoint = torch.load(get_iqa2d_checkpoint(), map_location=device)
-    model.load_state_dict(checkpoint)
-    model.eval()
+    model = load_iqa2d(device)
     # estimate mean and std
     if mean is None or std is None:
         v_mean = 0.0
@@ -8,6 +8,7 @@ from typing import List
 import os
 import tarfile
 import importlib
+import functools
 import torch.nn.functional as F
 from math import ceil
 import numpy as np
@@ -45,6 +46,7 @@ def get_monaifbs_checkpoint() -> str:
     return os.path.join(model_dir, model_name)
 
 
+@functools.lru_cache(maxsize=None)
 def build_monaifbs_net(device):
     logging.info("building monaifbs network")
 
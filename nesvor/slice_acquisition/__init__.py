@@ -1 +1,8 @@
 from .slice_acq import slice_acquisition, slice_acquisition_adjoint
+from .slice_acq_torch import (
+    clean_cache,
+    no_cache,
+    set_cache_budget,
+    set_matrix_free,
+    set_memory_budget,
+)
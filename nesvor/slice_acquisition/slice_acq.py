@@ -199,6 +199,7 @@ def slice_acquisition(
             slice_shape,
             res_slice,
             need_weight,
+            interp_psf,
         )
     else:
         return SliceAcqFunction.apply(
@@ -239,6 +240,7 @@ def slice_acquisition_adjoint(
             vol_shape,
             res_slice,
             equalize,
+            interp_psf,
         )
     else:
         return SliceAcqAdjointFunction.apply(
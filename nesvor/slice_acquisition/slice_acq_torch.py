@@ -1,59 +1,256 @@
-from typing import Optional, cast, Sequence
+from typing import Optional, cast, Sequence, Dict, Tuple
+from collections import OrderedDict
+import contextlib
+import hashlib
 import logging
+import warnings
 import torch
 import torch.nn.functional as F
 from ..image import Volume, Slice
 from ..transform import mat_transform_points
 
 
-# _cache: Dict = dict()
-# _cache_id: Tuple = tuple()
+# memory budget (in bytes) of the intermediate tensors of the torch implementation,
+# it is further limited by the free memory of the device (GPU memory or RAM)
+MEMORY_BUDGET = 512 * 1024**2
+# peak memory (in bytes) per nonzero of the system matrix in _construct_coef,
+# including the COO, CSR and transposed CSR matrices
+COEF_NBYTES = 96
+# shrinks after OOM and recovers after successful calls
+_oom_scale = 1.0
+_batch_size_logged: Dict[str, int] = {}
 
-BATCH_SIZE = 64
+warnings.filterwarnings("ignore", message="Sparse CSR tensor support is in beta")
 
+# cache of the system matrices (CSR + transposed CSR, interp_psf = True) and the
+# PSF sampling grids (matrix-free, interp_psf = False) of the torch implementation.
+# In SVR, the transformations only change once per outer iteration, while the
+# forward/adjoint operators are applied many times with the same inputs.
+_cache: "OrderedDict[Tuple, Dict[str, torch.Tensor]]" = OrderedDict()
+_cache_nbytes = 0
+CACHE_BUDGET = 2 * 1024**3  # bytes
+# > 0 inside no_cache()
+_no_cache_depth = 0
+# trilinear matrix-free operators for interp_psf = False (as the CUDA kernel),
+# otherwise the cached nearest neighbor system matrices are used, which are
+# less accurate but faster when the operators are reused many times in SVR
+MATRIX_FREE = True
 
-# def clean_cache(*args) -> None:
-#     global _cache, _cache_id
-#     del _cache
-#     _cache = dict()
-#     _cache_id = args
-#     torch.cuda.empty_cache()
 
+def set_cache_budget(nbytes: int) -> None:
+    """set the memory budget (in bytes) of the system matrix cache, 0 to disable"""
+    global CACHE_BUDGET
+    CACHE_BUDGET = int(nbytes)
+    _evict(0)
 
-# def check_cache(transforms, vol_shape, slice_shape, psf, res_slice) -> bool:
-#     global _cache, _cache_id
-#     if not _cache_id:
-#         return False
-#     if id(transforms) != id(_cache_id[0]):
-#         if transforms.shape != _cache_id[0].shape:
-#             return False
-#         if torch.any(transforms != _cache_id[0]):
-#             return False
-#     if vol_shape != _cache_id[1]:
-#         return False
-#     if slice_shape != _cache_id[2]:
-#         return False
-#     if id(psf) != id(_cache_id[3]):
-#         if psf.shape != _cache_id[3].shape:
-#             return False
-#         if torch.any(psf != _cache_id[3]):
-#             return False
-#     if res_slice != _cache_id[4]:
-#         return False
-#     return True
+
+@contextlib.contextmanager
+def no_cache():
+    """
+    do not cache the operators created in this context (e.g., in registration,
+    where each call uses new transformations), the existing entries are kept
+    """
+    global _no_cache_depth
+    _no_cache_depth += 1
+    try:
+        yield
+    finally:
+        _no_cache_depth -= 1
+
+
+def _cache_enabled() -> bool:
+    return CACHE_BUDGET > 0 and _no_cache_depth == 0
+
+
+def set_matrix_free(enabled: bool) -> None:
+    """
+    use the matrix-free operators (True) or the cached nearest neighbor
+    system matrices (False) of the torch implementation for interp_psf = False
+    """
+    global MATRIX_FREE
+    MATRIX_FREE = bool(enabled)
+
+
+def set_memory_budget(nbytes: int) -> None:
+    """set the memory budget (in bytes) of the intermediate tensors"""
+    global MEMORY_BUDGET
+    MEMORY_BUDGET = int(nbytes)
+
+
+def _available_memory(device: torch.device) -> int:
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device)
+        return free + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(
+            device
+        )
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return MEMORY_BUDGET
+
+
+def _memory_budget(device: torch.device) -> int:
+    budget = min(MEMORY_BUDGET, int(0.8 * _available_memory(device)))
+    return max(1, int(budget * _oom_scale))
+
+
+def _batch_size(name: str, n_max: int, nbytes_per_item: int, device) -> int:
+    # largest power of 2 (for stable cache keys) within the memory budget
+    budget = _memory_budget(torch.device(device))
+    n = max(1, budget // max(1, nbytes_per_item))
+    n = min(1 << (n.bit_length() - 1), n_max)
+    if _batch_size_logged.get(name) != n:
+        logging.debug(
+            "slice acquisition: %s batch size = %d (%d bytes / item, budget = %.1f MB)",
+            name,
+            n,
+            nbytes_per_item,
+            budget / 1024**2,
+        )
+        _batch_size_logged[name] = n
+    return n
+
+
+def _on_oom(e: RuntimeError) -> None:
+    global _oom_scale
+    if "out of memory" not in str(e) or _oom_scale < 1e-6:
+        raise e
+    logging.debug("OOM, reduce batch size")
+    _oom_scale /= 2
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def _on_success() -> None:
+    # recover after transient memory pressure
+    global _oom_scale
+    _oom_scale = min(1.0, _oom_scale * 2)
+
+
+def _coef_batch_size(
+    slice_shape: Tuple, slices_mask: Optional[torch.Tensor], psf: torch.Tensor
+) -> int:
+    # number of slices per system matrix, predicted from the number of
+    # pixels in a slice (with mask) and the support of the PSF
+    if slices_mask is not None:
+        n_pixel = int(slices_mask.flatten(1).sum(1).max())
+        n_slice = slices_mask.shape[0]
+    else:
+        n_pixel = slice_shape[0] * slice_shape[1]
+        n_slice = 1 << 30
+    n_psf = int((psf > 0).sum())
+    return _batch_size("coef", n_slice, n_pixel * n_psf * COEF_NBYTES, psf.device)
+
+
+def clean_cache() -> None:
+    """invalidate all the cached system matrices"""
+    global _cache_nbytes
+    _cache.clear()
+    _cache_nbytes = 0
+
+
+def _evict(nbytes_new: int) -> None:
+    global _cache_nbytes
+    while _cache and _cache_nbytes + nbytes_new > CACHE_BUDGET:
+        _, entry = _cache.popitem(last=False)
+        _cache_nbytes -= _entry_nbytes(entry)
+
+
+def _entry_nbytes(entry: Dict[str, torch.Tensor]) -> int:
+    nbytes = 0
+    for v in entry.values():
+        if v.layout == torch.sparse_csr:
+            for t in (v.crow_indices(), v.col_indices(), v.values()):
+                nbytes += t.numel() * t.element_size()
+        else:
+            nbytes += v.numel() * v.element_size()
+    return nbytes
+
+
+def _tensor_digest(x: Optional[torch.Tensor]) -> Optional[Tuple]:
+    if x is None:
+        return None
+    x = x.detach().contiguous()
+    h = hashlib.blake2b(x.cpu().numpy().tobytes(), digest_size=16).hexdigest()
+    return (tuple(x.shape), str(x.dtype), str(x.device), h)
+
+
+def _fingerprint(
+    transforms, vol_shape, slice_shape, slices_mask, psf, res_slice
+) -> Tuple:
+    # vol_mask is not part of the system matrix in the torch implementation
+    return (
+        _tensor_digest(transforms),
+        tuple(vol_shape),
+        tuple(slice_shape),
+        _tensor_digest(slices_mask),
+        _tensor_digest(psf),
+        float(res_slice),
+    )
+
+
+def _get_coef(
+    fingerprint: Optional[Tuple],
+    idxs,
+    transforms,
+    vol_shape,
+    slice_shape,
+    vol_mask,
+    slice_mask,
+    psf,
+    res_slice,
+) -> Dict[str, torch.Tensor]:
+    key = None
+    if fingerprint is not None:
+        key = fingerprint + (idxs[0], idxs[-1])
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    coef = _construct_coef(
+        idxs, transforms, vol_shape, slice_shape, vol_mask, slice_mask, psf, res_slice
+    )
+    entry = {
+        "coef": coef.to_sparse_csr(),
+        "coef_t": _transpose_csr(coef),
+        "weight": torch.sparse.sum(coef, 1).to_dense(),
+    }
+    del coef
+    if key is not None:
+        _cache_put(key, entry)
+    return entry
+
+
+def _cache_put(key: Tuple, entry: Dict[str, torch.Tensor]) -> None:
+    global _cache_nbytes
+    nbytes = _entry_nbytes(entry)
+    if nbytes <= CACHE_BUDGET:
+        _evict(nbytes)
+        _cache[key] = entry
+        _cache_nbytes += nbytes
+    else:
+        logging.debug(
+            "cache entry (%.1f MB) exceeds the cache budget", nbytes / 1024**2
+        )
+
+
+def _transpose_csr(coef: torch.Tensor) -> torch.Tensor:
+    # transposed CSR from a coalesced COO matrix (sorted by row)
+    row, col = coef.indices()
+    order = torch.argsort(col, stable=True)
+    crow = torch.zeros(coef.shape[1] + 1, dtype=torch.long, device=col.device)
+    crow[1:] = torch.bincount(col, minlength=coef.shape[1]).cumsum(0)
+    return torch.sparse_csr_tensor(
+        crow, row[order], coef.values()[order], (coef.shape[1], coef.shape[0])
+    )
 
 
 def _construct_coef(
     idxs, transforms, vol_shape, slice_shape, vol_mask, slice_mask, psf, res_slice
 ):
-    # if not check_cache(transforms, vol_shape, slice_shape, psf, res_slice):
-    #    clean_cache(transforms, vol_shape, slice_shape, psf, res_slice)
-    #    print("clean cache")
-    # if False and idxs[0] in _cache:
-    #     # print("cache")
-    #     return _cache[idxs[0]].to(transforms.device)
-    # else:
-
     slice_ids = []
     volume_ids = []
     psf_vs = []
@@ -88,7 +285,6 @@ def _construct_coef(
             vol_shape[0] * vol_shape[1] * vol_shape[2],
         ],
     ).coalesce()
-    # _cache[idxs[0]] = coef.cpu()
     return coef
 
 
@@ -139,6 +335,233 @@ def _construct_slice_coef(
     return slice_id, volume_id, psf_v
 
 
+def _psf_offsets(psf: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    # offsets (xyz, in voxels) and values of the nonzero PSF entries
+    d_p, h_p, w_p = psf.shape
+    oz, oy, ox = torch.meshgrid(
+        torch.arange(d_p, device=psf.device) - d_p // 2,
+        torch.arange(h_p, device=psf.device) - h_p // 2,
+        torch.arange(w_p, device=psf.device) - w_p // 2,
+        indexing="ij",
+    )
+    nz = psf.reshape(-1) > 0
+    offsets = torch.stack((ox, oy, oz), -1).reshape(-1, 3)[nz].to(psf.dtype)
+    return offsets, psf.reshape(-1)[nz]
+
+
+def _masked_pixels(
+    n_slice: int, slice_shape: Tuple, slices_mask: Optional[torch.Tensor], device
+) -> torch.Tensor:
+    if slices_mask is not None:
+        return torch.nonzero(slices_mask.reshape(-1)).view(-1)
+    return torch.arange(n_slice * slice_shape[0] * slice_shape[1], device=device)
+
+
+def _chunk_size(n_psf: int, n_pixel: int, device) -> int:
+    # number of pixels per chunk,
+    # bytes per PSF sample: coordinates (x2), grid, weights and sampled values
+    return _batch_size("matrix-free", n_pixel, n_psf * 4 * (3 * 3 + 2 + 2), device)
+
+
+def _get_grid(
+    fingerprint: Optional[Tuple],
+    i: int,
+    transforms: torch.Tensor,
+    pix: torch.Tensor,
+    offsets: torch.Tensor,
+    psf_v: torch.Tensor,
+    slice_shape: Tuple,
+    res_slice: float,
+    vol_shape: Tuple,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    # the sampling grids are cached like the system matrices,
+    # unless they are differentiated w.r.t. the transformations
+    key = None
+    if fingerprint is not None and not (
+        transforms.requires_grad and torch.is_grad_enabled()
+    ):
+        key = fingerprint + ("grid", i, pix.shape[0])
+        if key in _cache:
+            _cache.move_to_end(key)
+            entry = _cache[key]
+            return entry["grid"], entry["weight"]
+    grid, weight = _psf_grid(
+        transforms, pix, offsets, psf_v, slice_shape, res_slice, vol_shape
+    )
+    if key is not None:
+        _cache_put(key, {"grid": grid, "weight": weight})
+    return grid, weight
+
+
+def _psf_grid(
+    transforms: torch.Tensor,
+    pix: torch.Tensor,
+    offsets: torch.Tensor,
+    psf_v: torch.Tensor,
+    slice_shape: Tuple,
+    res_slice: float,
+    vol_shape: Tuple,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    PSF samples of the pixels (flattened indices) in the volume:
+    the sampling grid of grid_sample (1 x 1 x P x K x 3) and the PSF weights (P x K),
+    samples outside the volume have zero weight (as in the CUDA kernel)
+    """
+    h, w = slice_shape
+    n = pix // (h * w)
+    iy = (pix // w) % h
+    ix = pix % w
+    xyz = torch.stack(
+        (
+            (ix - (w - 1) / 2) * res_slice,
+            (iy - (h - 1) / 2) * res_slice,
+            torch.zeros_like(ix),
+        ),
+        -1,
+    ).to(transforms.dtype) + transforms[n, :, 3]
+    # (P, K, 3)
+    xyz = torch.matmul(
+        xyz[:, None] + offsets, transforms[n, :, :3].transpose(-1, -2)
+    )
+    size = torch.tensor(vol_shape[::-1], dtype=xyz.dtype, device=xyz.device) - 1
+    xyz = xyz + size / 2
+    weight = psf_v * ((xyz >= 0) & (xyz < size)).all(-1)
+    grid = xyz * (2 / size) - 1
+    return grid[None, None], weight
+
+
+def _grid_sample_adjoint(
+    g: torch.Tensor, grid: torch.Tensor, vol_shape: Tuple
+) -> torch.Tensor:
+    # adjoint of trilinear grid_sample (C x P x K -> 1 x C x D x H x W),
+    # i.e., scattering g to the 8 neighbors of each sample
+    v0 = torch.zeros((1, g.shape[0]) + vol_shape, dtype=g.dtype, device=g.device)
+    g = g[None, :, None]
+    if not (torch.is_grad_enabled() and (g.requires_grad or grid.requires_grad)):
+        # bilinear = 0, zeros padding = 0
+        return torch.ops.aten.grid_sampler_3d_backward(
+            g, v0, grid, 0, 0, True, [True, False]
+        )[0]
+    # differentiable w.r.t. g and grid
+    with torch.enable_grad():
+        v0.requires_grad_()
+        out = F.grid_sample(v0, grid, align_corners=True)
+        (v,) = torch.autograd.grad(out, v0, g, create_graph=True)
+    return v
+
+
+def slice_acquisition_matrix_free_torch(
+    transforms: torch.Tensor,
+    vol: torch.Tensor,
+    vol_mask: Optional[torch.Tensor],
+    slices_mask: Optional[torch.Tensor],
+    psf: torch.Tensor,
+    slice_shape: Tuple,
+    res_slice: float,
+    need_weight: bool,
+):
+    vol_shape = tuple(vol.shape[-3:])
+    offsets, psf_v = _psf_offsets(psf.to(transforms.dtype))
+    pix = _masked_pixels(transforms.shape[0], slice_shape, slices_mask, vol.device)
+    if vol_mask is not None:
+        vol = torch.cat((vol * vol_mask, vol_mask.to(vol.dtype)), 1)
+    fingerprint = (
+        _fingerprint(transforms, vol_shape, slice_shape, slices_mask, psf, res_slice)
+        if _cache_enabled()
+        else None
+    )
+    n_pixel = transforms.shape[0] * slice_shape[0] * slice_shape[1]
+    values = vol.new_zeros(n_pixel)
+    weights = vol.new_zeros(n_pixel)
+    i = 0
+    while i < pix.shape[0]:
+        chunk = _chunk_size(offsets.shape[0], pix.shape[0], pix.device)
+        p = pix[i : i + chunk]
+        try:
+            grid, w = _get_grid(
+                fingerprint,
+                i,
+                transforms,
+                p,
+                offsets,
+                psf_v,
+                slice_shape,
+                res_slice,
+                vol_shape,
+            )
+            # C x P x K
+            v = F.grid_sample(vol, grid, align_corners=True)[0, :, 0]
+        except RuntimeError as e:
+            _on_oom(e)
+            continue
+        values[p] = (v[0] * w).sum(-1)
+        weights[p] = (v[1] * w).sum(-1) if vol_mask is not None else w.sum(-1)
+        i += chunk
+    _on_success()
+    slices = values / torch.where(weights > 0, weights, torch.ones_like(weights))
+    slices = slices.view((-1, 1) + slice_shape)
+    if need_weight:
+        return slices, weights.view_as(slices)
+    else:
+        return slices
+
+
+def slice_acquisition_adjoint_matrix_free_torch(
+    transforms: torch.Tensor,
+    psf: torch.Tensor,
+    slices: torch.Tensor,
+    slices_mask: Optional[torch.Tensor],
+    vol_mask: Optional[torch.Tensor],
+    vol_shape: Tuple,
+    res_slice: float,
+    equalize: bool,
+) -> torch.Tensor:
+    slice_shape = tuple(slices.shape[-2:])
+    offsets, psf_v = _psf_offsets(psf.to(transforms.dtype))
+    pix = _masked_pixels(transforms.shape[0], slice_shape, slices_mask, slices.device)
+    slices = slices.reshape(-1)
+    fingerprint = (
+        _fingerprint(transforms, vol_shape, slice_shape, slices_mask, psf, res_slice)
+        if _cache_enabled()
+        else None
+    )
+    vol = slices.new_zeros((1, 2 if equalize else 1) + vol_shape)
+    i = 0
+    while i < pix.shape[0]:
+        chunk = _chunk_size(offsets.shape[0], pix.shape[0], pix.device)
+        p = pix[i : i + chunk]
+        try:
+            grid, w = _get_grid(
+                fingerprint,
+                i,
+                transforms,
+                p,
+                offsets,
+                psf_v,
+                slice_shape,
+                res_slice,
+                vol_shape,
+            )
+            # the PSF is normalized in each pixel, pixels at the border are skipped
+            w_sum = w.sum(-1, keepdim=True)
+            w = w * torch.where(w_sum >= 0.5, 1 / w_sum, torch.zeros_like(w_sum))
+            g = (w * slices[p, None])[None]
+            if equalize:
+                g = torch.cat((g, w[None]), 0)
+            vol = vol + _grid_sample_adjoint(g, grid, vol_shape)
+        except RuntimeError as e:
+            _on_oom(e)
+            continue
+        i += chunk
+    _on_success()
+    if vol_mask is not None:
+        vol = vol * vol_mask
+    if equalize:
+        vol, weight = vol[:, :1], vol[:, 1:]
+        vol = vol / torch.where(weight > 0, weight, torch.ones_like(weight))
+    return vol
+
+
 def slice_acquisition_torch(
     transforms: torch.Tensor,
     vol: torch.Tensor,
@@ -148,25 +571,43 @@ def slice_acquisition_torch(
     slice_shape: Sequence,
     res_slice: float,
     need_weight: bool,
+    interp_psf: bool = False,
 ):
     slice_shape = tuple(slice_shape)
-    global BATCH_SIZE
     if psf.numel() == 1 and need_weight == False:
         return slice_acquisition_no_psf_torch(
             transforms, vol, vol_mask, slices_mask, slice_shape, res_slice
         )
+    if not interp_psf and MATRIX_FREE:
+        return slice_acquisition_matrix_free_torch(
+            transforms,
+            vol,
+            vol_mask,
+            slices_mask,
+            psf,
+            slice_shape,
+            res_slice,
+            need_weight,
+        )
+    # nearest neighbor with a (cached) sparse system matrix
     # print("f")
     if vol_mask is not None:
         vol = vol * vol_mask
     vol_shape = vol.shape[-3:]
+    fingerprint = (
+        _fingerprint(transforms, vol_shape, slice_shape, slices_mask, psf, res_slice)
+        if _cache_enabled()
+        else None
+    )
     _slices = []
     _weights = []
     i = 0
     while i < transforms.shape[0]:
-        succ = False
+        batch_size = _coef_batch_size(slice_shape, slices_mask, psf)
         try:
-            coef = _construct_coef(
-                list(range(i, min(i + BATCH_SIZE, transforms.shape[0]))),
+            entry = _get_coef(
+                fingerprint,
+                list(range(i, min(i + batch_size, transforms.shape[0]))),
                 transforms,
                 vol_shape,
                 slice_shape,
@@ -175,21 +616,16 @@ def slice_acquisition_torch(
                 psf,
                 res_slice,
             )
-            s = torch.mv(coef, vol.view(-1)).to_dense().reshape((-1, 1) + slice_shape)
-            weight = torch.sparse.sum(coef, 1).to_dense().reshape_as(s)
-            del coef
-            succ = True
+            s = torch.mv(entry["coef"], vol.reshape(-1)).reshape((-1, 1) + slice_shape)
+            weight = entry["weight"].reshape_as(s)
+            del entry
         except RuntimeError as e:
-            if "out of memory" in str(e) and BATCH_SIZE > 0:
-                logging.debug("OOM, reduce batch size")
-                BATCH_SIZE = BATCH_SIZE // 2
-                torch.cuda.empty_cache()
-            else:
-                raise e
-        if succ:
-            _slices.append(s)
-            _weights.append(weight)
-            i += BATCH_SIZE
+            _on_oom(e)
+            continue
+        _slices.append(s)
+        _weights.append(weight)
+        i += batch_size
+    _on_success()
 
     slices = torch.cat(_slices)
     weights = torch.cat(_weights)
@@ -212,21 +648,38 @@ def slice_acquisition_adjoint_torch(
     vol_shape: Sequence,
     res_slice: float,
     equalize: bool,
+    interp_psf: bool = False,
 ):
     vol_shape = tuple(vol_shape)
-    global BATCH_SIZE
+    if not interp_psf and MATRIX_FREE:
+        return slice_acquisition_adjoint_matrix_free_torch(
+            transforms,
+            psf,
+            slices,
+            slices_mask,
+            vol_mask,
+            vol_shape,
+            res_slice,
+            equalize,
+        )
+    # nearest neighbor with a (cached) sparse system matrix
     if slices_mask is not None:
         slices = slices * slices_mask
     vol = None
     weight = None
-    slice_shape = slices.shape[-2:]
-    # print("b")
+    slice_shape = tuple(slices.shape[-2:])
+    fingerprint = (
+        _fingerprint(transforms, vol_shape, slice_shape, slices_mask, psf, res_slice)
+        if _cache_enabled()
+        else None
+    )
     i = 0
     while i < transforms.shape[0]:
-        succ = False
+        batch_size = _coef_batch_size(slice_shape, slices_mask, psf)
         try:
-            coef = _construct_coef(
-                list(range(i, min(i + BATCH_SIZE, transforms.shape[0]))),
+            coef_t = _get_coef(
+                fingerprint,
+                list(range(i, min(i + batch_size, transforms.shape[0]))),
                 transforms,
                 vol_shape,
                 slice_shape,
@@ -234,35 +687,32 @@ def slice_acquisition_adjoint_torch(
                 slices_mask,
                 psf,
                 res_slice,
-            ).t()
-            v = torch.mv(coef, slices[i : i + BATCH_SIZE].view(-1))
+            )["coef_t"]
+            v = torch.mv(coef_t, slices[i : i + batch_size].reshape(-1))
             if equalize:
-                w = torch.sparse.sum(coef, 1)
-            del coef
-            succ = True
+                w = torch.mv(
+                    coef_t, torch.ones_like(slices[i : i + batch_size]).view(-1)
+                )
+            del coef_t
         except RuntimeError as e:
-            if "out of memory" in str(e) and BATCH_SIZE > 0:
-                logging.debug("OOM, reduce batch size")
-                BATCH_SIZE = BATCH_SIZE // 2
-                torch.cuda.empty_cache()
+            _on_oom(e)
+            continue
+        if vol is None:
+            vol = v
+        else:
+            vol += v
+        if equalize:
+            if weight is None:
+                weight = w
             else:
-                raise e
-        if succ:
-            if vol is None:
-                vol = v
-            else:
-                vol += v
-            if equalize:
-                if weight is None:
-                    weight = w
-                else:
-                    weight += w
-            i += BATCH_SIZE
+                weight += w
+        i += batch_size
+    _on_success()
     vol = cast(torch.Tensor, vol)
-    vol = vol.to_dense().reshape((1, 1) + vol_shape)
+    vol = vol.reshape((1, 1) + vol_shape)
     if equalize:
         weight = cast(torch.Tensor, weight)
-        weight = weight.to_dense().reshape_as(vol)
+        weight = weight.reshape_as(vol)
         m = weight > 1e-2
         vol[m] = vol[m] / weight[m]
     if vol_mask is not None:
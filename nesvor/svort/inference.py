@@ -1,7 +1,8 @@
 import logging
 import time
 import math
-from typing import List, Tuple, Optional, cast
+import functools
+from typing import List, Tuple, Optional, Dict, Any, cast
 import numpy as np
 import torch
 import torch.nn.functional as F
@@ -427,6 +428,7 @@ def run_svort(
     vvr: bool,
     force_vvr: bool,
     force_scanner: bool,
+    args_registration: Optional[Dict[str, Any]] = None,
 ) -> List[Slice]:
     if svort or vvr:
         (dataset, stacks_in, ss_ori, stacks_full, crop_idx, volume, psf) = parse_data(
@@ -475,7 +477,9 @@ def run_svort(
     if vvr:
         # stack-to-stack registration
         time_start = time.time()
-        __ss = stack_registration([ss_stack_full, ss_ori] if svort else [ss_ori], svort)
+        __ss = stack_registration(
+            [ss_stack_full, ss_ori] if svort else [ss_ori], svort, args_registration
+        )
         logging.debug("time for stack registration: %f s" % (time.time() - time_start))
         # estimate NCC score for stack-to-stack registration
         if svort:
@@ -528,6 +532,32 @@ def run_svort(
     return slices
 
 
+@functools.lru_cache(maxsize=None)
+def load_svort(svort_version: str, device) -> torch.nn.Module:
+    # the loaded models are kept resident and shared between calls
+    if svort_version not in SVORT_URL_DICT:
+        raise ValueError("unknown SVoRT version!")
+    svort_url = SVORT_URL_DICT[svort_version]
+    cp = torch.hub.load_state_dict_from_url(
+        url=svort_url,
+        model_dir=CHECKPOINT_DIR,
+        map_location=device,
+        file_name="SVoRT_%s.pt" % svort_version,
+    )
+    model: torch.nn.Module
+    if svort_version == "v1" or "v1." in svort_version:
+        model = SVoRT(n_iter=3)
+    elif svort_version == "v2" or "v2." in svort_version:
+        model = SVoRTv2(n_iter=4)
+    else:
+        raise ValueError("unknown SVoRT version!")
+    logging.debug("Loading SVoRT model")
+    model.load_state_dict(cp["model"])
+    model.to(device)
+    model.eval()
+    return model
+
+
 def svort_predict(
     dataset: List[Stack],
     device,
@@ -536,26 +566,11 @@ def svort_predict(
     vvr: bool,
     force_vvr: bool,
     force_scanner: bool,
+    args_registration: Optional[Dict[str, Any]] = None,
 ) -> List[Slice]:
     model: Optional[torch.nn.Module] = None
     if svort:
-        if svort_version not in SVORT_URL_DICT:
-            raise ValueError("unknown SVoRT version!")
-        svort_url = SVORT_URL_DICT[svort_version]
-        cp = torch.hub.load_state_dict_from_url(
-            url=svort_url,
-            model_dir=CHECKPOINT_DIR,
-            map_location=device,
-            file_name="SVoRT_%s.pt" % svort_version,
-        )
-        if svort_version == "v1" or "v1." in svort_version:
-            model = SVoRT(n_iter=3)
-        elif svort_version == "v2" or "v2." in svort_version:
-            model = SVoRTv2(n_iter=4)
-        else:
-            raise ValueError("unknown SVoRT version!")
-        logging.debug("Loading SVoRT model")
-        model.load_state_dict(cp["model"])
-        model.to(device)
-        model.eval()
-    return run_svort(dataset, model, svort, vvr, force_vvr, force_scanner)
+        model = load_svort(svort_version, device)
+    return run_svort(
+        dataset, model, svort, vvr, force_vvr, force_scanner, args_registration
+    )
@@ -2,16 +2,18 @@ import logging
 from typing import List, Optional, Tuple, cast
 import torch
 import numpy as np
-from .registration import SliceToVolumeRegistration
+from .registration import SliceToVolumeRegistration, close_registration_pool
 from .outlier import EM, global_ncc_exclusion, local_ssim_exclusion
 from .reconstruction import (
     psf_reconstruction,
     srr_update,
+    srr_cg_update,
     simulate_slices,
     slices_scale,
     simulated_error,
 )
 from ..utils import DeviceType, PathType, get_PSF
+from ..slice_acquisition import clean_cache
 from ..image import Volume, Slice, load_volume, load_mask, Stack
 from ..inr.data import PointDataset
 
@@ -88,6 +90,12 @@ def slice_to_volume_reconstruction(
     sample_mask: Optional[PathType] = None,
     sample_orientation: Optional[PathType] = None,
     psf: str = "gaussian",
+    n_proc_svr: int = 1,
+    svr_auto_grad: bool = False,
+    registration_optimizer: str = "gd",
+    srr_solver: str = "gd",
+    srr_cg_iter: int = 3,
+    srr_cg_tol: float = 0.1,
     device: DeviceType = torch.device("cpu"),
     **unused
 ) -> Tuple[Volume, List[Slice], List[Slice]]:
@@ -129,13 +137,21 @@ def slice_to_volume_reconstruction(
                 num_steps=5,
                 step_size=2,
                 max_iter=30,
+                optimizer=(
+                    None
+                    if registration_optimizer == "gd"
+                    else {"name": registration_optimizer}
+                ),
+                auto_grad=svr_auto_grad,
             )
             slices_transform, _ = svr(
                 stack,
                 volume,
                 use_mask=True,
+                n_proc=n_proc_svr,
             )
             stack.transformation = slices_transform
+            clean_cache()
 
         # global structual exclusion
         if i > 0 and not no_global_exclusion:
@@ -186,16 +202,29 @@ def slice_to_volume_reconstruction(
             # super-resolution update
             beta = max(0.01, 0.08 / (2**i))
             alpha = min(1, 0.05 / beta)
-            volume = srr_update(
-                err,
-                volume,
-                p,
-                alpha,
-                beta,
-                delta * output_intensity_mean,
-                use_mask=not with_background,
-                psf=psf_tensor,
-            )
+            if srr_solver == "cg":
+                volume = srr_cg_update(
+                    err,
+                    volume,
+                    p,
+                    beta,
+                    delta * output_intensity_mean,
+                    use_mask=not with_background,
+                    psf=psf_tensor,
+                    n_iter=srr_cg_iter,
+                    rtol=srr_cg_tol,
+                )
+            else:
+                volume = srr_update(
+                    err,
+                    volume,
+                    p,
+                    alpha,
+                    beta,
+                    delta * output_intensity_mean,
+                    use_mask=not with_background,
+                    psf=psf_tensor,
+                )
 
     # reconstruction finished
     # prepare outputs
@@ -207,4 +236,7 @@ def slice_to_volume_reconstruction(
     )
     simulated_slices = stack[:]
     output_slices = slices_sim[:]
+    clean_cache()
+    # the registration workers are shared by the outer iterations of this run
+    close_registration_pool()
     return volume, output_slices, simulated_slices
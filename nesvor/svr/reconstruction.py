@@ -1,3 +1,4 @@
+import logging
 from typing import Callable, Dict, Optional, Tuple, Union, cast
 import torch
 import torch.nn as nn
@@ -7,36 +8,70 @@ from ..slice_acquisition import slice_acquisition, slice_acquisition_adjoint
 from ..image import Volume, Stack
 from ..utils import get_PSF
 
+# number of voxels per slab in edge_preserving_regularization
+SRR_SLAB_VOXELS = 2**22
+# neighbour offsets (dz, dy, dx) whose first nonzero component is positive
+_HALF_NEIGHBOURS = [
+    (dz, dy, dx)
+    for dz in (-1, 0, 1)
+    for dy in (-1, 0, 1)
+    for dx in (-1, 0, 1)
+    if (dz, dy, dx) > (0, 0, 0)
+]
+# upper bound of the diagonal of the regularization, sum_n 1 / |n|^2
+_REG_DIAG = 2 * sum(1 / sum(o * o for o in n) for n in _HALF_NEIGHBOURS)
+
 
 def dot(x: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
     return torch.dot(x.flatten(), y.flatten())
 
 
 def cg(
-    A: Callable, b: torch.Tensor, x0: torch.Tensor, n_iter: int, tol: float = 0.0
+    A: Callable,
+    b: torch.Tensor,
+    x0: torch.Tensor,
+    n_iter: int,
+    tol: float = 0.0,
+    M: Optional[Callable] = None,
+    rtol: float = 0.0,
 ) -> torch.Tensor:
+    """
+    (preconditioned) conjugate gradient for A x = b, M applies the inverse of
+    the preconditioner. It stops after n_iter iterations or once |r|^2 <= tol
+    or |r| <= rtol * |r0|.
+    """
     if x0 is None:
         x = 0
         r = b
     else:
         x = x0
         r = b - A(x)
-    p = r
-    dot_r_r = dot(r, r)
+    z = r if M is None else M(r)
+    p = z
+    dot_r_z = dot(r, z)
+    dot_r_r = dot_r_z if M is None else dot(r, r)
+    if dot_r_r <= tol:  # x0 is already a solution
+        return torch.zeros_like(b) if x0 is None else x
+    tol = max(tol, rtol * rtol * dot_r_r.item())
+    r0 = dot_r_r.sqrt().item()
     i = 0
     while True:
         Ap = A(p)
-        alpha = dot_r_r / dot(p, Ap)
+        alpha = dot_r_z / dot(p, Ap)
         x = x + alpha * p  # alpha ~ 0.1 - 1
         i += 1
-        if i == n_iter:
-            return x
         r = r - alpha * Ap
-        dot_r_r_new = dot(r, r)
-        if dot_r_r_new <= tol:
-            return x
-        p = r + (dot_r_r_new / dot_r_r) * p
-        dot_r_r = dot_r_r_new
+        z = r if M is None else M(r)
+        dot_r_z_new = dot(r, z)
+        dot_r_r = dot_r_z_new if M is None else dot(r, r)
+        if i == n_iter or dot_r_r <= tol:
+            break
+        p = z + (dot_r_z_new / dot_r_z) * p
+        dot_r_z = dot_r_z_new
+    logging.debug(
+        "cg: %d iterations, relative residual = %.3e", i, dot_r_r.sqrt().item() / r0
+    )
+    return x
 
 
 def psf_reconstruction(
@@ -266,25 +301,7 @@ def srr_update(
         g[cmap_mask] /= cmap[cmap_mask]
     reconstructed = F.relu(volume + alpha * g, True)
 
-    g = torch.zeros_like(volume)
-    D, H, W = volume.shape[-3:]
-    v0 = volume[:, :, 1 : D - 1, 1 : H - 1, 1 : W - 1]
-    r0 = reconstructed[:, :, 1 : D - 1, 1 : H - 1, 1 : W - 1]
-    for dx in [-1, 0, 1]:
-        for dy in [-1, 0, 1]:
-            for dz in [-1, 0, 1]:
-                if dx == 0 and dy == 0 and dz == 0:
-                    continue
-                v1 = volume[
-                    :, :, 1 + dz : D - 1 + dz, 1 + dy : H - 1 + dy, 1 + dx : W - 1 + dx
-                ]
-                r1 = reconstructed[
-                    :, :, 1 + dz : D - 1 + dz, 1 + dy : H - 1 + dy, 1 + dx : W - 1 + dx
-                ]
-                d2 = dx * dx + dy * dy + dz * dz
-                dv2 = (v1 - v0) ** 2
-                b = 1 / (d2 * torch.sqrt(1 + 1 / (d2 * delta * delta) * dv2))
-                g[:, :, 1 : D - 1, 1 : H - 1, 1 : W - 1] += b * (r1 - r0)
+    g = edge_preserving_regularization(volume, reconstructed, delta)
     if p is not None:
         g *= cmap_mask
     reconstructed.add_(g, alpha=alpha * beta)
@@ -292,6 +309,128 @@ def srr_update(
     return cast(Volume, Volume.like(v, reconstructed[0, 0], deep=False))
 
 
+def srr_cg_update(
+    e: Stack,
+    v: Volume,
+    p: Optional[Union[Stack, torch.Tensor]],
+    beta: float,
+    delta: float,
+    use_mask: bool = False,
+    psf: Optional[torch.Tensor] = None,
+    n_iter: int = 5,
+    rtol: float = 0.1,
+) -> Volume:
+    """
+    solve the SRR problem linearized at v for the update d of the volume,
+        (A^T P A - lambda R) d = A^T P e + lambda R v,
+    where R is the edge-preserving regularization with the weights of v and
+    lambda = beta * mean(A^T p), so that its fixed point matches srr_update.
+    It uses CG warm-started from v (d = 0) with a Jacobi preconditioner,
+    A^T p + lambda * sum_n 1 / |n|^2, and stops when the residual is reduced
+    by rtol.
+    """
+    err = e.slices
+    volume = v.image[None, None]
+    if p is None:
+        p = torch.ones_like(err)
+    elif isinstance(p, Stack):
+        p = p.slices
+
+    transforms, res_s, res_r, s_thick, psf = _parse_stack_volume(e, v, psf)
+    slices_mask = e.mask if use_mask else None
+    vol_mask = v.mask[None, None] if use_mask else None
+
+    def A(x: torch.Tensor) -> torch.Tensor:
+        return slice_acquisition(
+            transforms,
+            x,
+            vol_mask,
+            slices_mask,
+            psf,
+            err.shape[-2:],
+            res_s / res_r,
+            False,
+            False,
+        )
+
+    def At(y: torch.Tensor) -> torch.Tensor:
+        return slice_acquisition_adjoint(
+            transforms,
+            psf,
+            y,
+            slices_mask,
+            vol_mask,
+            v.shape,
+            res_s / res_r,
+            False,
+            False,
+        )
+
+    cmap = At(p)
+    cmap_mask = cmap > 0
+    if not cmap_mask.any():
+        return v
+    lam = beta * cmap[cmap_mask].mean()
+    diag_inv = torch.where(cmap_mask, 1 / (cmap + lam * _REG_DIAG), 0)
+
+    def AtA(d: torch.Tensor) -> torch.Tensor:
+        Ad = At(p * A(d)) - lam * edge_preserving_regularization(volume, d, delta)
+        return Ad * cmap_mask
+
+    b = At(p * err) + lam * edge_preserving_regularization(volume, volume, delta)
+    d = cg(AtA, b * cmap_mask, None, n_iter, M=lambda r: r * diag_inv, rtol=rtol)
+    reconstructed = F.relu(volume + d, True)
+    return cast(Volume, Volume.like(v, reconstructed[0, 0], deep=False))
+
+
+def edge_preserving_regularization(
+    volume: torch.Tensor,
+    reconstructed: torch.Tensor,
+    delta: float,
+    slab_size: Optional[int] = None,
+) -> torch.Tensor:
+    """
+    g(x) = sum_n b_n(x) * (r(x + n) - r(x)) over the 26 neighbours n of each
+    interior voxel x, where b_n(x) = 1 / (|n|^2 sqrt(1 + dv^2 / (|n|^2 delta^2)))
+    and dv = v(x + n) - v(x). b is symmetric in the pair (x, x + n), so each pair
+    is visited once (13 offsets) and its flux is added to both ends. The volume
+    is processed in slabs along z to bound the temporary memory.
+    """
+    D, H, W = volume.shape[-3:]
+    g = torch.zeros_like(volume)
+    if slab_size is None:
+        slab_size = max(1, SRR_SLAB_VOXELS // (H * W))
+    for z0 in range(1, D - 1, slab_size):
+        z1 = min(z0 + slab_size, D - 1)
+        # slab with a halo of one voxel
+        v = volume[:, :, z0 - 1 : z1 + 1]
+        r = reconstructed[:, :, z0 - 1 : z1 + 1]
+        g_slab = torch.zeros_like(v)
+        for offset in _HALF_NEIGHBOURS:
+            d2 = sum(o * o for o in offset)
+            x, y = _pair_slices(v.shape[-3:], offset)
+            b = v[y] - v[x]
+            b.square_().mul_(1 / (d2 * delta * delta)).add_(1).sqrt_()
+            b.mul_(d2).reciprocal_()
+            b.mul_(r[y] - r[x])
+            g_slab[x] += b
+            g_slab[y] -= b
+        g[:, :, z0:z1, 1 : H - 1, 1 : W - 1] = g_slab[:, :, 1:-1, 1 : H - 1, 1 : W - 1]
+    return g
+
+
+def _pair_slices(
+    shape: Tuple[int, ...], offset: Tuple[int, ...]
+) -> Tuple[Tuple[slice, ...], Tuple[slice, ...]]:
+    # slices of the voxels x and x + offset for all pairs inside the volume
+    x = [slice(None), slice(None)]
+    y = [slice(None), slice(None)]
+    for n, o in zip(shape, offset):
+        x.append(slice(max(0, -o), n - max(0, o)))
+        y.append(slice(max(0, o), n - max(0, -o)))
+    return tuple(x), tuple(y)
+
+
 def simulate_slices(
     slices: Stack,
     volume: Volume,
@@ -1,4 +1,7 @@
 import types
+import copy
+import atexit
+import logging
 from typing import Dict, Any, Tuple, Callable, Union, cast, Optional, List
 import numpy as np
 import torch
@@ -6,7 +9,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from ..transform import RigidTransform, axisangle2mat, mat_update_resolution
 from ..utils import ncc_loss, gaussian_blur, meshgrid, resample
-from ..slice_acquisition import slice_acquisition
+from ..slice_acquisition import slice_acquisition, no_cache, set_cache_budget
 from ..image import Volume, Stack
 
 
@@ -19,14 +22,27 @@ class Registration(nn.Module):
         max_iter: int = 20,
         optimizer: Optional[Dict[str, Any]] = None,
         loss: Optional[Union[Dict[str, Any], Callable]] = None,
+        auto_grad: bool = False,
     ) -> None:
         super().__init__()
+        # arguments to rebuild the module in other processes
+        self.init_kwargs = dict(
+            num_levels=num_levels,
+            num_steps=num_steps,
+            step_size=step_size,
+            max_iter=max_iter,
+            optimizer=copy.deepcopy(optimizer),
+            loss=copy.deepcopy(loss) if isinstance(loss, dict) else loss,
+            auto_grad=auto_grad,
+        )
         self.num_levels = num_levels
         self.current_level = self.num_levels - 1
         self.num_steps = [num_steps] * self.num_levels
         self.step_sizes = [step_size * 2**level for level in range(num_levels)]
         self.max_iter = max_iter
-        self.auto_grad = False
+        # exact gradient with autograd (one forward + backward)
+        # or central finite differences (12 extra forwards)
+        self.auto_grad = auto_grad
         self._degree2rad = torch.tensor(
             [np.pi / 180, np.pi / 180, np.pi / 180, 1, 1, 1],
         ).view(1, 6)
@@ -63,6 +79,11 @@ class Registration(nn.Module):
         if optimizer["name"] == "gd":
             if "momentum" not in optimizer:
                 optimizer["momentum"] = 0
+        elif optimizer["name"] == "lbfgs":
+            if "history" not in optimizer:
+                optimizer["history"] = 5
+        else:
+            raise Exception("unknown optimizer")
         self.optimizer = optimizer
 
     def degree2rad(self, theta: torch.Tensor) -> torch.Tensor:
@@ -132,6 +153,8 @@ class Registration(nn.Module):
         num_steps: int,
         step_size: float,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
+        if self.optimizer["name"] == "lbfgs":
+            return self.lbfgs(theta, source, target, num_steps, step_size)
         for _ in range(num_steps):
             theta, loss = self.step(theta, source, target, step_size)
             step_size /= 2
@@ -165,6 +188,128 @@ class Registration(nn.Module):
 
         return theta, loss_all.detach()
 
+    def lbfgs(
+        self,
+        theta: torch.Tensor,
+        source: torch.Tensor,
+        target: torch.Tensor,
+        num_steps: int,
+        step_size: float,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        L-BFGS on the parameters of each slice/volume independently, with a
+        backtracking line search that halves the step at most num_steps times.
+        If the line search fails, the history of the slice is cleared and it
+        restarts from steepest descent, a slice is deactivated once a steepest
+        descent step fails.
+        """
+        n = theta.shape[0]
+        self.activate_idx = torch.ones(n, device=theta.device, dtype=torch.bool)
+        theta = theta.detach().clone()
+        # finite difference step for the gradient (unused by autograd)
+        fd_step = step_size / 2
+        loss_all, grad = self._grad_active(theta, source, target, fd_step)
+        history: List[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]] = []
+        gamma = torch.zeros_like(theta[:, :1])
+        restart = torch.ones_like(self.activate_idx)
+        for _ in range(self.max_iter):
+            with torch.no_grad():
+                # the first step has a length of step_size, the same as gd
+                gamma[restart] = step_size / (
+                    torch.linalg.norm(grad[restart], dim=-1, keepdim=True) + 1e-6
+                )
+                for _, _, rho in history:
+                    rho[restart] = 0
+                active = self.activate_idx.clone()
+                g = grad[active]
+                direction = -self.lbfgs_direction(
+                    g, gamma[active], [[h[active] for h in hs] for hs in history]
+                )
+                sd = restart[active] | ((direction * g).sum(-1) >= 0)
+                direction[sd] = -gamma[active][sd] * g[sd]
+                # backtracking line search on the pending slices
+                alpha = torch.ones_like(g[:, :1])
+                accepted = torch.zeros_like(sd)
+                loss_new = loss_all[active].clone()
+                for _ in range(num_steps):
+                    self.activate_idx[active] = ~accepted
+                    theta_a, source_a, target_a = self.activate_set(
+                        theta, source, target
+                    )
+                    loss_a = self.evaluate(
+                        theta_a + alpha[~accepted] * direction[~accepted],
+                        source_a,
+                        target_a,
+                    )
+                    idx_new = loss_a + 1e-4 < loss_all[self.activate_idx]
+                    loss_new[~accepted] = torch.where(
+                        idx_new, loss_a, loss_new[~accepted]
+                    )
+                    accepted[~accepted] = idx_new
+                    if accepted.all():
+                        break
+                    alpha[~accepted] /= 2
+                restart[:] = False
+                restart[active] = ~accepted & ~sd
+                self.activate_idx[active] = accepted
+                if not torch.any(self.activate_idx):
+                    if torch.any(restart):
+                        self.activate_idx = restart.clone()
+                        continue
+                    break
+                s = torch.zeros_like(theta)
+                s[self.activate_idx] = (alpha * direction)[accepted]
+                theta += s
+                loss_all[self.activate_idx] = loss_new[accepted]
+            _, grad_new = self._grad_active(theta, source, target, fd_step)
+            with torch.no_grad():
+                y = torch.zeros_like(theta)
+                y[self.activate_idx] = grad_new - grad[self.activate_idx]
+                grad[self.activate_idx] = grad_new
+                sy = (s * y).sum(-1, keepdim=True)
+                curvature = sy > 1e-10
+                # pairs without positive curvature are skipped with rho = 0
+                rho = torch.where(curvature, 1 / sy, torch.zeros_like(sy))
+                gamma = torch.where(
+                    curvature, sy / (y * y).sum(-1, keepdim=True), gamma
+                )
+                history.append((s, y, rho))
+                history = history[-self.optimizer["history"] :]
+                self.activate_idx |= restart
+        return theta, loss_all
+
+    def lbfgs_direction(
+        self,
+        grad: torch.Tensor,
+        gamma: torch.Tensor,
+        history: List[List[torch.Tensor]],
+    ) -> torch.Tensor:
+        # two-loop recursion, batched over slices
+        q = grad.clone()
+        alphas = []
+        for s, y, rho in reversed(history):
+            a = rho * (s * q).sum(-1, keepdim=True)
+            q -= a * y
+            alphas.append(a)
+        r = gamma * q
+        for (s, y, rho), a in zip(history, reversed(alphas)):
+            b = rho * (y * r).sum(-1, keepdim=True)
+            r += s * (a - b)
+        return r
+
+    def _grad_active(
+        self,
+        theta: torch.Tensor,
+        source: torch.Tensor,
+        target: torch.Tensor,
+        step_size: float,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        theta_a, source_a, target_a = self.activate_set(theta, source, target)
+        if self.auto_grad:
+            theta_a.requires_grad_()
+        loss, grad = self.grad(theta_a, source_a, target_a, step_size)
+        return loss.detach(), grad.detach()
+
     def activate_set(
         self, theta: torch.Tensor, source: torch.Tensor, target: torch.Tensor
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
@@ -405,17 +550,19 @@ class SliceToVolumeRegistration(Registration):
             slices = slices * slices_mask
         else:
             slices_mask = None
-        warpped = slice_acquisition(
-            transforms,
-            volume,
-            self.volume_mask,
-            slices_mask,
-            self.psf,
-            slices.shape[-2:],
-            self.res_s * (2**self.current_level) / self.res_v,
-            False,
-            False,
-        )
+        # the transformations change in every evaluation, caching is useless
+        with no_cache():
+            warpped = slice_acquisition(
+                transforms,
+                volume,
+                self.volume_mask,
+                slices_mask,
+                self.psf,
+                slices.shape[-2:],
+                self.res_s * (2**self.current_level) / self.res_v,
+                False,
+                False,
+            )
         return warpped, slices
 
     def forward(
@@ -423,6 +570,7 @@ class SliceToVolumeRegistration(Registration):
         stack: Stack,
         volume: Volume,
         use_mask: bool = False,
+        n_proc: int = 1,
     ) -> Tuple[RigidTransform, torch.Tensor]:
         eps = 1e-3
         assert (
@@ -444,15 +592,110 @@ class SliceToVolumeRegistration(Registration):
         self.volume_mask = volume.mask[None, None] if use_mask else None
         self.slices_mask = stack.mask if use_mask else None
 
-        theta, loss = self.forward_tensor(
-            theta, volume.image[None, None], stack.slices, params
-        )
+        n_proc = min(n_proc, theta.shape[0])
+        if n_proc > 1 and theta.device.type == "cpu":
+            theta, loss = self.forward_sharded(
+                theta, volume.image[None, None], stack.slices, params, n_proc
+            )
+        else:
+            theta, loss = self.forward_tensor(
+                theta, volume.image[None, None], stack.slices, params
+            )
 
         transform_out = RigidTransform(theta, trans_first=self.trans_first)
         transform_out = volume_transform.compose(transform_out)
 
         return transform_out, loss
 
+    def forward_sharded(
+        self,
+        theta: torch.Tensor,
+        source: torch.Tensor,
+        target: torch.Tensor,
+        params: Dict[str, Any],
+        n_proc: int,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # slices are registered independently, so they are split into shards
+        # that are registered in a pool of processes sharing the volume
+        shards = torch.tensor_split(torch.arange(theta.shape[0]), n_proc)
+        source = source.contiguous().share_memory_()
+        if self.volume_mask is not None:
+            self.volume_mask = self.volume_mask.contiguous().share_memory_()
+        args = [
+            (
+                self.init_kwargs,
+                theta[idx],
+                source,
+                target[idx],
+                self.volume_mask,
+                self.slices_mask[idx] if self.slices_mask is not None else None,
+                params,
+            )
+            for idx in shards
+        ]
+        results = registration_pool(n_proc).starmap(_register_shard, args)
+        return (
+            torch.cat([r[0] for r in results]),
+            torch.cat([r[1] for r in results]),
+        )
+
+
+# pool of processes for forward_sharded, it is started on first use and reused
+# by later calls (e.g., in all outer iterations of SVR) to avoid the start-up cost
+_pool: Optional[Any] = None
+_pool_n_proc = 0
+
+
+def registration_pool(n_proc: int) -> Any:
+    global _pool, _pool_n_proc
+    if _pool is not None and _pool_n_proc != n_proc:
+        close_registration_pool()
+    if _pool is None:
+        n_threads = max(1, torch.get_num_threads() // n_proc)
+        logging.debug(
+            "slice-to-volume registration with %d processes x %d threads",
+            n_proc,
+            n_threads,
+        )
+        ctx = torch.multiprocessing.get_context("spawn")
+        _pool = ctx.Pool(n_proc, _init_worker, (n_threads,))
+        _pool_n_proc = n_proc
+    return _pool
+
+
+def _init_worker(n_threads: int) -> None:
+    torch.set_num_threads(n_threads)
+    # the workers only run registration, whose operators are never reused
+    set_cache_budget(0)
+
+
+def close_registration_pool() -> None:
+    """shut down the process pool of forward_sharded (if started)"""
+    global _pool, _pool_n_proc
+    if _pool is not None:
+        _pool.close()
+        _pool.join()
+        _pool = None
+        _pool_n_proc = 0
+
+
+atexit.register(close_registration_pool)
+
+
+def _register_shard(
+    init_kwargs: Dict[str, Any],
+    theta: torch.Tensor,
+    source: torch.Tensor,
+    target: torch.Tensor,
+    volume_mask: Optional[torch.Tensor],
+    slices_mask: Optional[torch.Tensor],
+    params: Dict[str, Any],
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    svr = SliceToVolumeRegistration(**init_kwargs)
+    svr.volume_mask = volume_mask
+    svr.slices_mask = slices_mask
+    return svr.forward_tensor(theta, source, target, params)
+
 
 def stack_registration(
     source_stacks: List[List[Stack]],
@@ -7,8 +7,14 @@ from .misc import (
     meshgrid,
     gaussian_blur,
     MovingAverage,
+    ConvergenceMonitor,
+)
+from .psf import (
+    get_PSF,
+    resolution2sigma,
+    psf_quadrature,
+    GAUSS_HERMITE_MAX_SAMPLES,
 )
-from .psf import get_PSF, resolution2sigma
 from .logger import (
     log_params,
     log_args,
@@ -18,4 +24,5 @@ from .logger import (
     TrainLogger,
     LogIO,
 )
+from .profiler import TrainProfiler
 from .types import PathType, DeviceType
@@ -69,7 +69,7 @@ def log_args(args: Namespace) -> None:
 _initialized = False
 
 
-def setup_logger(filename: Optional[str], verbose: int) -> None:
+def setup_logger(filename: Optional[str], verbose: int, mode: str = "w") -> None:
     global _initialized
     if _initialized:
         return
@@ -89,7 +89,7 @@ def setup_logger(filename: Optional[str], verbose: int) -> None:
     )
 
     if filename:
-        file_handler = logging.FileHandler(filename, mode="w")
+        file_handler = logging.FileHandler(filename, mode=mode)
         file_handler.setFormatter(log_formatter)
         handlers.append(file_handler)
 
@@ -1,7 +1,10 @@
 from typing import Optional
 import torch
 import torch.nn.functional as F
-from .misc import gaussian_blur
+from .misc import gaussian_kernels, separable_filter
+
+# window size from which box_filter uses cumulative sums instead of a dense kernel
+BOX_FILTER_CUMSUM_WIN = 7
 
 
 def ncc_loss(
@@ -45,16 +48,9 @@ def ncc_loss(
 
         win = 2 * int(win / 2**level / 2) + 1
 
-        mean_filt = torch.ones([1, 1] + [win] * spatial_dims, device=I.device) / (
-            win**spatial_dims
-        )
-        conv_fn = [F.conv1d, F.conv2d, F.conv3d][spatial_dims - 1]
-
-        I_mean = conv_fn(I, mean_filt, stride=1, padding=win // 2)
-        J_mean = conv_fn(J, mean_filt, stride=1, padding=win // 2)
-        I2_mean = conv_fn(I * I, mean_filt, stride=1, padding=win // 2)
-        J2_mean = conv_fn(J * J, mean_filt, stride=1, padding=win // 2)
-        IJ_mean = conv_fn(I * J, mean_filt, stride=1, padding=win // 2)
+        # the five local moments are filtered together
+        moments = box_filter(torch.cat((I, J, I * I, J * J, I * J), 1), win)
+        I_mean, J_mean, I2_mean, J2_mean, IJ_mean = moments.split(1, 1)
 
     cross = IJ_mean - I_mean * J_mean
     I_var = I2_mean - I_mean * I_mean
@@ -73,6 +69,53 @@ def ncc_loss(
             return -cc.view(-1, c, *I.shape[2:])
 
 
+def box_filter(x: torch.Tensor, win: int, method: str = "auto") -> torch.Tensor:
+    """
+    mean filter over a win^d window with zero padding on each channel of x.
+    method:
+        dense: a win^d kernel, O(win^d) per voxel
+        separable: 1D kernels along each dimension, O(d * win) per voxel
+        cumsum: differences of cumulative sums, O(d) per voxel
+        auto: dense for win < BOX_FILTER_CUMSUM_WIN, otherwise cumsum
+    """
+    spatial_dims = len(x.shape) - 2
+    c = x.shape[1]
+    r = win // 2
+    if method == "auto":
+        if win == 1:
+            return x
+        method = "dense" if win < BOX_FILTER_CUMSUM_WIN else "cumsum"
+    if method == "dense":
+        conv_fn = [F.conv1d, F.conv2d, F.conv3d][spatial_dims - 1]
+        k = torch.full(
+            [c, 1] + [win] * spatial_dims,
+            1 / win**spatial_dims,
+            dtype=x.dtype,
+            device=x.device,
+        )
+        return conv_fn(x, k, padding=r, groups=c)
+    elif method == "separable":
+        conv_fn = [F.conv1d, F.conv2d, F.conv3d][spatial_dims - 1]
+        for d in range(spatial_dims):
+            s = [c, 1] + [1] * spatial_dims
+            s[d + 2] = win
+            k = torch.full(s, 1 / win, dtype=x.dtype, device=x.device)
+            padding = [0] * spatial_dims
+            padding[d] = r
+            x = conv_fn(x, k, padding=padding, groups=c)
+        return x
+    elif method == "cumsum":
+        for d in range(2, spatial_dims + 2):
+            n = x.shape[d]
+            # one extra leading zero so that y[i] = cs[i + win] - cs[i]
+            pad = [0, 0] * (len(x.shape) - d - 1) + [r + 1, r]
+            cs = F.pad(x, pad).cumsum(d)
+            x = cs.narrow(d, win, n) - cs.narrow(d, 0, n)
+        return x / win**spatial_dims
+    else:
+        raise ValueError(f"Unknown box filter method: <{method}>!")
+
+
 def ssim_loss(
     I: torch.Tensor,
     J: torch.Tensor,
@@ -95,16 +138,18 @@ def ssim_loss(
     truncated = win / 2 / sigma - 0.5
     compensation = 1.0
 
-    mu1 = gaussian_blur(I, sigma, truncated)
-    mu2 = gaussian_blur(J, sigma, truncated)
+    # blur the five local moments in one separable pass
+    kernels = gaussian_kernels((sigma,) * spatial_dims, truncated, I.device, I.dtype)
+    moments = separable_filter(torch.cat((I, J, I * I, J * J, I * J), 1), kernels)
+    mu1, mu2, I2_mean, J2_mean, IJ_mean = moments.chunk(5, 1)
 
     mu1_sq = mu1.pow(2)
     mu2_sq = mu2.pow(2)
     mu1_mu2 = mu1 * mu2
 
-    sigma1_sq = compensation * (gaussian_blur(I * I, sigma, truncated) - mu1_sq)
-    sigma2_sq = compensation * (gaussian_blur(J * J, sigma, truncated) - mu2_sq)
-    sigma12 = compensation * (gaussian_blur(I * J, sigma, truncated) - mu1_mu2)
+    sigma1_sq = compensation * (I2_mean - mu1_sq)
+    sigma2_sq = compensation * (J2_mean - mu2_sq)
+    sigma12 = compensation * (IJ_mean - mu1_mu2)
 
     cs_map = (2 * sigma12 + C2) / (sigma1_sq + sigma2_sq + C2)  # set alpha=beta=gamma=1
     ssim_map = ((2 * mu1_mu2 + C1) / (mu1_sq + mu2_sq + C1)) * cs_map
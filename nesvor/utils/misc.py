@@ -1,13 +1,27 @@
-from typing import Dict, List, Any, Optional, Union, Collection, Iterable, Sequence
+from typing import (
+    Dict,
+    List,
+    Any,
+    Optional,
+    Union,
+    Collection,
+    Iterable,
+    Sequence,
+    Tuple,
+)
 import torch
 import torch.nn.functional as F
 import collections
+import functools
 from argparse import Namespace
 import os
 import random
 import numpy as np
 from .types import DeviceType
 
+# kernel length from which separable_filter uses FFT instead of convolution
+FFT_FILTER_TAPS = 25
+
 
 def set_seed(seed: Optional[int]) -> None:
     if seed is not None:
@@ -99,19 +113,60 @@ def gaussian_blur(
     spatial_dims = len(x.shape) - 2
     if not isinstance(sigma, collections.abc.Iterable):
         sigma = [sigma] * spatial_dims
-    kernels = [gaussian_1d_kernel(s, truncated, x.device) for s in sigma]
+    kernels = gaussian_kernels(
+        tuple(float(s) for s in sigma), float(truncated), x.device, x.dtype
+    )
+    return separable_filter(x, kernels)
+
+
+@functools.lru_cache(maxsize=64)
+def gaussian_kernels(
+    sigma: Tuple[float, ...],
+    truncated: float,
+    device: torch.device,
+    dtype: torch.dtype = torch.float32,
+) -> Tuple[torch.Tensor, ...]:
+    # 1D kernels shaped for a convolution along each spatial dimension
+    spatial_dims = len(sigma)
+    kernels = []
+    for d, s in enumerate(sigma):
+        shape = [1] * (spatial_dims + 2)
+        shape[d + 2] = -1
+        k = gaussian_1d_kernel(s, truncated, device).to(dtype)
+        kernels.append(k.reshape(shape))
+    return tuple(kernels)
+
+
+def separable_filter(
+    x: torch.Tensor, kernels: Sequence[torch.Tensor]
+) -> torch.Tensor:
+    # filter all channels of x at once, kernels are from gaussian_kernels,
+    # long kernels are applied in the frequency domain
+    spatial_dims = len(x.shape) - 2
     c = x.shape[1]
     conv_fn = [F.conv1d, F.conv2d, F.conv3d][spatial_dims - 1]
-    for d in range(spatial_dims):
-        s = [1] * len(x.shape)
-        s[d + 2] = -1
-        k = kernels[d].reshape(s).repeat(*([c, 1] + [1] * spatial_dims))
+    for d, k in enumerate(kernels):
+        if k.numel() >= FFT_FILTER_TAPS:
+            x = _fft_filter_1d(x, k, d + 2)
+            continue
         padding = [0] * spatial_dims
-        padding[d] = (k.shape[d + 2] - 1) // 2
-        x = conv_fn(x, k, padding=padding, groups=c)
+        padding[d] = (k.numel() - 1) // 2
+        x = conv_fn(x, k.expand(c, *k.shape[1:]), padding=padding, groups=c)
     return x
 
 
+def _fft_filter_1d(x: torch.Tensor, k: torch.Tensor, dim: int) -> torch.Tensor:
+    # linear convolution with a symmetric kernel along dim, same as zero padding
+    n = x.shape[dim]
+    n_fft = n + k.numel() - 1
+    x_f = torch.fft.rfft(x, n=n_fft, dim=dim)
+    k_f = torch.fft.rfft(k.flatten(), n=n_fft)
+    shape = [1] * len(x.shape)
+    shape[dim] = -1
+    y = torch.fft.irfft(x_f * k_f.view(shape), n=n_fft, dim=dim)
+    return y.narrow(dim, (k.numel() - 1) // 2, n)
+
+
 # from MONAI
 def gaussian_1d_kernel(
     sigma: float, truncated: float, device: DeviceType
@@ -178,3 +233,53 @@ class MovingAverage:
             return [self._value[key][0]] + values
         else:
             return values
+
+
+class ConvergenceMonitor:
+    """
+    check whether a loss stops improving, i.e., the relative improvement of its
+    mean over the last `window` iterations (compared with the mean over the
+    previous `window` iterations) is less than `tol`
+    """
+
+    def __init__(self, window: int, tol: float) -> None:
+        assert window > 0
+        self.window = window
+        self.tol = tol
+        self.reset()
+
+    def reset(self) -> None:
+        self._ref: Optional[float] = None
+        self._sum = 0.0
+        self._count = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "window": self.window,
+            "tol": self.tol,
+            "ref": self._ref,
+            "sum": self._sum,
+            "count": self._count,
+        }
+
+    def from_dict(self, d: Dict) -> None:
+        self.window = d["window"]
+        self.tol = d["tol"]
+        self._ref = d["ref"]
+        self._sum = d.get("sum", 0.0)
+        self._count = d.get("count", 0)
+
+    def __call__(self, value: float) -> bool:
+        # value is the loss of a single iteration, averaged over each window
+        self._sum += value
+        self._count += 1
+        if self._count < self.window:
+            return False
+        mean = self._sum / self._count
+        self._sum, self._count = 0.0, 0
+        if self._ref is None:
+            self._ref = mean
+            return False
+        improvement = (self._ref - mean) / max(abs(self._ref), 1e-8)
+        self._ref = mean
+        return improvement < self.tol
@@ -0,0 +1,150 @@
+from typing import Dict, List, Any, Optional
+import contextlib
+import json
+import logging
+import os
+import time
+import torch
+from .types import PathType, DeviceType
+from .misc import makedirs
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None  # type: ignore
+
+
+class TrainProfiler:
+    """
+    per-phase wall/CPU time and peak memory of the training loop, aggregated
+    over windows of `window` iterations. The first `trace_iters` iterations
+    (after one warm-up iteration) are also recorded with torch.profiler and
+    exported as a Chrome trace. A disabled profiler only returns a no-op
+    context in `phase` and does nothing in `step`.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        window: int = 100,
+        trace_path: Optional[PathType] = None,
+        trace_iters: int = 0,
+        device: DeviceType = "cpu",
+        start_iter: int = 1,
+    ) -> None:
+        self.enabled = enabled
+        self.start_iter = start_iter
+        self.window = max(1, window)
+        self.device = torch.device(device)
+        self.cuda = self.device.type == "cuda"
+        self.windows: List[Dict[str, Any]] = []
+        self._stack: List[str] = []
+        self._reset_window()
+        self._torch_profiler: Optional[torch.profiler.profile] = None
+        if enabled and trace_path and trace_iters > 0:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            trace_path = str(trace_path)
+            self._torch_profiler = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(
+                    wait=0, warmup=1, active=trace_iters, repeat=1
+                ),
+                on_trace_ready=lambda p: p.export_chrome_trace(trace_path),
+            )
+            self._torch_profiler.start()
+
+    def _reset_window(self) -> None:
+        self._n_iter = 0
+        self._wall: Dict[str, float] = dict()
+        self._cpu: Dict[str, float] = dict()
+        self._start_iter = self.start_iter + sum(w["n_iter"] for w in self.windows)
+        if self.enabled and self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def _sync(self) -> None:
+        # wait for the queued kernels so that they are timed in the right phase
+        if self.cuda:
+            torch.cuda.synchronize(self.device)
+
+    def phase(self, name: str):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._phase(name)
+
+    @contextlib.contextmanager
+    def _phase(self, name: str):
+        # nested phases are named as parent/child
+        if self._stack:
+            name = self._stack[-1] + "/" + name
+        self._stack.append(name)
+        self._sync()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            with torch.profiler.record_function(name):
+                yield
+                self._sync()
+        finally:
+            self._wall[name] = self._wall.get(name, 0.0) + time.perf_counter() - wall
+            self._cpu[name] = self._cpu.get(name, 0.0) + time.process_time() - cpu
+            self._stack.pop()
+
+    def step(self) -> None:
+        """end of a training iteration"""
+        if not self.enabled:
+            return
+        if self._torch_profiler is not None:
+            self._torch_profiler.step()
+        self._n_iter += 1
+        if self._n_iter >= self.window:
+            self._end_window()
+
+    def _end_window(self) -> None:
+        if self._n_iter == 0:
+            return
+        n = self._n_iter
+        summary: Dict[str, Any] = {
+            "start_iter": self._start_iter,
+            "n_iter": n,
+            "wall_ms": {k: v / n * 1e3 for k, v in self._wall.items()},
+            "cpu_ms": {k: v / n * 1e3 for k, v in self._cpu.items()},
+        }
+        if self.cuda:
+            summary["peak_cuda_memory_mb"] = (
+                torch.cuda.max_memory_allocated(self.device) / 2**20
+            )
+        if resource is not None:
+            # peak resident memory of the process (KB on Linux)
+            summary["peak_rss_mb"] = (
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+            )
+        self.windows.append(summary)
+        logging.debug(
+            "profile of iter %d-%d (ms/iter): %s",
+            self._start_iter,
+            self._start_iter + n - 1,
+            ", ".join("%s %.2f" % kv for kv in summary["wall_ms"].items()),
+        )
+        self._reset_window()
+
+    def save(self, path: PathType) -> None:
+        """write the JSON summary of all windows (and stop the trace if running)"""
+        if not self.enabled:
+            return
+        self._end_window()
+        if self._torch_profiler is not None:
+            self._torch_profiler.stop()
+            self._torch_profiler = None
+        total: Dict[str, Dict[str, float]] = {"wall_ms": {}, "cpu_ms": {}}
+        n_iter = sum(w["n_iter"] for w in self.windows)
+        for w in self.windows:
+            for key in total:
+                for k, v in w[key].items():
+                    total[key][k] = total[key].get(k, 0.0) + v * w["n_iter"] / n_iter
+        makedirs(os.path.dirname(str(path)))
+        with open(path, "w") as f:
+            json.dump(
+                {"n_iter": n_iter, "mean": total, "windows": self.windows}, f, indent=2
+            )
+        logging.info("training profile saved to %s", path)
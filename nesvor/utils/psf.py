@@ -1,10 +1,14 @@
 from typing import List, Tuple, Optional, Callable, Union
 import torch
-from math import log, sqrt
+import numpy as np
+from math import log, sqrt, pi
 from .types import DeviceType
 
 GAUSSIAN_FWHM = 1 / (2 * sqrt(2 * log(2)))
 SINC_FWHM = 1.206709128803223 * GAUSSIAN_FWHM
+# the Gauss-Hermite rule is only more accurate than Sobol/random sampling
+# for very few samples (2^3), larger rules are not supported
+GAUSS_HERMITE_MAX_SAMPLES = 8
 
 
 def resolution2sigma(rx, ry=None, rz=None, /, isotropic=False):
@@ -79,6 +83,45 @@ def get_PSF(
     return psf
 
 
+def psf_quadrature(
+    n_samples: int,
+    method: str = "sobol",
+    device: DeviceType = torch.device("cpu"),
+    dtype: torch.dtype = torch.float32,
+) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+    """
+    deterministic offsets (N x 3) for integrating a standard normal PSF,
+    the returned weights are None for equally weighted offsets.
+    method:
+        sobol: scrambled Sobol sequence mapped by the inverse normal CDF
+        gauss-hermite: tensor product of 1D Gauss-Hermite rules, N is rounded to k^3,
+            N <= GAUSS_HERMITE_MAX_SAMPLES
+    """
+    if method == "sobol":
+        engine = torch.quasirandom.SobolEngine(3, scramble=True, seed=0)
+        u = engine.draw(n_samples, dtype=torch.float64)
+        u = u.clamp(1e-6, 1 - 1e-6)
+        offsets = sqrt(2) * torch.erfinv(2 * u - 1)
+        weights = None
+    elif method == "gauss-hermite":
+        if n_samples > GAUSS_HERMITE_MAX_SAMPLES:
+            raise ValueError(
+                "Gauss-Hermite PSF quadrature supports at most %d samples, got %d"
+                % (GAUSS_HERMITE_MAX_SAMPLES, n_samples)
+            )
+        k = max(1, round(n_samples ** (1 / 3)))
+        x, w = np.polynomial.hermite.hermgauss(k)
+        x = torch.tensor(x * sqrt(2))
+        w = torch.tensor(w / sqrt(pi))
+        grid_z, grid_y, grid_x = torch.meshgrid(x, x, x, indexing="ij")
+        offsets = torch.stack((grid_x, grid_y, grid_z), -1).view(-1, 3)
+        weights = (w[:, None, None] * w[None, :, None] * w[None, None, :]).view(-1)
+        weights = weights.to(device=device, dtype=dtype)
+    else:
+        raise TypeError(f"Unknown PSF quadrature: <{method}>!")
+    return offsets.to(device=device, dtype=dtype), weights
+
+
 # class PSF:
 #     def __init__(
 #         self,
@@ -0,0 +1,59 @@
+"""
+benchmark of the pytorch hash grid encoding against the per-level implementation
+usage: python -m tests.inr.bench_hash_grid [batch size] [device]
+"""
+import sys
+import time
+import torch
+from nesvor.inr.hash_grid_torch import HashEmbedder
+from tests.inr.test_hash_grid import hash_grid_reference
+
+
+def timeit(f, n_iter=10):
+    f()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    t = time.time()
+    for _ in range(n_iter):
+        f()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.time() - t) / n_iter
+
+
+if __name__ == "__main__":
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 1024 * 16
+    device = sys.argv[2] if len(sys.argv) > 2 else "cpu"
+    embedder = HashEmbedder(
+        n_levels=12, log2_hashmap_size=19, base_resolution=16, per_level_scale=1.39
+    ).to(device)
+    tables = [
+        torch.empty(2**19, 2, device=device).uniform_(-1e-4, 1e-4).requires_grad_()
+        for _ in range(embedder.n_levels)
+    ]
+    embedder.load_state_dict(
+        {"box_offsets": embedder.box_offsets, "embeddings": torch.stack(tables)}
+    )
+    x = torch.rand(batch_size, 3, device=device)
+
+    def fwd_bwd(forward):
+        def f():
+            embedder.zero_grad()
+            for t in tables:
+                t.grad = None
+            forward(x).square().sum().backward()
+
+        return f
+
+    print(
+        "%d levels (%d dense), %d parameters"
+        % (embedder.n_levels, embedder.n_dense_levels, embedder.embeddings.numel())
+    )
+    for name, forward in [
+        ("per-level hashed", lambda x: hash_grid_reference(embedder, tables, x)),
+        ("packed", embedder),
+    ]:
+        with torch.no_grad():
+            t_fwd = timeit(lambda: forward(x))
+        t_bwd = timeit(fwd_bwd(forward))
+        print("%s: forward %.2f ms, forward+backward %.2f ms" % (name, t_fwd * 1e3, t_bwd * 1e3))
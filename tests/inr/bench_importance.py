@@ -0,0 +1,50 @@
+"""
+image quality vs number of training iterations with uniform and importance
+sampling of the training pixels
+usage: python -m tests.inr.bench_importance [device]
+"""
+import sys
+import time
+import torch
+from nesvor.cli.parsers import main_parser
+from nesvor.inr.train import train
+from tests.svort.bench_svr import phantom_slices
+
+
+def quality(model, gt):
+    # compare with the ground truth on the voxels of the phantom
+    with torch.no_grad():
+        xyz = gt.xyz_masked
+        v = torch.cat([model(x) for x in torch.split(xyz, 4096)]).float()
+    v_gt = gt.image[gt.mask]
+    ncc = torch.corrcoef(torch.stack((v, v_gt)))[0, 1].item()
+    scale = (v * v_gt).sum() / (v * v).sum()
+    nrmse = (torch.linalg.norm(scale * v - v_gt) / torch.linalg.norm(v_gt)).item()
+    return ncc, nrmse
+
+
+if __name__ == "__main__":
+    device = torch.device(sys.argv[1] if len(sys.argv) > 1 else "cpu")
+    slices, gt = phantom_slices(device)
+    parser, _ = main_parser()
+    print("%-10s %6s %8s %8s" % ("sampling", "iter", "ncc", "nrmse"))
+    for n_iter in [250, 500, 1000, 2000]:
+        for importance in [False, True]:
+            torch.manual_seed(0)
+            args = parser.parse_args(
+                ["reconstruct", "--input-slices", "", "--single-precision"]
+            )
+            args.device = device
+            args.dtype = torch.float32
+            args.n_iter = n_iter
+            args.batch_size = 1024
+            args.n_samples = 32
+            args.importance_sampling = importance
+            t = time.time()
+            model, _, _ = train([s.clone() for s in slices], args)
+            t = time.time() - t
+            ncc, nrmse = quality(model, gt)
+            print(
+                "%-10s %6d %8.4f %8.4f %.1fs"
+                % ("importance" if importance else "uniform", n_iter, ncc, nrmse, t)
+            )
@@ -0,0 +1,62 @@
+"""
+step time of AdamW and LazyAdam for the hash grid tables
+usage: python -m tests.inr.bench_optim [batch size] [device]
+"""
+import sys
+import torch
+from nesvor.inr.hash_grid_torch import HashEmbedder
+from nesvor.inr.optim import LazyAdam
+from tests.inr.bench_hash_grid import timeit
+
+
+def build_step(sparse_grad, optimizer, batch_size, device):
+    torch.manual_seed(0)
+    embedder = HashEmbedder(
+        n_levels=16,
+        log2_hashmap_size=19,
+        base_resolution=16,
+        per_level_scale=1.39,
+        sparse_grad=sparse_grad,
+    ).to(device)
+    kwargs = dict(lr=5e-3, betas=(0.9, 0.99), eps=1e-15)
+    if optimizer == "adamw":
+        opt = torch.optim.AdamW(embedder.parameters(), weight_decay=1e-2, **kwargs)
+    else:
+        opt = LazyAdam(embedder.parameters(), weight_decay=1e-2, lazy=True, **kwargs)
+    x = torch.rand(batch_size, 3, device=device)
+    g = torch.randn(batch_size, embedder.n_levels * 2, device=device)
+
+    def backward():
+        opt.zero_grad()
+        (embedder(x) * g).sum().backward()
+
+    def step():
+        backward()
+        opt.step()
+
+    return embedder, backward, step
+
+
+if __name__ == "__main__":
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 1024 * 4
+    device = sys.argv[2] if len(sys.argv) > 2 else "cpu"
+    for name, sparse_grad, optimizer in [
+        ("AdamW", False, "adamw"),
+        ("LazyAdam (dense grad)", False, "lazy"),
+        ("LazyAdam (sparse grad)", True, "lazy"),
+    ]:
+        embedder, backward, step = build_step(
+            sparse_grad, optimizer, batch_size, device
+        )
+        t_bwd = timeit(backward)
+        t_step = timeit(step)
+        print(
+            "%-24s %d parameters: forward+backward %.2f ms, step %.2f ms, total %.2f ms"
+            % (
+                name,
+                embedder.embeddings.numel(),
+                t_bwd * 1e3,
+                (t_step - t_bwd) * 1e3,
+                t_step * 1e3,
+            )
+        )
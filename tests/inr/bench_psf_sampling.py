@@ -0,0 +1,50 @@
+"""
+convergence of the PSF integration during inference (random vs. deterministic)
+usage: python -m tests.inr.bench_psf_sampling [device]
+"""
+import sys
+import torch
+from nesvor.cli.parsers import main_parser
+from nesvor.inr.models import INR
+from nesvor.inr.sample import sample_points
+
+
+if __name__ == "__main__":
+    device = sys.argv[1] if len(sys.argv) > 1 else "cpu"
+    parser, _ = main_parser()
+    args = parser.parse_args(
+        ["reconstruct", "--input-slices", "", "--single-precision"]
+    )
+    args.dtype = torch.float32
+    torch.manual_seed(0)
+    bounding_box = torch.tensor([[-40.0, -40.0, -40.0], [40.0, 40.0, 40.0]])
+    model = INR(bounding_box, args).to(device)
+    with torch.no_grad():
+        for p in model.encoding.parameters():
+            p.uniform_(-1, 1)
+    model.eval()
+
+    resolution = 1.6
+    xyz = (torch.rand(4096, 3, device=device) - 0.5) * 60
+    # reference: mean of several large random-sampling runs
+    reference = sum(
+        sample_points(model, xyz, resolution, 64, 4096, "random") for _ in range(8)
+    ) / 8
+    methods = ["random", "sobol", "gauss-hermite"]
+    print("n_samples  " + "  ".join("%14s" % m for m in methods))
+    for n_samples in [8, 27, 64, 125, 216, 512]:
+        errors = []
+        for psf_sampling in methods:
+            if psf_sampling == "gauss-hermite" and n_samples > 8:
+                # only supported for small n (GAUSS_HERMITE_MAX_SAMPLES)
+                errors.append(float("nan"))
+                continue
+            n_repeat = 5 if psf_sampling == "random" else 1
+            mse = 0.0
+            for _ in range(n_repeat):
+                v = sample_points(
+                    model, xyz, resolution, 512, n_samples, psf_sampling
+                )
+                mse += (v - reference).pow(2).mean().item() / n_repeat
+            errors.append(mse**0.5 / reference.std().item())
+        print("%9d  " % n_samples + "  ".join("%14.2e" % e for e in errors))
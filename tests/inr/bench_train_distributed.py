@@ -0,0 +1,45 @@
+"""
+training time of data-parallel training with different numbers of processes
+usage: python -m tests.inr.bench_train_distributed [device]
+"""
+import sys
+import time
+import torch
+from nesvor.cli.parsers import main_parser
+from nesvor.inr.train import train
+from tests.svort.bench_svr import phantom_slices
+
+
+if __name__ == "__main__":
+    device = torch.device(sys.argv[1] if len(sys.argv) > 1 else "cpu")
+    slices, _ = phantom_slices(device)
+    parser, _ = main_parser()
+    if device.type == "cuda":
+        n_procs = [n for n in [1, 2, 4, 8] if n <= torch.cuda.device_count()]
+    else:
+        n_procs = [n for n in [1, 2, 4, 8] if n <= torch.get_num_threads()]
+    print("%-8s %8s %8s %8s" % ("n_proc", "time", "it/s", "speedup"))
+    for lazy_adam in [False, True]:
+        print("lazy adam: %s" % lazy_adam)
+        t1 = None
+        for n_proc in n_procs:
+            torch.manual_seed(0)
+            args = parser.parse_args(
+                ["reconstruct", "--input-slices", "", "--single-precision"]
+            )
+            args.device = device
+            args.dtype = torch.float32
+            args.n_iter = 500
+            args.batch_size = 1024 * n_proc  # fixed batch size per process
+            args.n_samples = 32
+            args.n_proc_train = n_proc
+            args.lazy_adam = lazy_adam
+            t = time.time()
+            train([s.clone() for s in slices], args)
+            t = time.time() - t
+            # speedup in the number of processed points per second
+            t1 = t if t1 is None else t1
+            print(
+                "%-8d %8.1f %8.1f %8.2f"
+                % (n_proc, t, args.n_iter / t, t1 * n_proc / t)
+            )
@@ -0,0 +1,108 @@
+from tests import TestCaseNeSVoR
+from nesvor.inr.data import PointDataset
+from nesvor.image import Slice
+import torch
+
+
+class TestData(TestCaseNeSVoR):
+    @staticmethod
+    def get_dataset_test_data(device="cuda"):
+        slices = []
+        for i in range(10):
+            image = torch.arange(1000, dtype=torch.float32).view(1, 25, 40).to(device)
+            slices.append(Slice(image + i * 1000, image >= 0, None, 1.0, 1.0, 3.0))
+        return slices
+
+    def test_get_batch(self):
+        slices = self.get_dataset_test_data()
+        for prefetch in [False, True]:
+            torch.manual_seed(0)
+            dataset = PointDataset(slices, prefetch=prefetch)
+            batches = [
+                dataset.get_batch(1000, slices[0].device)["v"] for _ in range(10)
+            ]
+            dataset.clear_prefetch()
+            if not prefetch:
+                self.assertEqual(dataset.epoch, 1)
+            # each point is sampled once per epoch
+            v = torch.cat(batches).sort().values
+            self.assert_tensor_equal(v, torch.arange(10000, device=v.device).float())
+            if prefetch:
+                self.assert_tensor_equal(torch.cat(batches), batches_no_prefetch)
+            else:
+                batches_no_prefetch = torch.cat(batches)
+
+    def test_shard(self):
+        # the shards of the processes in distributed training are disjoint
+        slices = self.get_dataset_test_data()
+        batches = []
+        for rank in range(3):
+            dataset = PointDataset(slices, rank=rank, world_size=3)
+            n = (10000 - rank + 2) // 3
+            batches.append(dataset.get_batch(n, slices[0].device)["v"])
+            self.assertEqual(dataset.epoch, 1)
+        v = torch.cat(batches).sort().values
+        self.assert_tensor_equal(v, torch.arange(10000, device=v.device).float())
+
+    def test_importance(self):
+        slices = self.get_dataset_test_data()
+        torch.manual_seed(0)
+        dataset = PointDataset(slices, importance=True, importance_uniform=0.5)
+        batch = dataset.get_batch(1000, slices[0].device)
+        # uniform sampling before any error is known
+        self.assert_tensor_close(batch["weight"], torch.ones_like(batch["weight"]))
+        # the first half of the points have large errors
+        idx = torch.arange(10000, device=batch["v"].device)
+        dataset.update_error(idx, (idx < 5000).float() * 9 + 1)
+        batch = dataset.get_batch(10000, slices[0].device)
+        ratio = (batch["idx"] < 5000).float().mean().item()
+        self.assertAlmostEqual(ratio, 0.5 * 0.5 + 0.5 * 0.9, delta=0.03)
+        # the importance weights keep the estimate of the mean unbiased
+        mean = (batch["v"] * batch["weight"]).mean() / dataset.v.mean()
+        self.assertAlmostEqual(mean.item(), 1.0, delta=0.05)
+        # the uniform part bounds the importance weights
+        for importance_uniform in [0.0, 1.5]:
+            with self.assertRaises(ValueError):
+                PointDataset(
+                    slices, importance=True, importance_uniform=importance_uniform
+                )
+
+    def test_importance_large(self):
+        # per-point sampling frequencies with millions of points, where p of
+        # a point is only a few float32 ulps of the CDF
+        slices = []
+        for _ in range(8):
+            image = torch.rand((1, 512, 512), device="cuda") + 1
+            slices.append(Slice(image, image > 0, None, 1.0, 1.0, 3.0))
+        torch.manual_seed(0)
+        dataset = PointDataset(slices, importance=True, importance_uniform=0.01)
+        n = dataset.v.numel()
+        dataset.get_batch(1, slices[0].device)
+        # 64 points have half of the total error
+        idx = torch.arange(n, device=slices[0].device)
+        high = torch.randperm(n, device=idx.device)[:64]
+        error = torch.ones(n, device=idx.device)
+        error[high] = n / 64
+        dataset.update_error(idx, error)
+        error = error.double()
+        p = 0.01 / n + 0.99 * error / error.sum()
+        counts = torch.zeros(n, dtype=torch.float64, device=idx.device)
+        n_draw = 0
+        for _ in range(4):
+            batch = dataset.get_batch(2**20, slices[0].device)
+            counts += torch.bincount(batch["idx"], minlength=n)
+            n_draw += 2**20
+            self.assert_tensor_close(
+                batch["weight"].double(),
+                1 / (n * p[batch["idx"]]),
+                rtol=1e-3,
+                atol=0,
+            )
+        # each of the high-error points
+        self.assert_tensor_close(counts[high] / n_draw, p[high], rtol=0.05, atol=0)
+        # the low-error points in contiguous groups of 8192 points
+        low = torch.ones(n, dtype=torch.bool, device=idx.device)
+        low[high] = False
+        freq = (counts * low).view(-1, 8192).sum(1) / n_draw
+        expected = (p * low).view(-1, 8192).sum(1)
+        self.assert_tensor_close(freq, expected, rtol=0.06, atol=0)
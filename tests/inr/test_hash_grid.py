@@ -0,0 +1,95 @@
+from tests import TestCaseNeSVoR
+from nesvor.inr.hash_grid_torch import HashEmbedder, _hash
+import torch
+
+
+def hash_grid_reference(embedder: HashEmbedder, tables, x: torch.Tensor) -> torch.Tensor:
+    # per-level implementation with hash tables for all levels
+    x_embedded_all = []
+    for i in range(embedder.n_levels):
+        resolution = int(embedder.base_resolution * embedder.b**i)
+        xyz = x * resolution
+        voxel_min_vertex = torch.floor(xyz).int()
+        voxel_indices = voxel_min_vertex.unsqueeze(1) + embedder.box_offsets
+        hashed_voxel_indices = _hash(voxel_indices, embedder.log2_hashmap_size)
+        e = tables[i][hashed_voxel_indices]
+        w = xyz - voxel_min_vertex
+        c00 = e[:, 0] * (1 - w[:, 0:1]) + e[:, 4] * w[:, 0:1]
+        c01 = e[:, 1] * (1 - w[:, 0:1]) + e[:, 5] * w[:, 0:1]
+        c10 = e[:, 2] * (1 - w[:, 0:1]) + e[:, 6] * w[:, 0:1]
+        c11 = e[:, 3] * (1 - w[:, 0:1]) + e[:, 7] * w[:, 0:1]
+        c0 = c00 * (1 - w[:, 1:2]) + c10 * w[:, 1:2]
+        c1 = c01 * (1 - w[:, 1:2]) + c11 * w[:, 1:2]
+        x_embedded_all.append(c0 * (1 - w[:, 2:3]) + c1 * w[:, 2:3])
+    return torch.cat(x_embedded_all, dim=-1)
+
+
+class TestHashGrid(TestCaseNeSVoR):
+    @staticmethod
+    def get_hash_grid_test_data():
+        torch.manual_seed(0)
+        embedder = HashEmbedder(
+            n_levels=8, log2_hashmap_size=14, base_resolution=4, per_level_scale=1.5
+        ).cuda()
+        # hash tables of all levels in the state dict format of the per-level implementation
+        state_dict = {"box_offsets": embedder.box_offsets}
+        for i in range(embedder.n_levels):
+            state_dict["embeddings.%d.weight" % i] = torch.rand(2**14, 2).cuda() * 2 - 1
+        embedder.load_state_dict(state_dict)
+        tables = [state_dict["embeddings.%d.weight" % i] for i in range(8)]
+        x = torch.rand(4096, 3).cuda()
+        return embedder, tables, x
+
+    def test_dense_levels(self):
+        embedder, _, _ = self.get_hash_grid_test_data()
+        # resolution: 4, 6, 9, 13, 20, 30, 45, 68
+        self.assertEqual(embedder.n_dense_levels, 5)
+        self.assertEqual(
+            embedder.embeddings.shape[0],
+            6**3 + 8**3 + 11**3 + 15**3 + 22**3 + 3 * 2**14,
+        )
+
+    def test_forward(self):
+        embedder, tables, x = self.get_hash_grid_test_data()
+        self.assert_tensor_close(embedder(x), hash_grid_reference(embedder, tables, x))
+
+    def test_backward(self):
+        embedder, tables, x = self.get_hash_grid_test_data()
+        g = torch.randn(x.shape[0], embedder.n_levels * 2, device=x.device)
+        (embedder(x) * g).sum().backward()
+        grad = embedder.embeddings.grad
+        tables = [t.clone().requires_grad_() for t in tables]
+        (hash_grid_reference(embedder, tables, x) * g).sum().backward()
+        for i in range(embedder.n_levels):
+            start = int(embedder.level_offsets[i])
+            if i < embedder.n_dense_levels:
+                # accumulate the gradient of dense vertices into their hash entries
+                grid = torch.arange(int(embedder.dense_sides[i]), dtype=torch.int32)
+                z, y, xx = torch.meshgrid(grid, grid, grid, indexing="ij")
+                idx = _hash(torch.stack((xx, y, z), -1).view(-1, 3), 14).to(x.device)
+                grad_level = torch.zeros_like(tables[i]).index_add_(
+                    0, idx, grad[start : start + idx.shape[0]]
+                )
+            else:
+                grad_level = grad[start : start + 2**14]
+            self.assert_tensor_close(grad_level, tables[i].grad)
+
+    def test_load_packed_state_dict(self):
+        embedder, tables, x = self.get_hash_grid_test_data()
+        embedder_new = HashEmbedder(
+            n_levels=8, log2_hashmap_size=14, base_resolution=4, per_level_scale=1.5
+        ).cuda()
+        embedder_new.load_state_dict(
+            {"box_offsets": embedder.box_offsets, "embeddings": torch.stack(tables)}
+        )
+        self.assert_tensor_equal(embedder_new(x), embedder(x))
+
+    def test_active_levels(self):
+        embedder, tables, x = self.get_hash_grid_test_data()
+        y = hash_grid_reference(embedder, tables, x)
+        for n_active_levels in [1, 3, 5, 6]:
+            embedder.n_active_levels = n_active_levels
+            y_active = embedder(x)
+            n = n_active_levels * 2
+            self.assert_tensor_close(y_active[:, :n], y[:, :n])
+            self.assert_tensor_equal(y_active[:, n:], torch.zeros_like(y[:, n:]))
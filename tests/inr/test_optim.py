@@ -0,0 +1,53 @@
+from tests import TestCaseNeSVoR
+from nesvor.inr.hash_grid_torch import HashEmbedder
+from nesvor.inr.optim import LazyAdam
+import torch
+
+
+class TestOptim(TestCaseNeSVoR):
+    def test_lazy_adam_dense(self):
+        # a lazy update of rows touched at every step is identical to AdamW
+        torch.manual_seed(0)
+        x = torch.randn(100, 3).cuda()
+        params = [x.clone().requires_grad_() for _ in range(2)]
+        kwargs = dict(lr=1e-2, betas=(0.9, 0.99), eps=1e-15, weight_decay=1e-2)
+        optimizers = [
+            torch.optim.AdamW([params[0]], **kwargs),
+            LazyAdam([params[1]], lazy=True, **kwargs),
+        ]
+        for _ in range(10):
+            g = torch.randn_like(x)
+            for p, opt in zip(params, optimizers):
+                p.grad = g.clone()
+                opt.step()
+        self.assert_tensor_close(params[0], params[1])
+
+    def test_lazy_adam_sparse(self):
+        # dense and sparse gradients of the hash grid give the same update,
+        # rows without gradient are not changed
+        torch.manual_seed(0)
+        embedders = [
+            HashEmbedder(
+                n_levels=4,
+                log2_hashmap_size=12,
+                base_resolution=4,
+                per_level_scale=2,
+                sparse_grad=sparse_grad,
+            ).cuda()
+            for sparse_grad in [False, True]
+        ]
+        embedders[1].load_state_dict(embedders[0].state_dict())
+        init = embedders[0].embeddings.detach().clone()
+        optimizers = [LazyAdam(e.parameters(), lr=1e-2, lazy=True) for e in embedders]
+        for _ in range(3):
+            x = torch.rand(256, 3).cuda()
+            for e, opt in zip(embedders, optimizers):
+                opt.zero_grad()
+                e(x).square().sum().backward()
+                opt.step()
+        self.assertTrue(embedders[1].embeddings.grad.is_sparse)
+        self.assert_tensor_close(embedders[0].embeddings, embedders[1].embeddings)
+        last_step = optimizers[0].state[embedders[0].embeddings]["last_step"]
+        untouched = last_step == 0
+        self.assertTrue(untouched.any())
+        self.assert_tensor_equal(embedders[0].embeddings[untouched], init[untouched])
@@ -0,0 +1,33 @@
+from tests import TestCaseNeSVoR
+from nesvor.inr.sample import sample_volume
+from nesvor.image import Volume
+import torch
+
+
+class SphereINR(torch.nn.Module):
+    # a smooth sphere with the sampling interface of INR
+    def sample_batch(self, xyz, transformation, psf_sigma, n_samples, psf_offsets=None):
+        if psf_offsets is not None:
+            return xyz[:, None] + psf_offsets * psf_sigma
+        if n_samples > 1:
+            psf = torch.randn(xyz.shape[0], n_samples, 3, device=xyz.device)
+            return xyz[:, None] + psf * psf_sigma
+        return xyz[:, None]
+
+    def forward(self, xyz):
+        self.n_points += xyz.shape[0] * xyz.shape[1]
+        return torch.sigmoid((15 - xyz.norm(dim=-1)) * 3)
+
+
+class TestSample(TestCaseNeSVoR):
+    def test_occupancy(self):
+        image = torch.zeros((80, 80, 80)).cuda()
+        mask = Volume(image, torch.ones_like(image, dtype=torch.bool), None, 0.8)
+        model = SphereINR()
+        model.n_points = 0
+        v = sample_volume(model, mask, 0.8, 4096, 27, "sobol")
+        n_points = model.n_points
+        model.n_points = 0
+        v_occupancy = sample_volume(model, mask, 0.8, 4096, 27, "sobol", 4, 0.01)
+        self.assertLess(model.n_points, n_points / 2)
+        self.assert_tensor_close(v.image, v_occupancy.image, atol=1e-4, rtol=0)
@@ -0,0 +1,67 @@
+from tests import TestCaseNeSVoR
+from tests.inr.test_data import TestData
+from nesvor.cli.parsers import main_parser
+from nesvor.inr.models import INR
+from nesvor.inr.train import train, progressive_n_levels
+import json
+import os
+import tempfile
+import torch
+
+
+class TestTrain(TestCaseNeSVoR):
+    @staticmethod
+    def get_train_args(slices):
+        parser, _ = main_parser()
+        args = parser.parse_args(
+            ["reconstruct", "--input-slices", "", "--single-precision"]
+        )
+        args.device = slices[0].device
+        args.dtype = torch.float32
+        args.n_iter = 20
+        args.batch_size = 256
+        args.n_samples = 16
+        return args
+
+    def test_train_distributed(self):
+        for device in ["cpu", "cuda"]:
+            with self.subTest(device=device):
+                self.check_train_distributed(device, lazy_adam=False)
+        # sparse gradients of the hash grid are all-gathered
+        self.check_train_distributed("cpu", lazy_adam=True)
+
+    def check_train_distributed(self, device, lazy_adam):
+        slices = TestData.get_dataset_test_data(device)
+        args = self.get_train_args(slices)
+        args.n_proc_train = 2
+        args.lazy_adam = lazy_adam
+        model, output_slices, mask = train(slices, args)
+        self.assertIsInstance(model, INR)
+        self.assertEqual(len(output_slices), len(slices))
+        self.assertTrue(mask.mask.any())
+        x = mask.xyz_masked[:100]
+        self.assertTrue(model(x).isfinite().all())
+
+    def test_progressive_n_levels(self):
+        n_levels = [progressive_n_levels(i, 100, 4, 12) for i in range(1, 121)]
+        self.assertEqual(n_levels[0], 4)
+        self.assertEqual(n_levels[99:], [12] * 21)
+        self.assertTrue(all(a <= b for a, b in zip(n_levels, n_levels[1:])))
+        self.assertEqual(sorted(set(n_levels)), list(range(4, 13)))
+
+    def test_profile(self):
+        slices = TestData.get_dataset_test_data()
+        args = self.get_train_args(slices)
+        with tempfile.TemporaryDirectory() as tmp:
+            args.profile = os.path.join(tmp, "profile.json")
+            args.profile_trace = os.path.join(tmp, "trace.json")
+            args.profile_window = 8
+            args.profile_trace_iters = 4
+            train(slices, args)
+            with open(args.profile) as f:
+                profile = json.load(f)
+            self.assertTrue(os.path.isfile(args.profile_trace))
+        self.assertEqual(profile["n_iter"], 20)
+        self.assertEqual([w["n_iter"] for w in profile["windows"]], [8, 8, 4])
+        for phase in ["get_batch", "forward", "forward/inr/encoding", "backward"]:
+            self.assertIn(phase, profile["mean"]["wall_ms"])
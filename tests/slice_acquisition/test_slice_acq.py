@@ -1,6 +1,7 @@
 from tests import TestCaseNeSVoR
 from nesvor.transform import RigidTransform, mat_update_resolution
-from nesvor.slice_acquisition import slice_acquisition
+from nesvor.slice_acquisition import slice_acquisition, slice_acquisition_adjoint
+from nesvor.slice_acquisition import slice_acq_torch
 from nesvor.utils import get_PSF
 from nesvor.svort.models import SRR
 from tests.phantom3d import phantom3d
@@ -79,3 +80,46 @@ class TestSliceAcq(TestCaseNeSVoR):
         theta = mat_update_resolution(transforms.matrix(), 1, params["res_r"])
         volume_ = srr(theta, slices, volume, params)
         self.assert_tensor_close(volume_, volume, atol=3e-5, rtol=1e-5)
+
+    def test_adjoint(self):
+        # <A x, y> = <x, A^T y> for pixels with enough PSF weight inside the volume
+        slices, transforms, volume, params = self.get_cg_recon_test_data()
+        theta = mat_update_resolution(transforms.matrix(), 1, params["res_r"])
+        res = params["res_s"] / params["res_r"]
+        x = torch.rand_like(volume)
+        y = torch.rand_like(slices)
+        ax, w = slice_acquisition(
+            theta, x, None, None, params["psf"], params["slice_shape"], res, True, False
+        )
+        aty = slice_acquisition_adjoint(
+            theta,
+            params["psf"],
+            y,
+            None,
+            None,
+            params["volume_shape"],
+            res,
+            False,
+            False,
+        )
+        self.assert_tensor_close(
+            (ax * y * (w >= 0.5)).sum(), (aty * x).sum(), atol=0, rtol=1e-4
+        )
+
+    def test_no_cache(self):
+        # the operators created in no_cache() are not cached, the others are kept
+        slices, transforms, volume, params = self.get_cg_recon_test_data()
+        theta = mat_update_resolution(transforms.matrix(), 1, params["res_r"])
+        res = params["res_s"] / params["res_r"]
+        args = (volume, None, None, params["psf"], params["slice_shape"], res, False)
+        slice_acq_torch.clean_cache()
+        slice_acq_torch.slice_acquisition_torch(theta[:4], *args)
+        n_entry = len(slice_acq_torch._cache)
+        self.assertGreater(n_entry, 0)
+        with slice_acq_torch.no_cache():
+            y = slice_acq_torch.slice_acquisition_torch(theta[4:8], *args)
+        self.assertEqual(len(slice_acq_torch._cache), n_entry)
+        self.assert_tensor_close(
+            y, slice_acq_torch.slice_acquisition_torch(theta[4:8], *args)
+        )
+        slice_acq_torch.clean_cache()
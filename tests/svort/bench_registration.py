@@ -0,0 +1,170 @@
+"""
+accuracy and cost of slice-to-volume and volume-to-volume registration
+usage: python -m tests.svort.bench_registration [device]
+"""
+import sys
+import time
+import torch
+import numpy as np
+from nesvor.image import Volume, Stack
+from nesvor.transform import RigidTransform
+from nesvor.svr.registration import (
+    SliceToVolumeRegistration,
+    VolumeToVolumeRegistration,
+    close_registration_pool,
+)
+from nesvor.svr.reconstruction import simulate_slices
+from nesvor.utils import get_PSF
+from tests.phantom3d import phantom3d
+
+
+def svr_data(device, vs=64, seed=0):
+    torch.manual_seed(seed)
+    image = torch.tensor(phantom3d(n=vs), dtype=torch.float32, device=device)
+    volume = Volume(image, image > 0, None, 1.0)
+    stacks = []
+    for angle in ([0, 0, 0], [np.pi / 2, 0, 0], [0, np.pi / 2, 0]):
+        n = vs // 2
+        tz = (torch.arange(n, dtype=torch.float32) - (n - 1) / 2) * 2
+        t = torch.stack((torch.zeros(n), torch.zeros(n), tz), -1)
+        a = torch.tensor([angle], dtype=torch.float32).expand(n, -1)
+        transform = RigidTransform(torch.cat((a, t), -1).to(device))
+        slices = torch.zeros((n, 1, vs, vs), device=device)
+        stacks.append(Stack(slices, None, transform, 1.0, 1.0, 2.0, 2.0))
+    stack = Stack.cat(stacks)
+    psf = get_PSF(res_ratio=(1, 1, 2), device=device)
+    simulated = simulate_slices(stack, volume, False, False, psf)
+    stack.slices = simulated.slices
+    stack.mask = simulated.slices > 0
+    gt = stack.transformation
+    # perturbation: 5 degrees and 2 mm
+    noise = torch.cat(
+        (torch.randn(len(stack), 3) * np.pi / 180 * 5, torch.randn(len(stack), 3) * 2),
+        -1,
+    ).to(device)
+    stack.transformation = RigidTransform(gt.axisangle() + noise)
+    return stack, volume, gt
+
+
+def transform_error(transform, gt):
+    ax = transform.inv().compose(gt).axisangle()
+    rot = torch.linalg.norm(ax[:, :3], dim=-1) * 180 / np.pi
+    trans = torch.linalg.norm(ax[:, 3:], dim=-1)
+    return rot.mean().item(), trans.mean().item()
+
+
+def count_evaluate(reg):
+    reg.n_evaluate = 0
+    evaluate = reg.evaluate
+
+    def _evaluate(*args, **kwargs):
+        reg.n_evaluate += 1
+        return evaluate(*args, **kwargs)
+
+    reg.evaluate = _evaluate
+
+
+def run_svr(data, **kwargs):
+    stack, volume, gt = data
+    reg = SliceToVolumeRegistration(
+        num_levels=3, num_steps=5, step_size=2, max_iter=30, **kwargs
+    )
+    count_evaluate(reg)
+    t = time.time()
+    transform, loss = reg(stack, volume, use_mask=True)
+    t = time.time() - t
+    return t, reg.n_evaluate, loss.mean().item(), transform_error(transform, gt)
+
+
+def run_svr_sharded(data, n_proc, n_call=3):
+    # time of each call, the first one includes starting the process pool
+    stack, volume, _ = data
+    times = []
+    for _ in range(n_call):
+        reg = SliceToVolumeRegistration(
+            num_levels=3, num_steps=5, step_size=2, max_iter=30
+        )
+        t = time.time()
+        reg(stack, volume, use_mask=True, n_proc=n_proc)
+        times.append(time.time() - t)
+    close_registration_pool()
+    return times
+
+
+def run_vvr(device, **kwargs):
+    image = torch.tensor(phantom3d(n=96), dtype=torch.float32, device=device)
+    ax_source = torch.tensor([[0.4, 0.1, -0.6, 20, -50, 100]], device=device)
+    ax_target = ax_source + torch.tensor(
+        [[0.05, -0.05, 0.1, 3, -2, 1.5]], device=device
+    )
+    source = Volume(image, None, RigidTransform(ax_source, False), 1, 1, 1.5)
+    target = Volume(image, None, RigidTransform(ax_target, False), 1, 1, 1.5)
+    reg = VolumeToVolumeRegistration(
+        num_levels=3, num_steps=8, step_size=2, max_iter=20, **kwargs
+    )
+    count_evaluate(reg)
+    t = time.time()
+    transform, loss = reg(source, target)
+    t = time.time() - t
+    gt = target.transformation
+    return t, reg.n_evaluate, loss.mean().item(), transform_error(transform, gt)
+
+
+def gradient_similarity(data):
+    # cosine similarity between the autograd gradient and finite differences
+    stack, volume, _ = data
+    reg = SliceToVolumeRegistration(num_levels=1, auto_grad=True)
+    theta = stack.transformation.axisangle(reg.trans_first)
+    reg.volume_mask = volume.mask[None, None]
+    reg.slices_mask = stack.mask
+    params = {"res_s": 1.0, "res_r": 1.0}
+    reg.prepare(theta, volume.image[None, None], stack.slices, params)
+    reg._degree2rad = reg._degree2rad.to(theta.device)
+    reg.current_level = 0
+    source, target = reg.update_level(theta, volume.image[None, None], stack.slices)
+    reg.activate_idx = torch.ones(len(stack), dtype=torch.bool, device=theta.device)
+    theta = reg.rad2degree(theta)
+    results = []
+    with torch.enable_grad():
+        _, g_auto = reg.grad(theta.clone().requires_grad_(), source, target, 0)
+    reg.auto_grad = False
+    for step_size in [2, 0.5, 0.1, 0.02]:
+        with torch.no_grad():
+            _, g_fd = reg.grad(theta.clone(), source, target, step_size)
+        cos = torch.cosine_similarity(g_auto, g_fd, dim=-1)
+        results.append((step_size, cos.mean().item()))
+    return results
+
+
+if __name__ == "__main__":
+    device = sys.argv[1] if len(sys.argv) > 1 else "cpu"
+    data = svr_data(device)
+    stack, _, gt = data
+    rot, trans = transform_error(stack.transformation, gt)
+    print("initial error: %.3f deg, %.3f mm" % (rot, trans))
+    modes = [
+        ("finite difference", {}),
+        ("autograd", {"auto_grad": True}),
+        ("lbfgs", {"optimizer": {"name": "lbfgs"}}),
+        ("lbfgs + autograd", {"optimizer": {"name": "lbfgs"}, "auto_grad": True}),
+    ]
+    header = "%-24s %8s %8s %10s %10s %10s"
+    row = "%-24s %8.2f %8d %10.4f %10.3f %10.3f"
+    print(header % ("SVR", "time", "#eval", "loss", "rot err", "trans err"))
+    for name, kwargs in modes:
+        t, n_eval, loss, (rot, trans) = run_svr(data, **kwargs)
+        print(row % (name, t, n_eval, loss, rot, trans))
+    print(header % ("VVR", "time", "#eval", "loss", "rot err", "trans err"))
+    for name, kwargs in modes:
+        t, n_eval, loss, (rot, trans) = run_vvr(device, **kwargs)
+        print(row % (name, t, n_eval, loss, rot, trans))
+    if device == "cpu":
+        print("SVR on CPU with n_proc processes (time of 3 calls)")
+        for n_proc in [1, 2, 4, 8]:
+            if n_proc > torch.get_num_threads():
+                break
+            times = run_svr_sharded(data, n_proc)
+            print("n_proc %d: %s" % (n_proc, " ".join("%.2fs" % t for t in times)))
+    print("cosine similarity of autograd and finite-difference gradients (SVR)")
+    for step_size, cos in gradient_similarity(data):
+        print("step size %5.2f: %.4f" % (step_size, cos))
@@ -0,0 +1,49 @@
+"""
+time and peak memory of the edge-preserving regularization in srr_update
+for a volume at 0.5 mm resolution
+usage: python -m tests.svort.bench_srr [device] [size]
+"""
+import sys
+import time
+import resource
+import multiprocessing
+import torch
+from nesvor.svr.reconstruction import edge_preserving_regularization
+from tests.svort.test_srr import edge_preserving_regularization_loop
+
+
+def run(method, size, device):
+    torch.manual_seed(0)
+    volume = torch.rand((1, 1, size, size, size), device=device)
+    reconstructed = volume + 0.1 * torch.randn_like(volume)
+    if device == "cpu":
+        mem0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    else:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        mem0 = torch.cuda.memory_allocated()
+    t = time.time()
+    method(volume, reconstructed, 0.2)
+    if device == "cpu":
+        mem = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    else:
+        torch.cuda.synchronize()
+        mem = torch.cuda.max_memory_allocated()
+    return time.time() - t, (mem - mem0) / 2**20
+
+
+if __name__ == "__main__":
+    device = sys.argv[1] if len(sys.argv) > 1 else "cpu"
+    # 0.5 mm over a 100 mm field of view
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    print("volume %d^3 (%.0f MB)" % (size, size**3 * 4 / 2**20))
+    methods = [
+        ("loop", edge_preserving_regularization_loop),
+        ("fused", edge_preserving_regularization),
+    ]
+    # run each method in a new process to measure its peak memory
+    ctx = multiprocessing.get_context("fork" if device == "cpu" else "spawn")
+    for name, method in methods:
+        with ctx.Pool(1) as pool:
+            t, mem = pool.apply(run, (method, size, device))
+        print("%-8s time = %.2f s, peak temporary memory = %.0f MB" % (name, t, mem))
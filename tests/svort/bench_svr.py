@@ -0,0 +1,110 @@
+"""
+image quality vs number of forward/adjoint operations of the SVR inner loop
+(super-resolution reconstruction) with the gd and cg solvers
+usage: python -m tests.svort.bench_svr [device]
+"""
+import sys
+import time
+import torch
+import numpy as np
+import nesvor.svr.reconstruction as reconstruction
+from nesvor.image import Volume, Stack
+from nesvor.transform import RigidTransform
+from nesvor.svr.pipeline import slice_to_volume_reconstruction
+from nesvor.utils import get_PSF
+from tests.phantom3d import phantom3d
+
+
+def phantom_slices(device, vs=64, thickness=3.0, noise=0.05, seed=0):
+    torch.manual_seed(seed)
+    image = torch.tensor(phantom3d(n=vs), dtype=torch.float32, device=device)
+    volume = Volume(image, image > 0, None, 1.0)
+    psf = get_PSF(res_ratio=(1, 1, thickness), device=device)
+    slices = []
+    for angle in ([0, 0, 0], [np.pi / 2, 0, 0], [0, np.pi / 2, 0]):
+        n = int(vs / thickness)
+        tz = (torch.arange(n, dtype=torch.float32) - (n - 1) / 2) * thickness
+        t = torch.stack((torch.zeros(n), torch.zeros(n), tz), -1)
+        a = torch.tensor([angle], dtype=torch.float32).expand(n, -1)
+        transform = RigidTransform(torch.cat((a, t), -1).to(device))
+        zeros = torch.zeros((n, 1, vs, vs), device=device)
+        stack = Stack(zeros, None, transform, 1.0, 1.0, thickness, thickness)
+        stack = reconstruction.simulate_slices(stack, volume, False, False, psf)
+        stack.slices = stack.slices + noise * torch.randn_like(stack.slices)
+        stack.slices = stack.slices.clamp_(min=0)
+        stack.mask = stack.slices > 0.05
+        slices.extend(stack[:])
+    return slices, volume
+
+
+def count_calls(module, names):
+    counter = {name: 0 for name in names}
+    for name in names:
+        f = getattr(module, name)
+
+        def wrapped(*args, _f=f, _name=name, **kwargs):
+            counter[_name] += 1
+            return _f(*args, **kwargs)
+
+        setattr(module, name, wrapped)
+    return counter
+
+
+def quality(volume, gt):
+    # compare with the ground truth on the voxels of the output volume
+    v = volume.image[volume.mask]
+    v_gt = gt.sample_points(volume.xyz_masked)
+    ncc = torch.corrcoef(torch.stack((v, v_gt)))[0, 1].item()
+    scale = (v * v_gt).sum() / (v * v).sum()
+    nrmse = (torch.linalg.norm(scale * v - v_gt) / torch.linalg.norm(v_gt)).item()
+    return ncc, nrmse
+
+
+if __name__ == "__main__":
+    device = sys.argv[1] if len(sys.argv) > 1 else "cpu"
+    slices, gt = phantom_slices(device)
+    counter = count_calls(
+        reconstruction, ["slice_acquisition", "slice_acquisition_adjoint"]
+    )
+    settings = [
+        ("gd", [7], {}),
+        ("gd", [14], {}),
+        ("gd", [21], {}),
+        ("cg", [2], {"srr_cg_iter": 3}),
+        ("cg", [3], {"srr_cg_iter": 3}),
+        ("cg", [5], {"srr_cg_iter": 3}),
+        ("cg", [7], {"srr_cg_iter": 3}),
+        ("cg", [3], {"srr_cg_iter": 6}),
+    ]
+    print(
+        "%-6s %6s %12s %8s %8s %8s %8s"
+        % ("solver", "inner", "kwargs", "#A", "#At", "ncc", "nrmse")
+    )
+    for solver, n_iter_rec, kwargs in settings:
+        for k in counter:
+            counter[k] = 0
+        t = time.time()
+        volume, _, _ = slice_to_volume_reconstruction(
+            [s.clone() for s in slices],
+            output_resolution=1.0,
+            n_iter=1,
+            n_iter_rec=n_iter_rec,
+            srr_solver=solver,
+            device=gt.device,
+            **kwargs,
+        )
+        t = time.time() - t
+        ncc, nrmse = quality(volume, gt)
+        print(
+            "%-6s %6d %12s %8d %8d %8.4f %8.4f %.1fs"
+            % (
+                solver,
+                n_iter_rec[0],
+                ",".join("%s=%s" % kv for kv in kwargs.items()),
+                counter["slice_acquisition"],
+                counter["slice_acquisition_adjoint"],
+                ncc,
+                nrmse,
+                t,
+            )
+        )
@@ -18,3 +18,13 @@ class TestCG(TestCaseNeSVoR):
         x, _ = cg_scipy(A.cpu().numpy(), b.cpu().numpy(), tol=0, maxiter=n_iter, atol=0)
         x = torch.tensor(x, dtype=x_.dtype, device=x_.device).reshape(x_.shape)
         self.assert_tensor_close(x_, x)
+
+    def test_pcg(self):
+        torch.manual_seed(0)
+        B = torch.rand((20, 20), dtype=torch.float64).cuda()
+        A = B @ B.T + torch.diag(torch.arange(1, 21, dtype=B.dtype, device=B.device))
+        b = torch.rand((20, 1), dtype=A.dtype, device=A.device)
+        diag_inv = 1 / torch.diagonal(A)[:, None]
+        x_ = cg(lambda x: A @ x, b, None, 100, M=lambda r: r * diag_inv, rtol=1e-10)
+        x = torch.linalg.solve(A, b)
+        self.assert_tensor_close(x_, x)
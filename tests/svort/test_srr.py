@@ -0,0 +1,36 @@
+from tests import TestCaseNeSVoR
+from nesvor.svr.reconstruction import edge_preserving_regularization
+import torch
+
+
+def edge_preserving_regularization_loop(volume, reconstructed, delta):
+    g = torch.zeros_like(volume)
+    D, H, W = volume.shape[-3:]
+    v0 = volume[:, :, 1 : D - 1, 1 : H - 1, 1 : W - 1]
+    r0 = reconstructed[:, :, 1 : D - 1, 1 : H - 1, 1 : W - 1]
+    for dx in [-1, 0, 1]:
+        for dy in [-1, 0, 1]:
+            for dz in [-1, 0, 1]:
+                if dx == 0 and dy == 0 and dz == 0:
+                    continue
+                v1 = volume[
+                    :, :, 1 + dz : D - 1 + dz, 1 + dy : H - 1 + dy, 1 + dx : W - 1 + dx
+                ]
+                r1 = reconstructed[
+                    :, :, 1 + dz : D - 1 + dz, 1 + dy : H - 1 + dy, 1 + dx : W - 1 + dx
+                ]
+                d2 = dx * dx + dy * dy + dz * dz
+                dv2 = (v1 - v0) ** 2
+                b = 1 / (d2 * torch.sqrt(1 + 1 / (d2 * delta * delta) * dv2))
+                g[:, :, 1 : D - 1, 1 : H - 1, 1 : W - 1] += b * (r1 - r0)
+    return g
+
+
+class TestSRR(TestCaseNeSVoR):
+    def test_edge_preserving_regularization(self):
+        volume = torch.rand((1, 1, 30, 40, 50)).cuda()
+        reconstructed = volume + 0.1 * torch.randn_like(volume)
+        g_ref = edge_preserving_regularization_loop(volume, reconstructed, 0.2)
+        for slab_size in [None, 1, 7, 100]:
+            g = edge_preserving_regularization(volume, reconstructed, 0.2, slab_size)
+            self.assert_tensor_close(g, g_ref, atol=1e-5, rtol=1e-5)
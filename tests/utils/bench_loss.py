@@ -0,0 +1,39 @@
+"""
+runtime of the image similarity losses on stack-sized inputs
+usage: python -m tests.utils.bench_loss [device]
+"""
+import sys
+import time
+import torch
+from nesvor.utils import ncc_loss, ssim_loss
+
+
+def timeit(f, *args, n=10, **kwargs):
+    f(*args, **kwargs)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    t = time.time()
+    for _ in range(n):
+        f(*args, **kwargs)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.time() - t) / n
+
+
+if __name__ == "__main__":
+    device = sys.argv[1] if len(sys.argv) > 1 else "cpu"
+    torch.manual_seed(0)
+    print("%-20s %10s %10s %10s" % ("stack", "ssim", "ncc", "ncc win=9"))
+    for n, h, w in [(30, 128, 128), (60, 192, 192), (80, 256, 256)]:
+        x = torch.rand((n, 1, h, w), device=device)
+        y = x + 0.3 * torch.rand_like(x)
+        m = x > 0.1
+        print(
+            "%-20s %10.4f %10.4f %10.4f"
+            % (
+                "%d x %d x %d" % (n, h, w),
+                timeit(ssim_loss, x, y, m),
+                timeit(ncc_loss, x, y, m, win=None),
+                timeit(ncc_loss, x, y, m, win=9),
+            )
+        )
@@ -0,0 +1,43 @@
+from tests import TestCaseNeSVoR
+from nesvor.utils.loss import box_filter, ncc_loss, ssim_loss
+from nesvor.utils import gaussian_blur
+import torch
+
+
+class TestLoss(TestCaseNeSVoR):
+    def test_box_filter(self):
+        for shape in [(2, 3, 50), (2, 3, 40, 30), (1, 2, 20, 25, 30)]:
+            x = torch.rand(shape).cuda()
+            for win in [1, 3, 9, 15]:
+                y = box_filter(x, win, "dense")
+                for method in ["separable", "cumsum", "auto"]:
+                    self.assert_tensor_close(
+                        box_filter(x, win, method), y, atol=1e-5, rtol=1e-5
+                    )
+
+    def test_ncc(self):
+        I = torch.rand((4, 1, 30, 30, 30)).cuda()
+        J = I + torch.rand_like(I)
+        self.assert_tensor_close(
+            ncc_loss(I, I, win=9), -torch.ones_like(I), atol=1e-3, rtol=0
+        )
+        loss = ncc_loss(I, J, win=9)
+        self.assertEqual(loss.shape, I.shape)
+        self.assertTrue(bool(((loss <= 0) & (loss >= -1)).all()))
+
+    def test_ssim(self):
+        I = torch.rand((5, 1, 40, 50)).cuda()
+        J = I + torch.rand_like(I)
+        ssim = -ssim_loss(I, J)
+        # reference: blur each moment separately
+        I = (I - I.min()) / (I.max() - I.min())
+        J = (J - J.min()) / (J.max() - J.min())
+        sigma, truncated = 1.5, 11 / 2 / 1.5 - 0.5
+        mu1, mu2, I2, J2, IJ = (
+            gaussian_blur(x, sigma, truncated) for x in (I, J, I * I, J * J, I * J)
+        )
+        C1, C2 = 0.01**2, 0.03**2
+        ssim_ref = ((2 * mu1 * mu2 + C1) / (mu1**2 + mu2**2 + C1)) * (
+            (2 * (IJ - mu1 * mu2) + C2) / (I2 - mu1**2 + J2 - mu2**2 + C2)
+        )
+        self.assert_tensor_close(ssim, ssim_ref)
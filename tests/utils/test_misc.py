@@ -0,0 +1,30 @@
+from tests import TestCaseNeSVoR
+from nesvor.utils import gaussian_blur, ConvergenceMonitor
+from nesvor.utils.misc import gaussian_1d_kernel
+import torch
+import torch.nn.functional as F
+
+
+class TestMisc(TestCaseNeSVoR):
+    def test_gaussian_blur(self):
+        x = torch.rand((2, 3, 40, 30, 35)).cuda()
+        # short (conv) and long (fft) kernels
+        sigma = [0.5, 2.0, 6.0]
+        y = gaussian_blur(x, sigma, 4.0)
+        y_ref = x
+        for d, s in enumerate(sigma):
+            k = gaussian_1d_kernel(s, 4.0, x.device)
+            shape = [1, 1, 1, 1, 1]
+            shape[d + 2] = -1
+            padding = [0, 0, 0]
+            padding[d] = (k.numel() - 1) // 2
+            k = k.view(shape).repeat(3, 1, 1, 1, 1)
+            y_ref = F.conv3d(y_ref, k, padding=padding, groups=3)
+        self.assert_tensor_close(y, y_ref, atol=1e-5, rtol=1e-5)
+
+    def test_convergence_monitor(self):
+        monitor = ConvergenceMonitor(10, 0.1)
+        # noisy loss that decreases by 50% per window, then plateaus
+        losses = [100 * 0.5 ** (i // 10) + (i % 2) for i in range(40)] + [7.0] * 20
+        converged = [i for i, v in enumerate(losses) if monitor(v)]
+        self.assertEqual(converged, [59])